@@ -0,0 +1,327 @@
+"""
+asyncio peer engine.
+
+Runs every peer connection, the dialers and both choking timers as tasks on
+one event loop in a single background thread, instead of one thread per
+socket plus two sleeping choker threads. Message handling, piece bookkeeping
+and the choking decisions are shared with Client; only the I/O layer differs.
+"""
+
+import asyncio
+import threading
+
+import codec
+from client import Client
+from connection_manager import BASE_DELAY, PROBE_DELAY, backoff_delay
+
+HANDSHAKE_LENGTH = 32
+HANDSHAKE_TIMEOUT = 5  # Seconds to wait for the other side's handshake
+CONNECT_TIMEOUT = 3
+LISTEN_BACKLOG = 1024  # Large enough for a whole swarm dialing in at once
+
+
+class StreamConnection:
+    """Socket-like front for an asyncio stream, so shared Client code can send to it and close it"""
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.loop_thread = threading.get_ident()  # Connections are always created on the loop thread
+
+    def sendall(self, data):
+        # The transport buffers writes, so this never blocks the loop;
+        # the peer's writer task applies backpressure with drain()
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncClient(Client):
+    def __init__(self, config_filepath, host, port, ID="1001"):
+        super().__init__(config_filepath, host, port, ID)
+        self.loop = None
+        self.loop_thread = None
+        self.server = None
+        self.ready = threading.Event()
+        self.dial_slots = None  # Bounds concurrent dials at MaxConcurrentDials, like the threaded engine's dialer pool
+        self.use_sendfile = True  # Cleared once loop.sendfile turns out to be unavailable for our streams
+
+    def setup(self, other_peers):
+        """Start the event loop thread, then return once the listener is up"""
+        self.loop_thread = threading.Thread(target=self.run_loop, args=(other_peers,), daemon=True)
+        self.loop_thread.start()
+        self.ready.wait()
+
+    def run_loop(self, other_peers):
+        """Body of the event loop thread"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.start(other_peers))
+            self.loop.run_forever()
+        except Exception as e:
+            print(f"Error in event loop: {e}")
+        finally:
+            self.ready.set()
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+    async def start(self, other_peers):
+        """Bind the listener, start the choking timers and dial earlier peers"""
+        listen_host = "127.0.0.1" if self.host not in ["localhost", "127.0.0.1"] else self.host
+        while True:
+            try:
+                self.server = await asyncio.start_server(self.handle_incoming, listen_host, self.port,
+                                                         backlog=LISTEN_BACKLOG, reuse_address=True)
+                break
+            except OSError:
+                self.port += 1
+        print(f"Listening on {listen_host}:{self.port} (configured host was {self.host})")
+
+        self.loop.call_later(self.config.unchoking_interval, self.preferred_neighbors_timer)
+        self.loop.call_later(self.config.optimistic_unchoking_interval, self.optimistic_unchoke_timer)
+        self.loop.call_later(self.config.resume_interval, self.resume_checkpoint_timer)
+
+        self.dial_slots = asyncio.Semaphore(max(1, self.config.max_concurrent_dials))
+        for peer_info in other_peers:
+            self.loop.create_task(self.connect_to_peer(peer_info))
+        self.ready.set()
+
+    def preferred_neighbors_timer(self):
+        """Timer callback running the preferred neighbors round, like the scheduler task of the threaded engine"""
+        if not self.running:
+            return
+        self.preferred_neighbors_task()
+        self.loop.call_later(self.config.unchoking_interval, self.preferred_neighbors_timer)
+
+    def optimistic_unchoke_timer(self):
+        """Timer callback running the optimistic unchoke round"""
+        if not self.running:
+            return
+        self.run_optimistic_unchoke_round()
+        self.loop.call_later(self.config.optimistic_unchoking_interval, self.optimistic_unchoke_timer)
+
+    def resume_checkpoint_timer(self):
+        """Timer callback replacing the checkpoint_resume_state_loop thread"""
+        if not self.running:
+            return
+        # Flushing and writing the state file block, so keep them off the loop
+        self.loop.run_in_executor(self.disk_pool, self.checkpoint_resume_state)
+        self.loop.call_later(self.config.resume_interval, self.resume_checkpoint_timer)
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds, on the event loop"""
+        if self.loop is not None and self.running:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+        else:
+            callback()
+
+    async def read_handshake(self, reader):
+        """Read and validate a handshake; returns the peer ID or None"""
+        handshake = await asyncio.wait_for(reader.readexactly(HANDSHAKE_LENGTH), HANDSHAKE_TIMEOUT)
+        handshake_message = handshake.decode('utf-8')
+        print(f"Received handshake: {handshake_message}")
+        if not self.check_handshake(handshake_message):
+            print(f"Handshake is invalid: {handshake_message}")
+            return None
+        return handshake_message[-4:]
+
+    async def handle_incoming(self, reader, writer):
+        """Handle a connection accepted by the listener"""
+        print(f"Accepted connection from {writer.get_extra_info('peername')}")
+        try:
+            # When a peer connects, they send the first handshake
+            peer_id = await self.read_handshake(reader)
+            if peer_id is None:
+                writer.close()
+                return
+
+            if peer_id in [p.ID for p in self.peers] or peer_id == self.ID:
+                print(f"Peer {peer_id} is already connected, closing connection")
+                writer.close()
+                return
+
+            if peer_id in self.banned_peers:
+                print(f"Peer {peer_id} is banned, closing connection")
+                writer.close()
+                return
+
+            writer.write(self.create_handshake().encode('utf-8'))
+            print(f"Sent reciprocal handshake to peer {peer_id}")
+            peer = self.add_peer(StreamConnection(self.loop, writer), peer_id, False)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, UnicodeDecodeError) as e:
+            print(f"Error in handle_incoming: {e}")
+            writer.close()
+            return
+
+        await self.receive_from_stream(peer, reader, writer)
+
+    async def connect_to_peer(self, peer_info):
+        """Dial an earlier peer, retrying with backoff, and redial it whenever the connection drops"""
+        host = "127.0.0.1" if peer_info[0] not in ["localhost", "127.0.0.1"] else peer_info[0]
+        port = int(peer_info[1])
+        address = (peer_info[0], peer_info[1])
+        attempts = 0  # Failures since the last successful handshake
+        base_delay = PROBE_DELAY  # Until the first handshake, the peer may just not be listening yet
+        while self.running:
+            async with self.dial_slots:
+                print(f"Connecting to {host}:{port}")
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError) as e:
+                    reader = None
+                    retry_delay = backoff_delay(attempts, self.config.dial_backoff_max, base_delay)
+                    attempts += 1
+                    print(f"Dial to {address} failed ({e}), retrying in {retry_delay:.1f}s")
+            if reader is None:
+                await asyncio.sleep(retry_delay)
+                continue
+
+            try:
+                # Send the handshake after connecting to a peer
+                writer.write(self.create_handshake().encode('utf-8'))
+                print(f"Sent initiating handshake to {host}")
+                peer_id = await self.read_handshake(reader)
+                if peer_id in self.banned_peers:
+                    print(f"Peer {peer_id} is banned, closing connection")
+                    writer.close()
+                    return
+                peer = None
+                if peer_id is not None:
+                    peer = self.add_peer(StreamConnection(self.loop, writer), peer_id, True, address)
+                    attempts = 0
+                    base_delay = BASE_DELAY
+                else:
+                    writer.close()
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, UnicodeDecodeError) as e:
+                print(f"Error in connect_to_peer: {e}")
+                writer.close()
+                peer = None
+
+            if peer is not None:
+                await self.receive_from_stream(peer, reader, writer)
+                if peer.ID in self.banned_peers:
+                    return
+            if not self.running:
+                return
+            retry_delay = backoff_delay(attempts, self.config.dial_backoff_max, base_delay)
+            attempts += 1
+            print(f"Connection to {address} lost, redialing in {retry_delay:.1f}s")
+            await asyncio.sleep(retry_delay)
+
+    def redial(self, address):
+        """Redialing is done by the peer's connect_to_peer task"""
+
+    def stop_dialing(self, address):
+        """connect_to_peer stops on its own once the peer is banned"""
+
+    def start_writer(self, peer):
+        """Start the task that sends everything queued for the peer; called on the loop thread"""
+        ready = asyncio.Event()
+        peer.outbound.on_ready = lambda: self.loop.call_soon_threadsafe(ready.set)
+        self.loop.create_task(self.write_to_stream(peer, ready))
+
+    async def write_to_stream(self, peer, ready):
+        """Drain the peer's outbound queue into its stream, waiting for the transport between writes"""
+        writer = peer.socket.writer
+        while not peer.outbound.closed:
+            item = peer.outbound.take()
+            if item is None:
+                await ready.wait()
+                ready.clear()
+                continue
+            frames, block = item
+            try:
+                if frames is not None:
+                    writer.write(frames)
+                else:
+                    await self.write_block_to_stream(peer, writer, block)
+                # Keep the transport buffer short, so control messages are not stuck behind blocks
+                await writer.drain()
+            except Exception as e:
+                # The reader sees the broken connection and removes the peer
+                print(f"Error sending to peer {peer.ID}: {e}")
+                return
+
+    async def write_block_to_stream(self, peer, writer, block):
+        """Upload a block with loop.sendfile straight from the file, or buffered where the loop cannot do that"""
+        piece_index, begin, length = block
+        store = self.get_piece_store()
+        store.check_block(piece_index, begin, length)
+        writer.write(self.block_header(piece_index, begin, length))
+        sent = 0
+        if self.use_sendfile:
+            try:
+                for stored, offset, count in store.spans(store.piece_offset(piece_index) + begin, length):
+                    await self.loop.sendfile(writer.transport, stored.file_object(), offset, count, fallback=False)
+                    sent += count
+            except (asyncio.SendfileNotAvailableError, RuntimeError) as e:
+                # RuntimeError also means a closing transport; then the buffered write fails as well
+                if writer.transport.is_closing():
+                    raise
+                print(f"loop.sendfile not available, using buffered uploads: {e}")
+                self.use_sendfile = False
+        if sent < length:
+            writer.write(store.read_block(piece_index, begin + sent, length - sent))
+        self.block_sent(peer, piece_index, length)
+
+    async def receive_from_stream(self, peer, reader, writer):
+        """Process messages from a peer until the connection ends"""
+        while self.running:
+            try:
+                header = await reader.readexactly(codec.HEADER_SIZE)
+                payload_length, mtype = codec.decode_header(header)
+                payload = await reader.readexactly(payload_length) if payload_length else b""
+                print(f"Received message type {mtype} from peer {peer.ID}")
+
+                self.handle_message(peer, mtype, payload)
+            except asyncio.IncompleteReadError:
+                print(f"Connection with peer {peer.ID} closed")
+                break
+            except Exception as e:
+                print(f"Error receiving from peer {peer.ID}: {e}")
+                break
+
+        # Connection ended, clean up
+        self.remove_peer(peer)
+
+    async def stop_loop(self):
+        """Close the listener and every connection, give readers a moment to finish, then stop the loop"""
+        if self.server:
+            self.server.close()
+        with self.peers_lock:
+            for peer in self.peers:
+                peer.outbound.close()
+                peer.socket.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+        self.loop.stop()
+
+    def shutdown(self):
+        """Gracefully shut down the client"""
+        print("Shutting down client...")
+        self.running = False
+        if self.loop and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.stop_loop(), self.loop)
+            self.loop_thread.join(timeout=5)
+        if self.verify_pool:
+            self.verify_pool.shutdown(wait=True, cancel_futures=True)
+        self.disk_pool.shutdown(wait=True)
+        self.checkpoint_resume_state()
+        self.close_piece_store()
+        self.logger.close()
+        if self.trace is not None:
+            self.trace.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        print("Client shutdown complete")
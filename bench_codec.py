@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the peer message codec.
+
+Compares the old ASCII framing (zero-padded 4-digit decimal length, ASCII type
+digit, str payloads) with the binary framing in codec.py, for both small
+control frames and full piece frames.
+
+Usage: python bench_codec.py [--piece-size PIECE_SIZE] [--frames FRAMES] [--runs RUNS]
+"""
+
+import argparse
+import os
+import time
+
+import codec
+
+
+# --- Old ASCII framing, kept here only for comparison ---
+
+def legacy_encode(message_type, payload="", encoding='utf-8'):
+    length = str(len(payload) + 1)
+    while len(length) < 4:
+        length = "0" + length
+    return (length + message_type + payload).encode(encoding)
+
+
+def legacy_decode_stream(data):
+    offset = 0
+    frames = 0
+    while offset < len(data):
+        length = data[offset:offset + 4].decode('utf-8')
+        if not length.isdigit():
+            raise ValueError(f"Invalid message length: {length}")
+        length = int(length)
+        message_type = data[offset + 4:offset + 5].decode('utf-8')
+        payload = data[offset + 5:offset + 4 + length].decode('latin1')
+        if message_type in ("4", "6"):
+            int(payload)
+        offset += 4 + length
+        frames += 1
+    return frames
+
+
+# --- Binary framing ---
+
+def binary_decode_stream(data):
+    offset = 0
+    frames = 0
+    while True:
+        frame = codec.decode_frame(data, offset)
+        if frame is None:
+            break
+        message_type, payload, offset = frame
+        if message_type in (codec.HAVE, codec.REQUEST, codec.PIECE):
+            codec.decode_index(payload)
+        frames += 1
+    return frames
+
+
+def rate(frames, elapsed):
+    return frames / elapsed if elapsed > 0 else float("inf")
+
+
+def best_of(runs, func):
+    """Run a benchmark several times and keep the best rate for each column"""
+    results = [func() for _ in range(runs)]
+    return tuple(max(column) for column in zip(*results))
+
+
+def bench_control(frames):
+    """Have messages: tiny frames, dominated by per-frame overhead"""
+    start = time.perf_counter()
+    for i in range(frames):
+        legacy_encode("4", str(i % 9999))
+    legacy_encode_rate = rate(frames, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        codec.encode_frame(codec.HAVE, codec.encode_index(i))
+    binary_encode_rate = rate(frames, time.perf_counter() - start)
+
+    legacy_stream = b"".join(legacy_encode("4", str(i % 9999)) for i in range(frames))
+    binary_stream = b"".join(codec.encode_frame(codec.HAVE, codec.encode_index(i)) for i in range(frames))
+
+    start = time.perf_counter()
+    legacy_decode_stream(legacy_stream)
+    legacy_decode_rate = rate(frames, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    binary_decode_stream(binary_stream)
+    binary_decode_rate = rate(frames, time.perf_counter() - start)
+
+    return legacy_encode_rate, binary_encode_rate, legacy_decode_rate, binary_decode_rate
+
+
+def bench_piece(frames, piece_size):
+    """Piece messages: the legacy format cannot carry more than 9998 payload bytes,
+    so both runs use a piece size capped there. Legacy frames are encoded as
+    latin1, since utf-8 would change binary lengths."""
+    piece_size = min(piece_size, 9998 - 4)
+    legacy_content = os.urandom(piece_size)
+    binary_content = legacy_content
+
+    def encode_legacy(i):
+        return legacy_encode("7", str(i).zfill(4) + legacy_content.decode('latin1'), 'latin1')
+
+    def encode_binary(i):
+        return codec.encode_frame(codec.PIECE, codec.encode_block_header(i, 0) + binary_content)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        encode_legacy(i)
+    legacy_encode_rate = rate(frames, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        encode_binary(i)
+    binary_encode_rate = rate(frames, time.perf_counter() - start)
+
+    legacy_stream = b"".join(encode_legacy(i) for i in range(frames))
+    binary_stream = b"".join(encode_binary(i) for i in range(frames))
+
+    start = time.perf_counter()
+    legacy_decode_stream(legacy_stream)
+    legacy_decode_rate = rate(frames, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    binary_decode_stream(binary_stream)
+    binary_decode_rate = rate(frames, time.perf_counter() - start)
+
+    return piece_size, legacy_encode_rate, binary_encode_rate, legacy_decode_rate, binary_decode_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ASCII vs binary message framing")
+    parser.add_argument("--piece-size", type=int, default=8192, help="Piece payload size in bytes (at most 9994, the legacy limit)")
+    parser.add_argument("--frames", type=int, default=200000, help="Number of control frames to encode/decode")
+    parser.add_argument("--runs", type=int, default=3, help="Repetitions per benchmark; the best run is reported")
+    args = parser.parse_args()
+
+    piece_frames = max(1, args.frames // 50)
+
+    le, be, ld, bd = best_of(args.runs, lambda: bench_control(args.frames))
+    print(f"Control frames (have), {args.frames} frames")
+    print(f"  encode: legacy {le:>12,.0f} frames/s   binary {be:>12,.0f} frames/s   ({be / le:.1f}x)")
+    print(f"  decode: legacy {ld:>12,.0f} frames/s   binary {bd:>12,.0f} frames/s   ({bd / ld:.1f}x)")
+
+    piece_size, le, be, ld, bd = best_of(args.runs, lambda: bench_piece(piece_frames, args.piece_size))
+    print(f"Piece frames, {piece_frames} frames of {piece_size} B")
+    print(f"  encode: legacy {le:>12,.0f} frames/s   binary {be:>12,.0f} frames/s   ({be / le:.1f}x)")
+    print(f"  decode: legacy {ld:>12,.0f} frames/s   binary {bd:>12,.0f} frames/s   ({bd / ld:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Connection scaling benchmark for the two networking engines.
+
+Starts one client with the chosen engine, opens many raw connections to it
+that complete the handshake, and reports resident memory and thread count as
+the connections pile up.
+
+Usage: python bench_connections.py [--engine {threads,asyncio}] [--connections N]
+"""
+
+import argparse
+import contextlib
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from client import Client
+from async_client import AsyncClient
+
+
+def rss_kb():
+    """Current resident set size of this process in KB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Peak rather than current, but good enough where /proc is missing
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def open_connection(port, peer_id):
+    """Connect to the client under test and complete the handshake as peer_id"""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(("P2PFILESHARINGPROJ" + "0" * 10 + peer_id).encode('utf-8'))
+    reply = b""
+    while len(reply) < 32:
+        chunk = sock.recv(32 - len(reply))
+        if not chunk:
+            raise ConnectionError(f"Connection for {peer_id} closed during handshake")
+        reply += chunk
+    return sock
+
+
+def wait_for_peers(client, count, timeout=30):
+    deadline = time.time() + timeout
+    while len(client.peers) < count and time.time() < deadline:
+        time.sleep(0.05)
+    return len(client.peers)
+
+
+def measure(args):
+    """Connect args.connections fake peers to a client in the current directory; returns (rows, baseline RSS, baseline threads)"""
+    with open("Common.cfg", "w") as f:
+        f.write("NumberOfPreferredNeighbors 2\nUnchokingInterval 3600\nOptimisticUnchokingInterval 3600\n")
+        f.write("FileName thefile\nFileSize 1048576\nPieceSize 16384\n")
+
+    client_class = AsyncClient if args.engine == "asyncio" else Client
+    checkpoints = sorted({max(1, args.connections * step // 4) for step in range(1, 5)})
+    sockets = []
+    rows = []
+
+    # The clients print a line per event; keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        client = client_class("Common.cfg", "127.0.0.1", args.port, "1001")
+        client.setup([])
+        time.sleep(0.3)  # The threaded engine binds its listener on a background thread
+        baseline_rss = rss_kb()
+        baseline_threads = threading.active_count()
+        start = time.perf_counter()
+
+        for i in range(args.connections):
+            sockets.append(open_connection(client.port, str(2000 + i)))
+            if i + 1 in checkpoints:
+                connected = wait_for_peers(client, i + 1)
+                rows.append((connected, rss_kb(), threading.active_count(), time.perf_counter() - start))
+
+        client.shutdown()
+        for sock in sockets:
+            sock.close()
+    return rows, baseline_rss, baseline_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory per peer connection for each engine")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="asyncio")
+    parser.add_argument("--connections", type=int, default=1000, help="Number of peer connections to open (at most 7999)")
+    parser.add_argument("--port", type=int, default=9400, help="First port to try for the client under test")
+    args = parser.parse_args()
+
+    # The client writes its logs and peer directory into the working directory; remove them afterwards
+    work_dir = tempfile.mkdtemp(prefix="bench_connections_")
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        rows, baseline_rss, baseline_threads = measure(args)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"Engine: {args.engine}")
+    print(f"Baseline: {baseline_rss} KB RSS, {baseline_threads} threads")
+    print(f"{'peers':>7} {'RSS KB':>9} {'KB/peer':>8} {'threads':>8} {'seconds':>8}")
+    for connected, rss, threads, elapsed in rows:
+        per_peer = (rss - baseline_rss) / connected if connected else 0
+        print(f"{connected:>7} {rss:>9} {per_peer:>8.1f} {threads:>8} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Seeder upload throughput benchmark.
+
+Serves every piece of a file over a loopback TCP connection the way a seeder
+answers requests (frame header, then the piece), once with os.sendfile and
+once with buffered reads, and reports throughput and CPU time for each.
+
+Usage: python bench_upload.py [--file-size BYTES] [--piece-size PIECE_SIZE] [--runs RUNS]
+"""
+
+import argparse
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+
+import codec
+from piece_store import PieceStore, HAS_SENDFILE
+
+
+def drain(sock, expected, done):
+    """Receive and discard expected bytes, then signal done"""
+    buffer = bytearray(1 << 20)
+    received = 0
+    while received < expected:
+        n = sock.recv_into(buffer)
+        if not n:
+            break
+        received += n
+    done.set()
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def upload_run(store, sender, receiver):
+    """Send every piece once; returns (wall seconds, CPU seconds)"""
+    expected = sum(codec.HEADER_SIZE + codec.BLOCK_HEADER_SIZE + store.piece_length(i)
+                   for i in range(store.num_pieces))
+    done = threading.Event()
+    reader = threading.Thread(target=drain, args=(receiver, expected, done), daemon=True)
+    reader.start()
+
+    start_cpu = cpu_seconds()
+    start = time.perf_counter()
+    for i in range(store.num_pieces):
+        header = (codec.encode_header(codec.PIECE, codec.BLOCK_HEADER_SIZE + store.piece_length(i))
+                  + codec.encode_block_header(i, 0))
+        store.send_piece(sender, i, header)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    reader.join()
+    return elapsed, cpu_seconds() - start_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sendfile and buffered piece uploads")
+    parser.add_argument("--file-size", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--runs", type=int, default=3, help="Best of this many runs is reported")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_upload_")
+    path = os.path.join(work_dir, "thefile")
+    with open(path, "wb") as f:
+        remaining = args.file_size
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+
+    modes = [("sendfile", True), ("buffered", False)] if HAS_SENDFILE else [("buffered", False)]
+    if not HAS_SENDFILE:
+        print("os.sendfile is not available on this platform; only the buffered path is measured")
+
+    print(f"File: {args.file_size} bytes, piece size {args.piece_size}")
+    print(f"{'mode':>9} {'MB/s':>9} {'pieces/s':>10} {'CPU s':>7}")
+    for name, use_sendfile in modes:
+        store = PieceStore([(path, args.file_size)], args.piece_size, use_sendfile=use_sendfile)
+        best = None
+        for _ in range(args.runs):
+            elapsed, cpu = upload_run(store, sender, receiver)
+            if best is None or elapsed < best[0]:
+                best = (elapsed, cpu)
+        store.close()
+        elapsed, cpu = best
+        print(f"{name:>9} {args.file_size / elapsed / 1e6:>9.1f} {store.num_pieces / elapsed:>10.0f} {cpu:>7.2f}")
+
+    sender.close()
+    receiver.close()
+    os.remove(path)
+    os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    main()
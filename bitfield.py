@@ -0,0 +1,104 @@
+"""
+Packed piece bitfield.
+
+Bit i is piece i, most significant bit of byte 0 first, which is also the
+layout sent in bitfield messages. Setting and testing a piece is O(1) and the
+number of pieces held is kept up to date on every change, so per-piece
+bookkeeping does not depend on the file size.
+"""
+
+# For every byte value, the bit offsets (0 = most significant) that are set
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256))
+
+
+class Bitfield:
+    def __init__(self, num_pieces, data=None):
+        self.num_pieces = num_pieces
+        num_bytes = (num_pieces + 7) // 8
+        if data is None:
+            self.bits = bytearray(num_bytes)
+            self._count = 0
+        else:
+            self.bits = bytearray(data[:num_bytes])
+            if len(self.bits) < num_bytes:
+                self.bits.extend(bytes(num_bytes - len(self.bits)))
+            # Spare bits in the last byte must stay clear so whole-field ops are exact
+            spare_bits = num_bytes * 8 - num_pieces
+            if spare_bits:
+                self.bits[-1] &= (0xFF << spare_bits) & 0xFF
+            self._count = bin(int.from_bytes(self.bits, "big")).count("1")
+
+    @classmethod
+    def full(cls, num_pieces):
+        """Bitfield with every piece set"""
+        return cls(num_pieces, b"\xff" * ((num_pieces + 7) // 8))
+
+    @classmethod
+    def from_bytes(cls, num_pieces, data):
+        """Bitfield from a packed bitfield message payload"""
+        return cls(num_pieces, data)
+
+    def __len__(self):
+        return self.num_pieces
+
+    def __str__(self):
+        return f"{self._count}/{self.num_pieces} pieces"
+
+    def has(self, index):
+        """Whether piece index is set"""
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def set(self, index):
+        """Set piece index; returns True if it was not already set"""
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if byte & mask:
+            return False
+        self.bits[index >> 3] = byte | mask
+        self._count += 1
+        return True
+
+    def clear(self, index):
+        """Clear piece index; returns True if it was set"""
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if not byte & mask:
+            return False
+        self.bits[index >> 3] = byte & ~mask
+        self._count -= 1
+        return True
+
+    def count(self):
+        """Number of pieces set"""
+        return self._count
+
+    def is_complete(self):
+        return self._count == self.num_pieces
+
+    def is_empty(self):
+        return self._count == 0
+
+    def to_bytes(self):
+        """Packed payload for a bitfield message"""
+        return bytes(self.bits)
+
+    def wanted_from(self, other):
+        """Bitfield of pieces other has and this one lacks (other AND NOT self)"""
+        mine = int.from_bytes(self.bits, "big")
+        theirs = int.from_bytes(other.bits, "big")
+        wanted = theirs & ~mine
+        return Bitfield(self.num_pieces, wanted.to_bytes(len(self.bits), "big"))
+
+    def wants_from(self, other):
+        """Whether other has at least one piece this one lacks"""
+        mine = int.from_bytes(self.bits, "big")
+        theirs = int.from_bytes(other.bits, "big")
+        return (theirs & ~mine) != 0
+
+    def pieces(self):
+        """Iterate over the indices of set pieces in increasing order"""
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                base = byte_index << 3
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
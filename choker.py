@@ -0,0 +1,74 @@
+"""
+Tit-for-tat choker.
+
+Every peer gets a RateMeter that counts the piece bytes received from it. Once
+per unchoking interval the meters are updated from a monotonic clock into an
+exponentially weighted moving average of bytes per second, so a rate reflects
+partial transfers and piece sizes, and one slow interval does not wipe out a
+peer's history.
+
+Choker.select ranks interested peers on those rates, with hysteresis: a peer
+that is already preferred keeps its slot unless a challenger is faster by more
+than the hysteresis margin. Near-equal peers therefore do not trade places
+every interval, which would cost a choke and an unchoke message each time and
+stall the requests in flight to the peer that was choked.
+"""
+
+import random
+import time
+
+DEFAULT_HALF_LIFE = 10.0  # Seconds for an old rate sample to lose half its weight
+DEFAULT_HYSTERESIS = 0.2  # A challenger must be this much faster to displace a preferred peer
+
+
+class RateMeter:
+    def __init__(self, half_life=DEFAULT_HALF_LIFE):
+        self.half_life = half_life
+        self.total_bytes = 0  # Only added to by the thread receiving from the peer
+        self.last_total = 0
+        self.last_update = time.monotonic()
+        self.rate = 0.0  # Bytes per second, as of the last update
+
+    def add(self, num_bytes):
+        self.total_bytes += num_bytes
+
+    def update(self, now=None):
+        """Fold the bytes received since the last update into the average; returns the new rate"""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.last_update
+        if elapsed <= 0:
+            return self.rate
+        total = self.total_bytes
+        sample = (total - self.last_total) / elapsed
+        # Weight by elapsed time, so late or early rounds do not skew the average
+        keep = 0.5 ** (elapsed / self.half_life) if self.half_life > 0 else 0.0
+        self.rate = self.rate * keep + sample * (1 - keep)
+        self.last_total = total
+        self.last_update = now
+        return self.rate
+
+
+class Choker:
+    def __init__(self, num_preferred, hysteresis=DEFAULT_HYSTERESIS):
+        self.num_preferred = num_preferred
+        self.hysteresis = hysteresis
+
+    def select(self, candidates, current, rate_of):
+        """Preferred peers among candidates, keeping members of current unless clearly outpaced"""
+        # Shuffle before the stable sort so peers with equal rates are ordered at random
+        ranked = list(candidates)
+        random.shuffle(ranked)
+        ranked.sort(key=rate_of, reverse=True)
+
+        selected = [p for p in ranked if p in current][:self.num_preferred]
+        for challenger in ranked:
+            if challenger in selected:
+                continue
+            if len(selected) < self.num_preferred:
+                selected.append(challenger)
+                continue
+            weakest = min(selected, key=rate_of)
+            if rate_of(challenger) <= rate_of(weakest) * (1 + self.hysteresis):
+                break  # The rest are slower still
+            selected[selected.index(weakest)] = challenger
+        return selected
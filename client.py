@@ -5,47 +5,77 @@ import time
 import os
 from logger import Logger
 from config import Config
-from shutil import copy2
 from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+import codec
+from codec import MESSAGE_TYPE_ENCODE
+from bitfield import Bitfield
+from request_window import RequestWindow
+from partial_piece import PartialPiece
+from piece_store import FLUSH_NONE, FLUSH_PERIODIC, FLUSH_POLICIES, PieceStore
+from file_link import link_file, link_tree
+from piece_picker import make_piece_picker
+from choker import Choker, RateMeter
+from scheduler import Scheduler
+from outbound import OutboundQueue
+from connection_manager import ConnectionManager
+from manifest import Manifest
+from resume import PART_SUFFIX, ResumeState, part_path, recover_bitfield, resume_path, sync_directory
+import event_trace
+from event_trace import EventTrace, NO_PIECE
+from metrics import MetricsRegistry, MetricsServer
 
+REQUEST_TIMEOUT = 10.0  # Seconds before an unanswered block request is given to another peer
+HASH_WORKERS = 4  # Threads verifying received pieces; hashlib releases the GIL on large buffers
+MAX_HASH_FAILURES = 3  # Corrupt pieces a peer may send before it is disconnected
+CONNECT_TIMEOUT = 3  # Seconds a dial may take before it counts as failed
+LISTEN_BACKLOG = 1024  # Large enough for a whole swarm dialing in at once
 
-
-MESSAGE_TYPE_ENCODE = {
-    "choke": "0",
-    "unchoke": "1",
-    "interested": "2",
-    "not interested": "3",
-    "have": "4",
-    "bitfield": "5",
-    "request": "6",
-    "piece": "7",
+# Messages that are traced when sent or received, and the event recorded for each
+SENT_TRACE_EVENTS = {
+    codec.CHOKE: event_trace.CHOKE_SENT,
+    codec.UNCHOKE: event_trace.UNCHOKE_SENT,
+    codec.REQUEST: event_trace.REQUEST_SENT,
+    codec.CANCEL: event_trace.CANCEL_SENT,
+}
+RECEIVED_TRACE_EVENTS = {
+    codec.CHOKE: event_trace.CHOKED_BY,
+    codec.UNCHOKE: event_trace.UNCHOKED_BY,
+    codec.PIECE: event_trace.PIECE_RECEIVED,
 }
 
+
 class Message:
-    def __init__(self, message_type, message_payload=""):
-        self.message_length = str(len(message_payload) + 1)  # +1 for the message type
+    def __init__(self, message_type, message_payload=b""):
+        self.message_length = len(message_payload) + 1  # +1 for the message type
         self.decoded_message_type = message_type
         self.encoded_message_type = MESSAGE_TYPE_ENCODE[message_type]
         self.message_payload = message_payload
 
-        # Ensure message_length is 4 bytes by padding with zeros
-        while len(self.message_length) < 4:
-            self.message_length = "0" + self.message_length
-
     def get_message(self):
-        return self.message_length + self.encoded_message_type + self.message_payload
+        # 4-byte big-endian length, 1-byte type, then the raw payload
+        return codec.encode_frame(self.encoded_message_type, self.message_payload)
 
 class Peer:
     # Will be used to store information on peers
-    def __init__(self, socket_number, ID, num_pieces):
+    def __init__(self, socket_number, ID, num_pieces, request_window, download_meter):
         self.socket = socket_number
         self.ID = ID
-        self.bitfield = "0" * num_pieces
+        self.bitfield = Bitfield(num_pieces)
         self.complete = False
-        self.interested = False
-        self.choked = True
-        self.last_download_rate = 0  # For preferred neighbor selection
-        self.pieces_downloaded = 0  # Track how many pieces downloaded from this peer
+        self.interested = False  # Peer is interested in our pieces
+        self.choked = True  # We are choking the peer
+        self.am_interested = False  # We are interested in the peer's pieces
+        self.choking_us = True  # Peer is choking us
+        self.requests = request_window  # Our outstanding requests to this peer
+        self.download_meter = download_meter  # Averaged byte rate from this peer, for preferred neighbor selection
+        self.hash_failures = 0  # Pieces from this peer that failed verification
+        self.outbound = OutboundQueue()  # Everything we send, drained by the peer's writer
+        self.dial_address = None  # (host, port) we dialed it at, so it can be redialed if the connection drops
+        # This peer's labelled metric children, cached by add_peer so updates skip the label lookup
+        self.download_counter = None
+        self.upload_counter = None
+        self.latency_histogram = None
 
 class Client:
     def __init__(self, config_filepath, host, port, ID="1001"):
@@ -56,32 +86,66 @@ class Client:
         self.unchoked_peers = []
         self.optimistically_unchoked_peer = None
         self.ID = ID
-        self.logger = Logger(ID)
         self.config = Config(config_filepath)
+        self.logger = Logger(ID, self.config.log_flush_interval, self.config.log_flush_bytes,
+                             self.config.log_queue_size, self.config.log_overflow)
         self.other_peers = []  # Will be used for establishing connections
         
         # Calculate the number of pieces based on file size and piece size
         self.num_pieces = ceil(self.config.file_size / self.config.piece_size)
         
-        self.bitfield = "0" * self.num_pieces
+        self.bitfield = Bitfield(self.num_pieces)
+        self.piece_picker = make_piece_picker(self.config.piece_selection, self.bitfield)
         
         # Create peer directory if it doesn't exist
         self.peer_directory = f"peer_{self.ID}"
         if not os.path.exists(self.peer_directory):
             os.makedirs(self.peer_directory)
+        # Directory the file (or share directory) is in; a seeder may serve it from where it was found
+        self.data_root = self.peer_directory
+        self.data_suffix = PART_SUFFIX  # Added to FileName until the download is complete and finalized
+        self.flush_policy = self.config.flush_policy
+        if self.flush_policy not in FLUSH_POLICIES:
+            print(f"Unknown FlushPolicy {self.flush_policy}, using {FLUSH_PERIODIC}")
+            self.flush_policy = FLUSH_PERIODIC
             
-        # Initialize file pieces as empty
-        self.file_pieces = [None] * self.num_pieces
-        self.pieces_requested = [False] * self.num_pieces
+        # Piece data lives only in the file on disk, reached through the piece store
+        self.pieces_requested = [False] * self.num_pieces  # True while the piece has an entry in partial_pieces
+        # Pieces are requested in blocks, so a piece can be fetched from several peers at once
+        self.block_size = (min(self.config.block_size, self.config.piece_size) if self.config.block_size > 0
+                           else self.config.piece_size)
+        self.partial_pieces = {}  # piece index -> PartialPiece, for pieces with blocks requested or stored
+        self.end_game = False  # Set once few enough pieces are left to request them from several peers
+        self.piece_store = None
+        self.resume_dirty = False  # Pieces were stored since the last resume checkpoint
+        self.pending_haves = []  # Stored pieces not announced yet, see queue_have
+        self.trace = None  # EventTrace, once start_trace is called
+        self.metrics_server = None  # MetricsServer, once start_metrics_server is called
+        self.scheduler = None  # Runs the choking rounds of the threaded engine, once setup is called
+        self.connections = None  # Dials and redials earlier peers for the threaded engine, once setup is called
+        self.banned_peers = set()  # IDs of peers disconnected for sending corrupt pieces
+        self.peer_history = {}  # peer ID -> (rate meter, hash failures) of a lost connection
+
+        # Piece hashes to check downloads against, if Common.cfg names a manifest
+        self.manifest = self.load_manifest()
+        self.verify_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS) if self.manifest else None
+        # Finalizing and checkpointing sync the file to disk; one worker runs them in order, off the network threads
+        self.disk_pool = ThreadPoolExecutor(max_workers=1)
         
         # For selecting preferred neighbors
         self.download_rates = {}
         self.interested_peers = []
+        self.choker = Choker(self.config.num_of_pref_neighbords, self.config.choke_hysteresis)
         
         # For thread synchronization
         self.peers_lock = threading.Lock()
         self.bitfield_lock = threading.Lock()
-        self.file_pieces_lock = threading.Lock()
+        self.piece_store_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.have_lock = threading.Lock()
+
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
         
         # For threading control
         self.running = True
@@ -96,10 +160,45 @@ class Client:
         print(f"  - Pieces: {self.num_pieces}")
         print(f"  - Peer directory: {self.peer_directory}")
         
-    def has_file(self):
-        """If this peer has the file, update its bitfield and read file into memory"""
+    def data_files(self, root=None):
+        """(path, size) of every file in the piece space: the share's files, or the single FileName"""
+        root = root or self.data_root
+        if self.config.share is not None:
+            return self.config.share.file_paths(root, self.config.file_name + self.data_suffix)
+        return [(os.path.join(root, self.config.file_name + self.data_suffix), self.config.file_size)]
+
+    def download_path(self):
+        """The file (or share directory) pieces are stored in: FileName, with .part until the download is finalized"""
+        return os.path.join(self.data_root, self.config.file_name + self.data_suffix)
+
+    def load_manifest(self):
+        """Load the ManifestFile from Common.cfg; returns None when pieces are not to be verified"""
+        if not self.config.manifest_file and self.config.share is not None:
+            manifest = self.config.share.manifest()
+            if manifest is None:
+                print(f"Share {self.config.share_file} has no piece hashes, received pieces will not be verified")
+            else:
+                print(f"Verifying pieces against {self.config.share_file} ({manifest.algorithm})")
+            return manifest
+        if not self.config.manifest_file:
+            print("No ManifestFile configured, received pieces will not be verified")
+            return None
+        try:
+            manifest = Manifest.load(self.config.manifest_file)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load manifest {self.config.manifest_file}, received pieces will not be verified: {e}")
+            return None
+        if not manifest.matches(self.config.file_size, self.config.piece_size):
+            print(f"Manifest {self.config.manifest_file} does not match FileSize/PieceSize, ignoring it")
+            return None
+        print(f"Verifying pieces against {self.config.manifest_file} ({manifest.algorithm})")
+        return manifest
+
+    def has_file(self, source_path=None):
+        """If this peer has the file, link it into the peer directory and mark every piece as present"""
+        self.data_suffix = ""  # A seeder's file is complete under its final name
         # Check for file in various possible locations
-        file_paths = [
+        file_paths = [source_path] if source_path else [
             os.path.join(self.peer_directory, self.config.file_name),
             os.path.join("project_config_file_small/project_config_file_small", self.ID, self.config.file_name),
             os.path.join("project_config_file_small", self.ID, self.config.file_name),
@@ -110,40 +209,184 @@ class Client:
         for path in file_paths:
             if os.path.exists(path):
                 print(f"Found file at: {path}")
+                root = os.path.dirname(path) or "."
+                if not self.check_file_sizes(root):
+                    break
                 file_found = True
-                # Read file into memory in pieces
-                with open(path, 'rb') as f:
-                    for i in range(self.num_pieces):
-                        try:
-                            f.seek(i * self.config.piece_size)
-                            piece_data = f.read(self.config.piece_size)
-                            print(f"PIECE {i}: {piece_data[:20]}")
-                            if piece_data:
-                                self.file_pieces[i] = piece_data
-                        except Exception as e:
-                            print(f"Error reading piece {i}: {e}")
-                
-                # Copy file to peer directory if it's not already there
-                if path != os.path.join(self.peer_directory, self.config.file_name):
+
+                # Link file into peer directory if it's not already there; no bytes are copied either way
+                dest = os.path.join(self.peer_directory, self.config.file_name)
+                if not (os.path.exists(dest) and os.path.samefile(path, dest)):
                     os.makedirs(self.peer_directory, exist_ok=True)
-                    copy2(path, os.path.join(self.peer_directory, self.config.file_name))
-                    print(f"Copied file to peer directory: {self.peer_directory}")
+                    linked = link_tree(path, dest) if os.path.isdir(path) else link_file(path, dest) is not None
+                    if linked:
+                        print(f"Linked file into peer directory: {self.peer_directory}")
+                    else:
+                        self.data_root = root
+                        print(f"Serving file from {root} instead of copying it")
                 
                 # Update bitfield
-                self.bitfield = "1" * self.num_pieces
+                self.bitfield = Bitfield.full(self.num_pieces)
                 break
         
         if not file_found:
             print(f"Warning: File {self.config.file_name} not found in any expected locations!")
-            self.bitfield = "0" * self.num_pieces
+            self.bitfield = Bitfield(self.num_pieces)
+            self.data_suffix = PART_SUFFIX
+
+        # The picker tracks the pieces the new bitfield is missing
+        self.piece_picker = make_piece_picker(self.config.piece_selection, self.bitfield)
+
+    def check_file_sizes(self, root):
+        """Check with stat alone that the file(s) under root have the configured sizes"""
+        for path, size in self.data_files(root):
+            try:
+                actual_size = os.stat(path).st_size
+            except OSError as e:
+                print(f"Warning: Cannot stat {path}: {e}")
+                return False
+            if actual_size != size:
+                print(f"Warning: {path} has {actual_size} bytes, expected {size}")
+                return False
+        return True
             
+    def start_trace(self, path):
+        """Record a binary event trace of this run to path"""
+        self.trace = EventTrace(path, self.ID)
+        print(f"Tracing events to {path}")
+
+    def trace_event(self, event_type, peer=None, piece_index=NO_PIECE, num_bytes=0):
+        if self.trace is not None:
+            peer_id = event_trace.peer_number(peer.ID) if peer is not None else 0
+            self.trace.record(event_type, peer_id, piece_index, num_bytes)
+
+    def trace_message(self, events, peer, mtype, payload):
+        """Trace a sent or received message if its type is one we record"""
+        event_type = events.get(mtype)
+        if event_type is None:
+            return
+        piece_index = codec.decode_index(payload) if len(payload) >= codec.PIECE_INDEX_SIZE else NO_PIECE
+        num_bytes = len(payload) - codec.BLOCK_HEADER_SIZE if mtype == codec.PIECE else 0
+        self.trace_event(event_type, peer, piece_index, num_bytes)
+
+    def setup_metrics(self):
+        """Register the counters and histograms updated while transferring, and the gauges read at scrape time"""
+        m = self.metrics
+        self.bytes_downloaded_metric = m.counter("p2p_downloaded_bytes_total", "Piece bytes received", ("peer",))
+        self.bytes_uploaded_metric = m.counter("p2p_uploaded_bytes_total", "Piece bytes sent", ("peer",))
+        self.latency_metric = m.histogram("p2p_request_latency_seconds", "Time from block request to block", ("peer",))
+        self.pieces_stored_metric = m.counter("p2p_pieces_stored_total", "Pieces written to the file")
+        m.rate("p2p_pieces_per_second", "Pieces stored per second", self.pieces_stored_metric.labels())
+        self.hash_failures_metric = m.counter("p2p_hash_failures_total", "Received pieces that failed verification")
+        self.have_frames_metric = m.counter("p2p_have_frames_sent_total", "Have, multi have and completion bitfield frames sent")
+        self.haves_suppressed_metric = m.counter("p2p_haves_suppressed_total",
+                                                 "Piece announcements skipped because the peer already had the piece")
+        self.request_timeouts_metric = m.counter("p2p_request_timeouts_total", "Piece requests that timed out")
+        self.flush_latency_metric = m.histogram("p2p_store_flush_seconds", "Time to flush (or sync) stored pieces to disk")
+        self.flushed_bytes_metric = m.counter("p2p_store_flushed_bytes_total", "Bytes of stored pieces flushed to disk")
+
+        m.gauge_callback("p2p_connected_peers", "Connected peers", lambda: [((), len(self.peers))])
+        m.gauge_callback("p2p_interested_peers", "Peers interested in our pieces",
+                         lambda: [((), sum(1 for peer in list(self.peers) if peer.interested))])
+        m.gauge_callback("p2p_pieces_have", "Pieces held",
+                         lambda: [((), self.bitfield.count())])
+        m.gauge_callback("p2p_download_rate_bytes", "Averaged download rate used for choking",
+                         lambda: [((peer.ID,), peer.download_meter.rate) for peer in list(self.peers)], ("peer",))
+        m.gauge_callback("p2p_outstanding_requests", "Block requests waiting for an answer",
+                         lambda: [((peer.ID,), peer.requests.pending()) for peer in list(self.peers)], ("peer",))
+        m.gauge_callback("p2p_outbound_queued", "Control frames and blocks waiting in a peer's outbound queue",
+                         self.outbound_samples, ("peer", "kind"))
+        m.gauge_callback("p2p_dial_targets", "Earlier peers we dial, by state (waiting, dialing, connected)",
+                         lambda: list(((state,), n) for state, n in self.connections.counts().items())
+                         if self.connections else [], ("state",))
+        m.gauge_callback("p2p_log_queue_depth", "Log lines waiting for the writer thread",
+                         lambda: [((), self.logger.queue.qsize())])
+        m.gauge_callback("p2p_peer_state", "Choke and interest flags per peer (1 = set)",
+                         self.peer_state_samples, ("peer", "flag"))
+
+    def outbound_samples(self):
+        samples = []
+        for peer in list(self.peers):
+            control, blocks = peer.outbound.pending()
+            samples.append(((peer.ID, "control"), control))
+            samples.append(((peer.ID, "block"), blocks))
+        return samples
+
+    def peer_state_samples(self):
+        samples = []
+        for peer in list(self.peers):
+            for flag in ("choked", "choking_us", "interested", "am_interested"):
+                samples.append(((peer.ID, flag), int(getattr(peer, flag))))
+        return samples
+
+    def start_metrics_server(self, port):
+        """Serve live metrics on 127.0.0.1:port"""
+        self.metrics_server = MetricsServer(self.metrics, port)
+        self.metrics_server.start()
+
+    def resume_download(self):
+        """Pick up a partial download left in the peer directory by an earlier run"""
+        final_path = os.path.join(self.peer_directory, self.config.file_name)
+        if os.path.exists(final_path):
+            # Finished by an earlier run (or started before downloads went to .part files)
+            self.data_suffix = ""
+        elif not os.path.exists(part_path(final_path)):
+            return
+
+        file_path = self.download_path()
+        bitfield, source = recover_bitfield(file_path, self.config.file_size, self.config.piece_size,
+                                            self.num_pieces, self.manifest, self.data_files())
+        print(f"Resuming download with {bitfield} from {source}")
+        with self.bitfield_lock:
+            self.bitfield = bitfield
+            self.piece_picker = make_piece_picker(self.config.piece_selection, self.bitfield)
+
+        if self.data_suffix and bitfield.is_complete():
+            # The last run stored every piece but stopped before renaming the file
+            self.finalize_download()
+
+    def checkpoint_resume_state(self):
+        """Flush stored pieces (with FlushPolicy periodic) and record them in the resume state file"""
+        with self.checkpoint_lock:
+            with self.bitfield_lock:
+                if not self.resume_dirty:
+                    return
+                self.resume_dirty = False
+                bitfield = Bitfield.from_bytes(self.num_pieces, self.bitfield.to_bytes())
+
+            try:
+                # Every piece in the snapshot was written before its bit was set; flushing makes it durable.
+                # Unflushed pieces survive a crash of this process in the page cache, but not a power loss
+                if self.flush_policy == FLUSH_PERIODIC:
+                    self.flush_store()
+                file_path = self.download_path()
+                state = ResumeState.capture(self.data_files(), self.config.file_size, self.config.piece_size, bitfield)
+                state.save(resume_path(file_path))
+                print(f"Saved resume state with {bitfield}")
+            except OSError as e:
+                print(f"Error saving resume state: {e}")
+
+    def checkpoint_resume_state_loop(self):
+        """Periodically save the resume state"""
+        while self.running:
+            time.sleep(self.config.resume_interval)
+            self.checkpoint_resume_state()
+
     def setup(self, other_peers):
         """Initialize server socket and connect to existing peers"""
-        # Start preferred neighbors selection thread
-        threading.Thread(target=self.select_preferred_neighbors, daemon=True).start()
-        
-        # Start optimistically unchoked neighbor selection thread
-        threading.Thread(target=self.select_optimistically_unchoked_neighbor, daemon=True).start()
+        # Choking rounds run as timed tasks on one scheduler thread
+        self.scheduler = Scheduler()
+        self.scheduler.call_every(self.config.unchoking_interval, self.preferred_neighbors_task)
+        self.scheduler.call_every(self.config.optimistic_unchoking_interval, self.run_optimistic_unchoke_round)
+        self.scheduler.start()
+
+        # A fixed pool of dialer threads reaches earlier peers, retrying with backoff and redialing dropped ones
+        self.connections = ConnectionManager(self.open_connection, self.start_initiated_connection,
+                                             self.config.max_concurrent_dials, self.config.dial_backoff_max)
+        self.connections.start()
+
+        # Start resume state checkpoint thread
+        threading.Thread(target=self.checkpoint_resume_state_loop, daemon=True).start()
         
         # Start server socket to listen for incoming connections
         threading.Thread(target=self.listen_for_connections, daemon=True).start()
@@ -166,7 +409,7 @@ class Client:
                 self.port += 1
 
         # Always listen on localhost regardless of configured host
-        self.s.listen(10)
+        self.s.listen(LISTEN_BACKLOG)
         print(f"Listening on {listen_host}:{self.port} (configured host was {self.host})")
 
         while self.running:
@@ -179,29 +422,41 @@ class Client:
         if self.s:
             self.s.close()
 
-    def try_connect(self, peer_info, delay):
-        time.sleep(delay)
-        if not self.running:
-            return
-        try:
-            host = "127.0.0.1" if peer_info[0] not in ["localhost", "127.0.0.1"] else peer_info[0]
-            port = int(peer_info[1])
-            print(f"Retrying connection to {host}:{port}")
+    def open_connection(self, address):
+        """Dial a peer; runs on a dialer thread of the connection manager, which retries if this raises"""
+        host = "127.0.0.1" if address[0] not in ["localhost", "127.0.0.1"] else address[0]
+        port = int(address[1])
+        print(f"Connecting to {host}:{port}")
 
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.settimeout(3)
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer_socket.settimeout(CONNECT_TIMEOUT)
+        try:
             peer_socket.connect((host, port))
+        except OSError:
+            peer_socket.close()
+            raise
+        return peer_socket
+
+    def start_initiated_connection(self, address, peer_socket):
+        """Handshake on a dialed socket and then receive from it, on a thread of its own"""
+        threading.Thread(target=self.setup_connection_from_initiating,
+                         args=(peer_socket, address), daemon=True).start()
 
-            threading.Thread(target=self.setup_connection_from_initiating,
-                             args=(peer_socket, host), daemon=True).start()
-        except (socket.error, ConnectionRefusedError) as e:
-            threading.Thread(target=self.try_connect, args=(peer_info, delay), daemon=True).start()
-            print(f"try failed: {e}")
-                
     def initiate_connections(self, other_peers):
         """Reach out to other peers"""
+        # All at once; the dialer pool probes peers that are not listening yet until they are
         for peer in other_peers:
-            self.try_connect(peer, 5)
+            self.connections.add(peer)
+
+    def redial(self, address):
+        """Dial a peer we lost the connection to again, after a backoff"""
+        if self.connections is not None:
+            self.connections.lost(address)
+
+    def stop_dialing(self, address):
+        """Give up on a peer for good"""
+        if self.connections is not None:
+            self.connections.forget(address)
 
 
     def setup_connection_from_listening(self, peer_socket):
@@ -231,6 +486,11 @@ class Client:
                 print(f"Peer {peer_id} is already connected, closing connection")
                 peer_socket.close()
                 return
+
+            if peer_id in self.banned_peers:
+                print(f"Peer {peer_id} is banned, closing connection")
+                peer_socket.close()
+                return
             
             # Reciprocal handshake is then sent
             reciprocal_handshake = self.create_handshake()
@@ -238,20 +498,7 @@ class Client:
             print(f"Sent reciprocal handshake to peer {peer_id}")
             
             # Add new connection to list of peers
-            peer = Peer(peer_socket, peer_id, self.num_pieces)
-            with self.peers_lock:
-                self.peers.append(peer)
-                print(peer.ID, "IS CONNECTED")
-            
-            # Log connection
-            self.logger.log_tcp_connection(peer.ID, False)
-            
-            # Send bitfield to peer if we have any pieces
-            if self.bitfield != "0" * self.num_pieces:
-                bitfield_message = self.make_bitfield_message(self.bitfield)
-                encoded_message = bitfield_message.get_message().encode('utf-8')
-                peer_socket.sendall(encoded_message)
-                print(f"Sent bitfield to peer {peer_id}")
+            peer = self.add_peer(peer_socket, peer_id, False)
             
             # Start receiving messages from this peer
             peer_socket.settimeout(None)  # Remove timeout for normal operation
@@ -276,6 +523,7 @@ class Client:
             if not handshake_message:
                 print("Empty handshake received, closing connection")
                 peer_socket.close()
+                self.redial(peer_address)
                 return
                 
             print(f"Received handshake: {handshake_message}")
@@ -284,25 +532,22 @@ class Client:
             if not self.check_handshake(handshake_message):
                 print(f"Handshake is invalid: {handshake_message}")
                 peer_socket.close()
+                self.redial(peer_address)
                 return
                 
             # Extract peer ID from handshake
             peer_id = handshake_message[-4:]
+
+            if peer_id in self.banned_peers:
+                print(f"Peer {peer_id} is banned, closing connection")
+                peer_socket.close()
+                self.stop_dialing(peer_address)
+                return
             
             # Add new connection to list of peers
-            peer = Peer(peer_socket, peer_id, self.num_pieces)
-            with self.peers_lock:
-                self.peers.append(peer)
-            
-            # Log the connection
-            self.logger.log_tcp_connection(peer.ID, True)
-            
-            # Send bitfield to peer if we have any pieces
-            if self.bitfield != "0" * self.num_pieces:
-                bitfield_message = self.make_bitfield_message(self.bitfield)
-                encoded_message = bitfield_message.get_message().encode('utf-8')
-                peer_socket.sendall(encoded_message)
-                print(f"Sent bitfield to peer {peer_id}")
+            peer = self.add_peer(peer_socket, peer_id, True, peer_address)
+            if self.connections is not None:
+                self.connections.connected(peer_address)
             
             # Start receiving messages from this peer
             peer_socket.settimeout(None)  # Remove timeout for normal operation
@@ -311,168 +556,74 @@ class Client:
         except Exception as e:
             print(f"Error in setup_connection_from_initiating: {e}")
             peer_socket.close()
+            self.redial(peer_address)
             
+    def add_peer(self, connection, peer_id, self_initiated, dial_address=None):
+        """Register a peer after a valid handshake and send it our bitfield"""
+        peer = Peer(connection, peer_id, self.num_pieces, self.make_request_window(),
+                    RateMeter(self.config.rate_half_life))
+        peer.dial_address = dial_address
+        # A reconnecting peer picks up where its last connection left off
+        history = self.peer_history.pop(peer_id, None)
+        if history is not None:
+            peer.download_meter, peer.hash_failures = history
+            print(f"Peer {peer_id} reconnected, restored its rate and {peer.hash_failures} hash failures")
+        peer.download_counter = self.bytes_downloaded_metric.labels(peer.ID)
+        peer.upload_counter = self.bytes_uploaded_metric.labels(peer.ID)
+        peer.latency_histogram = self.latency_metric.labels(peer.ID)
+        self.start_writer(peer)
+        with self.peers_lock:
+            self.peers.append(peer)
+            print(peer.ID, "IS CONNECTED")
+        
+        # Log connection
+        self.logger.log_tcp_connection(peer.ID, self_initiated)
+        self.trace_event(event_trace.CONNECT, peer)
+        
+        # Send bitfield to peer if we have any pieces
+        if not self.bitfield.is_empty():
+            bitfield_message = self.make_bitfield_message(self.bitfield)
+            self.send_message(peer, bitfield_message)
+            print(f"Sent bitfield to peer {peer_id}")
+        return peer
+
+    def start_writer(self, peer):
+        """Start the thread that sends everything queued for the peer"""
+        # Writes are whole frames or a header plus sendfile with MSG_MORE, so Nagle only adds delay
+        peer.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self.write_to_peer, args=(peer,), daemon=True).start()
+
+    def write_to_peer(self, peer):
+        """Drain the peer's outbound queue into its socket until the queue is closed"""
+        while True:
+            item = peer.outbound.wait()
+            if item is None:
+                break
+            frames, block = item
+            try:
+                if frames is not None:
+                    peer.socket.sendall(frames)
+                else:
+                    self.write_block(peer, block)
+            except Exception as e:
+                # The receive thread sees the broken connection and removes the peer
+                print(f"Error sending to peer {peer.ID}: {e}")
+                break
+
     def receive_from_peer(self, peer):
         """Process messages from a peer"""
         while self.running:
             try:
-                # First receive the message length (4 bytes)
-                mlength_bytes = peer.socket.recv(4)
-                if not mlength_bytes:
+                frame = codec.read_frame(peer.socket)
+                if frame is None:
                     print(f"Connection with peer {peer.ID} closed")
                     break
-                    
-                mlength = mlength_bytes.decode('utf-8')
-                if not mlength.isdigit():
-                    print(f"Invalid message length: {mlength}")
-                    continue
-                    
-                mlength = int(mlength)
-                
-                # Then receive message type (1 byte)
-                mtype_bytes = peer.socket.recv(1)
-                if not mtype_bytes:
-                    break
-                    
-                mtype = mtype_bytes.decode('utf-8')
+
+                mtype, payload = frame
                 print(f"Received message type {mtype} from peer {peer.ID}")
                 
-                # Process message based on type
-                if mtype == "0":
-                    # Choked by peer
-                    self.logger.log_choked(peer.ID)
-                    peer.choked = True
-                    print(f"Choked by peer {peer.ID}")
-                    
-                elif mtype == "1":
-                    # Unchoked by peer
-                    self.logger.log_unchoked(peer.ID)
-                    peer.choked = False
-                    print(f"Unchoked by peer {peer.ID}")
-                    
-                    # Request a piece if we're interested
-                    if peer.interested:
-                        self.request_piece(peer)
-                        
-                elif mtype == "2":
-                    # Peer is interested in pieces
-                    self.logger.log_interested_message(peer.ID)
-                    peer.interested = True
-                    print(f"Peer {peer.ID} is interested in our pieces")
-                    
-                    # Add to interested peers list
-                    if peer not in self.interested_peers:
-                        self.interested_peers.append(peer)
-                        
-                elif mtype == "3":
-                    # Peer is not interested in any pieces
-                    self.logger.log_not_interested_message(peer.ID)
-                    peer.interested = False
-                    print(f"Peer {peer.ID} is not interested in our pieces")
-                    
-                    # Remove from interested peers list
-                    if peer in self.interested_peers:
-                        self.interested_peers.remove(peer)
-                        
-                elif mtype == "4":
-                    # Peer has certain piece
-                    if mlength > 1:  # Must have payload
-                        piece_id_bytes = peer.socket.recv(mlength - 1)
-                        if not piece_id_bytes:
-                            break
-                            
-                        piece_id = int(piece_id_bytes.decode('utf-8'))
-                        print(f"Peer {peer.ID} has piece {piece_id}")
-                        
-                        # Update log and stored bitfield for that peer
-                        self.logger.log_have_message(peer.ID, str(piece_id))
-                        
-                        # Update peer's bitfield
-                        temp_bitfield = list(peer.bitfield)
-                        if piece_id < len(temp_bitfield):
-                            temp_bitfield[piece_id] = '1'
-                            peer.bitfield = ''.join(temp_bitfield)
-                        
-                        # Check if we need this piece
-                        with self.bitfield_lock:
-                            if piece_id < len(self.bitfield) and self.bitfield[piece_id] == '0':
-                                # Send interested message if we need this piece
-                                interested_message = self.make_interested_message()
-                                peer.socket.sendall(interested_message.get_message().encode('utf-8'))
-                                peer.interested = True
-                                print(f"Sent interested message to peer {peer.ID} for piece {piece_id}")
-                                
-                elif mtype == "5":
-                    # Receiving bitfield of peer
-                    if mlength > 1:  # Must have payload
-                        bitfield_bytes = peer.socket.recv(mlength - 1)
-                        if not bitfield_bytes:
-                            break
-                            
-                        peer.bitfield = bitfield_bytes.decode('utf-8')
-                        print(f"Received bitfield from peer {peer.ID}: {peer.bitfield}")
-                        
-                        # Check if they have any pieces we need
-                        needs_pieces = False
-                        with self.bitfield_lock:
-                            for i in range(min(len(self.bitfield), len(peer.bitfield))):
-                                if self.bitfield[i] == '0' and peer.bitfield[i] == '1':
-                                    needs_pieces = True
-                                    break
-                                    
-                        if needs_pieces:
-                            # Send interested message
-                            interested_message = self.make_interested_message()
-                            peer.socket.sendall(interested_message.get_message().encode('utf-8'))
-                            peer.interested = True
-                            print(f"Sent interested message to peer {peer.ID}")
-                        else:
-                            # Send not interested message
-                            not_interested_message = self.make_not_interested_message()
-                            peer.socket.sendall(not_interested_message.get_message().encode('utf-8'))
-                            peer.interested = False
-                            print(f"Sent not interested message to peer {peer.ID}")
-
-                elif mtype == "6":
-                    # A piece has been requested
-                    if mlength > 1:  # Must have payload
-                        piece_id_bytes = peer.socket.recv(mlength - 1)
-                        if not piece_id_bytes:
-                            break
-                            
-                        piece_id = int(piece_id_bytes.decode('utf-8'))
-                        print(f"Peer {peer.ID} requested piece {piece_id}")
-                        if piece_id > self.num_pieces - 1:
-                            print(f"Invalid piece ID received: {piece_id}")
-                            continue
-
-                        # Only send if peer is unchoked and we have the piece
-                        if ((peer in self.unchoked_peers or peer == self.optimistically_unchoked_peer)
-                            and piece_id < len(self.bitfield) and self.bitfield[piece_id] == '1'):
-
-                            with self.file_pieces_lock:
-                                piece_content = self.file_pieces[piece_id]
-                                if piece_content:
-                                    try:
-                                        peer.socket.sendall(piece_content)
-                                        print(f"PIECE {piece_id} SENT: {piece_content[:10]}")
-                                        print(f"Sent piece {piece_id} to peer {peer.ID}")
-                                    except Exception as e:
-                                        print(f"Error sending piece {piece_id} to peer {peer.ID}: {e}")
-                        else:
-                            print(f"Cannot send piece {piece_id} - not authorized")
-
-
-                elif mtype == "7":
-                    # Since we're ignoring the message format for piece data, this block is now empty
-                    # All actual piece data is received directly after sending a request
-                    pass
-                else:
-                    print(f"Unknown message type {mtype} from peer {peer.ID}")
-                    # Skip the payload
-                    if mlength > 1:
-                        peer.socket.recv(mlength - 1)
-                            
+                self.handle_message(peer, mtype, payload)
+                
             except Exception as e:
                 print(f"Error receiving from peer {peer.ID}: {e}")
                 break
@@ -480,142 +631,285 @@ class Client:
         # Connection ended, clean up
         self.remove_peer(peer)
 
-    def select_preferred_neighbors(self):
-        """Periodically select preferred neighbors"""
-        while self.running:
-            # Sleep for unchoking interval
-            print(f"Sleeping for {self.config.unchoking_interval} seconds before selecting preferred neighbors")
-            time.sleep(self.config.unchoking_interval)
+    def handle_message(self, peer, mtype, payload):
+        """Act on one decoded message from a peer"""
+        if self.trace is not None:
+            self.trace_message(RECEIVED_TRACE_EVENTS, peer, mtype, payload)
+
+        # Process message based on type
+        if mtype == codec.CHOKE:
+            # Choked by peer, which discards whatever we had requested from it
+            self.logger.log_choked(peer.ID)
+            peer.choking_us = True
+            self.release_requests(peer.requests.clear())
+            print(f"Choked by peer {peer.ID}")
             
-            with self.peers_lock:
-                if not self.peers:
-                    print("No peers connected, skipping preferred neighbor selection")
-                    continue
+        elif mtype == codec.UNCHOKE:
+            # Unchoked by peer
+            self.logger.log_unchoked(peer.ID)
+            peer.choking_us = False
+            print(f"Unchoked by peer {peer.ID}")
+            
+            # Fill the request window if we're interested
+            if peer.am_interested:
+                self.request_pieces(peer)
                 
-                print(f"Selecting preferred neighbors from {len(self.peers)} connected peers")
-                    
-                # Calculate download rates for each peer
-                for peer in self.peers:
-                    peer.last_download_rate = peer.pieces_downloaded
-                    print(f"Peer {peer.ID} download rate: {peer.last_download_rate} pieces and is intereseted?: {peer.interested}")
-                    peer.pieces_downloaded = 0  # Reset for next interval
-                    
-                # Get interested peers
-                candidates = [p for p in self.peers if p.interested]
-                print(f"Found {len(candidates)} interested peers")
+        elif mtype == codec.INTERESTED:
+            # Peer is interested in pieces
+            self.logger.log_interested_message(peer.ID)
+            peer.interested = True
+            print(f"Peer {peer.ID} is interested in our pieces")
+            
+            # Add to interested peers list
+            if peer not in self.interested_peers:
+                self.interested_peers.append(peer)
                 
-                if not candidates:
-                    print("No interested peers, skipping preferred neighbor selection")
-                    continue
-                    
-                # If we have the complete file, select randomly
-                if self.bitfield.count('1') == self.num_pieces:
-                    print("We have complete file, selecting neighbors randomly")
-                    # Random selection from interested peers
-                    selected_peers = random.sample(candidates, 
-                                                min(self.config.num_of_pref_neighbords, len(candidates)))
-                else:
-                    print("Selecting neighbors based on download rates")
-                    # Select based on download rates
-                    sorted_peers = sorted(candidates, key=lambda p: p.last_download_rate, reverse=True)
-                    selected_peers = sorted_peers[:min(self.config.num_of_pref_neighbords, len(sorted_peers))]
+        elif mtype == codec.NOT_INTERESTED:
+            # Peer is not interested in any pieces
+            self.logger.log_not_interested_message(peer.ID)
+            peer.interested = False
+            print(f"Peer {peer.ID} is not interested in our pieces")
+            
+            # Remove from interested peers list
+            if peer in self.interested_peers:
+                self.interested_peers.remove(peer)
                 
-                print(f"Selected {len(selected_peers)} preferred neighbors")
-                    
-                # Unchoke selected peers
-                new_unchoked = selected_peers.copy()
+        elif mtype in (codec.HAVE, codec.MULTI_HAVE):
+            # Peer has one piece (have) or several (multi have)
+            piece_ids = [i for i in codec.decode_indices(payload) if i < self.num_pieces]
+            if piece_ids:
+                self.handle_haves(peer, piece_ids)
+                        
+        elif mtype == codec.BITFIELD:
+            # Receiving bitfield of peer
+            if payload:  # Must have payload
+                bitfield = Bitfield.from_bytes(self.num_pieces, payload)
+                print(f"Received bitfield from peer {peer.ID}: {bitfield}")
                 
-                # Don't disturb optimistically unchoked peer
-                if self.optimistically_unchoked_peer and self.optimistically_unchoked_peer not in new_unchoked:
-                    new_unchoked.append(self.optimistically_unchoked_peer)
-                    print(f"Added optimistically unchoked peer {self.optimistically_unchoked_peer.ID} to the unchoked list")
-                    
-                # Handle peers that need to be choked
-                for peer in self.unchoked_peers:
-                    if peer not in new_unchoked and peer != self.optimistically_unchoked_peer and not peer.choked:
-                        print(f"Choking peer {peer.ID}")
-                        choke_message = self.make_choke_message()
-                        peer.choked = True
-                        try:
-                            peer.socket.sendall(choke_message.get_message().encode('utf-8'))
-                            print(f"Sent choke message to peer {peer.ID}")
-                        except Exception as e:
-                            print(f"Failed to send choke message to peer {peer.ID}: {e}")
+                # Check if they have any pieces we need
+                with self.bitfield_lock:
+                    self.piece_picker.remove_peer_bitfield(peer.bitfield)
+                    peer.bitfield = bitfield
+                    self.piece_picker.add_peer_bitfield(peer.bitfield)
+                    needs_pieces = self.bitfield.wants_from(peer.bitfield)
                             
-                # Handle peers that need to be unchoked
-                for peer in new_unchoked:
-                    if peer not in self.unchoked_peers and peer.choked:
-                        print(f"Unchoking peer {peer.ID}")
-                        unchoke_message = self.make_unchoke_message()
-                        try:
-                            peer.socket.sendall(unchoke_message.get_message().encode('utf-8'))
-                            peer.choked = False
-                            print(f"Sent unchoke message to peer {peer.ID}")
-                        except Exception as e:
-                            print(f"Failed to send unchoke message to peer {peer.ID}: {e}")
-                            
-                # Update unchoked peers list
-                self.unchoked_peers = [p for p in new_unchoked if p != self.optimistically_unchoked_peer]
-                
-                # Log preferred neighbors change
-                pref_ids = [peer.ID for peer in self.unchoked_peers]
-                print(f"New preferred neighbors: {pref_ids}")
-                self.logger.log_change_in_pref_neighbors(pref_ids)
+                if needs_pieces:
+                    # Send interested message
+                    interested_message = self.make_interested_message()
+                    self.send_message(peer, interested_message)
+                    peer.am_interested = True
+                    print(f"Sent interested message to peer {peer.ID}")
+                else:
+                    # Send not interested message
+                    not_interested_message = self.make_not_interested_message()
+                    self.send_message(peer, not_interested_message)
+                    peer.am_interested = False
+                    print(f"Sent not interested message to peer {peer.ID}")
 
-    def select_optimistically_unchoked_neighbor(self):
-        """Periodically select an optimistically unchoked neighbor"""
-        while self.running:
-            # Sleep for optimistic unchoking interval
-            print(f"Sleeping for {self.config.optimistic_unchoking_interval} seconds before selecting optimistically unchoked neighbor")
-            time.sleep(self.config.optimistic_unchoking_interval)
+        elif mtype == codec.REQUEST:
+            # A block of a piece has been requested
+            if len(payload) >= codec.BLOCK_REQUEST_SIZE:  # Must have payload
+                piece_id, begin, length = codec.decode_block_request(payload)
+                print(f"Peer {peer.ID} requested piece {piece_id} block {begin}+{length}")
+                if piece_id > self.num_pieces - 1 or length == 0 or begin + length > self.piece_length(piece_id):
+                    print(f"Invalid block requested: piece {piece_id} block {begin}+{length}")
+                    return
+
+                # Only send if peer is unchoked and we have the piece
+                if ((peer in self.unchoked_peers or peer == self.optimistically_unchoked_peer)
+                    and self.bitfield.has(piece_id)):
+                    self.send_block(peer, (piece_id, begin, length))
+                    print(f"Queued piece {piece_id} block {begin}+{length} for peer {peer.ID}")
+                else:
+                    print(f"Cannot send piece {piece_id} - not authorized")
+
+
+        elif mtype == codec.PIECE:
+            # Block data: 4-byte index and 4-byte offset in the piece, followed by the content
+            if len(payload) >= codec.BLOCK_HEADER_SIZE:
+                piece_id, begin = codec.decode_block_header(payload)
+                block_content = memoryview(payload)[codec.BLOCK_HEADER_SIZE:]
+                self.handle_block(peer, piece_id, begin, block_content)
+
+        elif mtype == codec.CANCEL:
+            # Drop the block if it is still waiting in the peer's queue
+            if len(payload) >= codec.BLOCK_REQUEST_SIZE:
+                block = codec.decode_block_request(payload)
+                if peer.outbound.cancel_block(block):
+                    print(f"Peer {peer.ID} cancelled its request for block {block}, dropped it from the queue")
+                else:
+                    print(f"Peer {peer.ID} cancelled its request for block {block}, already sent")
+        else:
+            # The frame length already told us how much to skip
+            print(f"Unknown message type {mtype} from peer {peer.ID}")
+
+    def handle_haves(self, peer, piece_ids):
+        """Record pieces a peer announced and become interested if we need any of them"""
+        print(f"Peer {peer.ID} has pieces {piece_ids}")
+        for piece_id in piece_ids:
+            # Update log for every announced piece
+            self.logger.log_have_message(peer.ID, str(piece_id))
+            self.trace_event(event_trace.HAVE_RECEIVED, peer, piece_id)
+
+        # Check if we need any of these pieces
+        with self.bitfield_lock:
+            # Update peer's bitfield and the pieces' availability
+            for piece_id in piece_ids:
+                if peer.bitfield.set(piece_id):
+                    self.piece_picker.add_have(piece_id)
+            needs_piece = any(not self.bitfield.has(piece_id) for piece_id in piece_ids)
+        if needs_piece:
+            if not peer.am_interested:
+                # Send interested message if we need a piece
+                interested_message = self.make_interested_message()
+                self.send_message(peer, interested_message)
+                peer.am_interested = True
+                print(f"Sent interested message to peer {peer.ID} for pieces {piece_ids}")
+            elif not peer.choking_us:
+                # New pieces available on an open link, top up the window
+                self.request_pieces(peer)
+
+    def preferred_neighbors_task(self):
+        """Scheduled every unchoking interval"""
+        # Receive threads only expire requests when something arrives, so catch silent peers here
+        self.expire_requests()
+        self.run_preferred_neighbors_round()
+
+    def send_choke_updates(self, updates):
+        """Send the choke/unchoke messages a round decided on; called without peers_lock held"""
+        for peer, choke in updates:
+            if choke:
+                # A choke discards the peer's pending requests, so their blocks need not go out
+                dropped = peer.outbound.clear_blocks()
+                if dropped:
+                    print(f"Dropped queued blocks {dropped} for choked peer {peer.ID}")
+            message = self.make_choke_message() if choke else self.make_unchoke_message()
+            try:
+                self.send_message(peer, message)
+                print(f"Sent {'choke' if choke else 'unchoke'} message to peer {peer.ID}")
+            except Exception as e:
+                print(f"Failed to send {'choke' if choke else 'unchoke'} message to peer {peer.ID}: {e}")
+
+    def run_preferred_neighbors_round(self):
+        """Choose preferred neighbors for the next unchoking interval and (un)choke accordingly"""
+        # Decide under the lock, send after releasing it, so a slow peer never holds up the others
+        updates = []
+        with self.peers_lock:
+            if not self.peers:
+                print("No peers connected, skipping preferred neighbor selection")
+                return
             
-            with self.peers_lock:
-                # Get choked but interested peers
-                candidates = [p for p in self.peers if p.interested and p not in self.unchoked_peers]
-                print(f"Found {len(candidates)} candidates for optimistic unchoking")
+            print(f"Selecting preferred neighbors from {len(self.peers)} connected peers")
                 
-                if not candidates:
-                    print("No candidates for optimistic unchoking, skipping")
-                    continue
-                    
-                # Select a random peer
-                selected_peer = random.choice(candidates)
-                print(f"Selected peer {selected_peer.ID} as optimistically unchoked neighbor")
+            # Fold the bytes received during the interval into each peer's average rate
+            now = time.monotonic()
+            for peer in self.peers:
+                rate = peer.download_meter.update(now)
+                print(f"Peer {peer.ID} download rate: {rate:.0f} B/s and is intereseted?: {peer.interested}")
+                
+            # Get interested peers
+            candidates = [p for p in self.peers if p.interested]
+            print(f"Found {len(candidates)} interested peers")
+            
+            if not candidates:
+                print("No interested peers, skipping preferred neighbor selection")
+                return
+                
+            # If we have the complete file, select randomly
+            if self.bitfield.is_complete():
+                print("We have complete file, selecting neighbors randomly")
+                # Random selection from interested peers
+                selected_peers = random.sample(candidates, 
+                                            min(self.config.num_of_pref_neighbords, len(candidates)))
+            else:
+                print("Selecting neighbors based on download rates")
+                # Current preferred neighbors stay unless a candidate is clearly faster
+                selected_peers = self.choker.select(candidates, self.unchoked_peers,
+                                                    lambda p: p.download_meter.rate)
+            
+            print(f"Selected {len(selected_peers)} preferred neighbors")
                 
-                # Unchoke the previously optimistically unchoked peer if not in preferred neighbors
-                if self.optimistically_unchoked_peer and self.optimistically_unchoked_peer not in self.unchoked_peers:
-                    print(f"Choking previous optimistically unchoked peer {self.optimistically_unchoked_peer.ID}")
-                    choke_message = self.make_choke_message()
-                    try:
-                        self.optimistically_unchoked_peer.socket.sendall(choke_message.get_message().encode('utf-8'))
-                        print(f"Sent choke message to peer {self.optimistically_unchoked_peer.ID}")
-                    except Exception as e:
-                        print(f"Failed to send choke message to peer {self.optimistically_unchoked_peer.ID}: {e}")
+            # Unchoke selected peers
+            new_unchoked = selected_peers.copy()
+            
+            # Don't disturb optimistically unchoked peer
+            if self.optimistically_unchoked_peer and self.optimistically_unchoked_peer not in new_unchoked:
+                new_unchoked.append(self.optimistically_unchoked_peer)
+                print(f"Added optimistically unchoked peer {self.optimistically_unchoked_peer.ID} to the unchoked list")
+                
+            # Handle peers that need to be choked
+            for peer in self.unchoked_peers:
+                if peer not in new_unchoked and peer != self.optimistically_unchoked_peer and not peer.choked:
+                    print(f"Choking peer {peer.ID}")
+                    peer.choked = True
+                    updates.append((peer, True))
+                        
+            # Handle peers that need to be unchoked
+            for peer in new_unchoked:
+                if peer not in self.unchoked_peers and peer.choked:
+                    print(f"Unchoking peer {peer.ID}")
+                    peer.choked = False
+                    updates.append((peer, False))
                         
-                # Set new optimistically unchoked peer
-                self.optimistically_unchoked_peer = selected_peer
+            # Update unchoked peers list
+            self.unchoked_peers = [p for p in new_unchoked if p != self.optimistically_unchoked_peer]
+            pref_ids = [peer.ID for peer in self.unchoked_peers]
+
+        self.send_choke_updates(updates)
+
+        # Log preferred neighbors change
+        print(f"New preferred neighbors: {pref_ids}")
+        self.logger.log_change_in_pref_neighbors(pref_ids)
+
+    def run_optimistic_unchoke_round(self):
+        """Rotate the optimistically unchoked neighbor"""
+        updates = []
+        with self.peers_lock:
+            # Get choked but interested peers
+            candidates = [p for p in self.peers if p.interested and p not in self.unchoked_peers]
+            print(f"Found {len(candidates)} candidates for optimistic unchoking")
+            
+            if not candidates:
+                print("No candidates for optimistic unchoking, skipping")
+                return
                 
-                # Send unchoke message to the selected peer
-                unchoke_message = self.make_unchoke_message()
-                try:
-                    selected_peer.socket.sendall(unchoke_message.get_message().encode('utf-8'))
-                    print(f"Sent unchoke message to peer {selected_peer.ID}")
-                except Exception as e:
-                    print(f"Failed to send unchoke message to peer {selected_peer.ID}: {e}")
+            # Select a random peer
+            selected_peer = random.choice(candidates)
+            print(f"Selected peer {selected_peer.ID} as optimistically unchoked neighbor")
+            
+            # Choke the previously optimistically unchoked peer if not in preferred neighbors
+            previous = self.optimistically_unchoked_peer
+            if previous and previous not in self.unchoked_peers and previous != selected_peer:
+                print(f"Choking previous optimistically unchoked peer {previous.ID}")
+                previous.choked = True
+                updates.append((previous, True))
                     
-                # Log optimistically unchoked neighbor change
-                self.logger.log_optimistic_unchoke(selected_peer.ID)
+            # Set new optimistically unchoked peer
+            self.optimistically_unchoked_peer = selected_peer
+            if selected_peer.choked:
+                selected_peer.choked = False
+                updates.append((selected_peer, False))
+
+        self.send_choke_updates(updates)
+                
+        # Log optimistically unchoked neighbor change
+        self.logger.log_optimistic_unchoke(selected_peer.ID)
 
     def shutdown(self):
         """Gracefully shut down the client"""
         print("Shutting down client...")
         self.running = False
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.connections is not None:
+            self.connections.stop()
         
         # Close all peer connections
         with self.peers_lock:
             for peer in self.peers:
                 try:
                     print(f"Closing connection to peer {peer.ID}")
+                    peer.outbound.close()
                     peer.socket.close()
                 except Exception as e:
                     print(f"Error closing peer socket: {e}")
@@ -627,7 +921,19 @@ class Client:
                 print("Closed server socket")
         except Exception as e:
             print(f"Error closing server socket: {e}")
-            
+
+        # Let pending verifications finish, then flush and unmap the downloaded file
+        if self.verify_pool:
+            self.verify_pool.shutdown(wait=True, cancel_futures=True)
+        self.disk_pool.shutdown(wait=True)
+        self.checkpoint_resume_state()
+        self.close_piece_store()
+        self.logger.close()
+        if self.trace is not None:
+            self.trace.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
         print("Client shutdown complete")
 
 
@@ -668,175 +974,425 @@ class Client:
         
     def make_have_message(self, piece_index):
         """Create a have message"""
-        return Message("have", piece_index)
+        return Message("have", codec.encode_index(piece_index))
         
+    def make_multi_have_message(self, piece_indices):
+        """Create a multi have message announcing several pieces"""
+        return Message("multi have", codec.encode_indices(piece_indices))
+
     def make_bitfield_message(self, bitfield):
-        print(self.ID, "HAS SEND A BITFIELD MESSAGE")
         """Create a bitfield message"""
-        return Message("bitfield", bitfield)
+        print(self.ID, "HAS SEND A BITFIELD MESSAGE")
+        return Message("bitfield", bitfield.to_bytes())
         
-    def make_request_message(self, piece_index):
-        """Create a request message"""
-        return Message("request", piece_index)
+    def make_request_message(self, piece_index, begin, length):
+        """Create a request message for one block of a piece"""
+        return Message("request", codec.encode_block_request(piece_index, begin, length))
+
+    def make_cancel_message(self, piece_index, begin, length):
+        """Create a cancel message for a block request that is no longer needed"""
+        return Message("cancel", codec.encode_block_request(piece_index, begin, length))
         
-    def make_piece_message(self, piece_index, piece_content):
-        """Create a piece message with binary content"""
-        # For piece messages, handle binary content differently
-        if isinstance(piece_content, bytes):
-            # If piece_content is already bytes, convert to latin1 string
-            piece_content_str = piece_content.decode('latin1')
-            return Message("piece", piece_index + piece_content_str)
-        else:
-            # If it's already a string
-            return Message("piece", piece_index + piece_content)
+    def send_message(self, peer, message):
+        """Queue a complete message for a peer; control messages go out ahead of queued pieces"""
+        peer.outbound.put_control(message.get_message())
+        if self.trace is not None:
+            self.trace_message(SENT_TRACE_EVENTS, peer, message.encoded_message_type, message.message_payload)
+
+    def send_block(self, peer, block):
+        """Queue a (piece index, begin, length) block for upload; the peer's writer reads it from disk when its turn comes"""
+        peer.outbound.put_block(block)
+
+    def write_block(self, peer, block):
+        """Upload a block from the file on disk; the frame header goes first, then the block range"""
+        piece_index, begin, length = block
+        self.get_piece_store().send_block(peer.socket, piece_index, begin, length,
+                                          self.block_header(piece_index, begin, length))
+        self.block_sent(peer, piece_index, length)
+
+    def block_header(self, piece_index, begin, length):
+        """Frame header and block header that go in front of a block's bytes"""
+        return (codec.encode_header(codec.PIECE, codec.BLOCK_HEADER_SIZE + length)
+                + codec.encode_block_header(piece_index, begin))
 
-    def request_piece(self, peer):
-        """Request a random piece that we need from the peer"""
-        # Find pieces that peer has and we don't have
-        desired_pieces = []
+    def block_sent(self, peer, piece_index, length):
+        self.trace_event(event_trace.PIECE_SENT, peer, piece_index, length)
+        peer.upload_counter.inc(length)
+
+    def piece_length(self, piece_index):
+        """Length of a piece; only the last one can be shorter than PieceSize"""
+        return min(self.config.piece_size, self.config.file_size - piece_index * self.config.piece_size)
+
+    def make_request_window(self):
+        """Create the outstanding-request window for a new peer connection"""
+        return RequestWindow(self.config.max_outstanding_requests, self.block_size)
+
+    def release_requests(self, blocks):
+        """Make blocks whose requests were dropped available to be requested again"""
         with self.bitfield_lock:
-            for i in range(len(peer.bitfield)):
-                if self.bitfield[i] == '0' and peer.bitfield[i] == '1' and not self.pieces_requested[i]:
-                    desired_pieces.append(i)
-        
-        print(f"Pieces available from peer {peer.ID}: {len(desired_pieces)}")
-                    
-        if desired_pieces:
-            # Choose a random piece
-            random_piece = random.choice(desired_pieces)
-            print(f"Requesting piece {random_piece} from peer {peer.ID}")
-            
-            # Mark as requested
-            self.pieces_requested[random_piece] = True
-            
-            # Create request message and send
-            request_message = self.make_request_message(str(random_piece))
+            self.release_blocks(blocks)
+
+    def release_blocks(self, blocks):
+        """release_requests for a caller that holds bitfield_lock"""
+        for piece_index, begin in blocks:
+            partial = self.partial_pieces.get(piece_index)
+            if partial is not None:
+                partial.release(begin // partial.block_size)
+
+    def expire_peer_requests(self, peer):
+        """Release a peer's timed-out requests; returns the expired (piece index, begin) blocks"""
+        expired = peer.requests.expire(REQUEST_TIMEOUT)
+        if expired:
+            print(f"Requests for blocks {expired} to peer {peer.ID} timed out")
+            for piece_index, _ in expired:
+                self.trace_event(event_trace.REQUEST_TIMEOUT, peer, piece_index)
+            self.request_timeouts_metric.inc(len(expired))
+            self.release_requests(expired)
+        return expired
+
+    def expire_requests(self):
+        """Release timed-out requests on every peer and re-issue them where we can"""
+        with self.peers_lock:
+            peers = list(self.peers)
+        released = False
+        for peer in peers:
+            if self.expire_peer_requests(peer):
+                released = True
+        if released:
+            for peer in peers:
+                if peer.am_interested and not peer.choking_us:
+                    self.request_pieces(peer)
+
+    def request_pieces(self, peer):
+        """Keep the peer's request window full with blocks of pieces we still need"""
+        # Requests that never got an answer go back into the pool
+        self.expire_peer_requests(peer)
+
+        free_slots = peer.requests.free_slots()
+        if free_slots == 0:
+            return
+
+        # Find blocks of pieces that peer has and we don't have, and claim some of them
+        with self.bitfield_lock:
+            if peer.outbound.closed:
+                return  # Being removed; remove_peer releases its window under this lock
+            if self.check_end_game():
+                chosen_blocks = self.pick_end_game_blocks(peer, free_slots)
+            else:
+                chosen_blocks = self.pick_blocks(peer, free_slots)
+            # Enter them in the window before the lock goes, so remove_peer cannot miss them
+            for piece_index, begin, _ in chosen_blocks:
+                peer.requests.on_request((piece_index, begin))
+            still_wanted = bool(chosen_blocks) or self.bitfield.wants_from(peer.bitfield)
+
+        print(f"Picked blocks {chosen_blocks} from peer {peer.ID}, window {peer.requests.size()}")
+
+        for piece_index, begin, length in chosen_blocks:
+            request_message = self.make_request_message(piece_index, begin, length)
             try:
-                peer.socket.sendall(request_message.get_message().encode('utf-8'))
-                print(f"Sent request for piece {random_piece} to peer {peer.ID}")
-                
-                # Immediately receive the piece data after sending request
-                start_time = time.time()
-                try:
-                    piece_content = b''
-                    remaining = self.config.piece_size
-                    
-                    # Set a timeout for piece reception
-                    peer.socket.settimeout(10.0)  # 10 second timeout
-                    
-                    while remaining > 0:
-                        chunk = peer.socket.recv(min(self.config.piece_size, remaining))
-                        if not chunk:
-                            print(f"Connection closed while receiving piece {random_piece}")
-                            break
-                        piece_content += chunk
-                        remaining -= len(chunk)
-                        
-                        # Progress indicator for large pieces
-                        if self.config.piece_size > 100000:  # Over 100KB
-                            progress = 100 * (self.config.piece_size - remaining) / self.config.piece_size
-                            if progress % 20 == 0:  # Show progress at 0%, 20%, 40%, etc.
-                                print(f"Download progress for piece {random_piece}: {progress:.1f}%")
-                    
-                    # Reset socket timeout to default
-                    peer.socket.settimeout(None)
-                    
-                    # Process the received piece
-                    if piece_content:
-                        download_time = time.time() - start_time
-                        download_rate = len(piece_content) / download_time if download_time > 0 else 0
-                        print(f"Received piece {random_piece} ({len(piece_content)} bytes) at {download_rate:.2f} B/s")
-
-                        # Update bitfield
-                        with self.bitfield_lock:
-                            temp_bitfield = list(self.bitfield)
-                            temp_bitfield[random_piece] = '1'
-                            self.bitfield = ''.join(temp_bitfield)
-                        
-                        # Store piece
-                        with self.file_pieces_lock:
-                            self.file_pieces[random_piece] = piece_content
-                            
-                            # Write to file
-                            file_path = os.path.join(self.peer_directory, self.config.file_name)
-                            if not os.path.exists(file_path):
-                                # Create an empty file of the right size
-                                with open(file_path, 'wb') as f:
-                                    f.seek(self.config.file_size - 1)
-                                    f.write(b'\0')
-                            
-                            # Write the piece to the correct position in the file
-                            with open(file_path, 'r+b') as f:
-                                f.seek(random_piece * self.config.piece_size)
-                                f.write(piece_content)
-                        
-                        # Log download and update statistics
-                        peer.pieces_downloaded += 1
-                        cur_num_pieces = self.bitfield.count('1')
-                        self.logger.log_downloading_piece(peer.ID, str(random_piece), cur_num_pieces)
-                        
-                        # Send have messages to all peers
-                        have_message = self.make_have_message(str(random_piece))
-                        have_encoded = have_message.get_message().encode('utf-8')
-                        
-                        with self.peers_lock:
-                            for other_peer in self.peers:
-                                if other_peer.ID != peer.ID:  # Don't send to the peer we got the piece from
-                                    try:
-                                        other_peer.socket.sendall(have_encoded)
-                                        print(f"Sent have message for piece {random_piece} to peer {other_peer.ID}")
-                                    except Exception as e:
-                                        print(f"Error sending have message to peer {other_peer.ID}: {e}")
-                        
-                        # Check if download is complete
-                        if cur_num_pieces == self.num_pieces:
-                            self.logger.log_download_completion()
-                            print(f"Download complete! All {self.num_pieces} pieces received.")
-                            self.reconstruct_file()
-                            
-                            # Tell all peers that they can terminate if everyone has the file
-                            # This would require additional protocol extension
-                        
-                        # Request another piece if not choked
-                        if not peer.choked:
-                            self.request_piece(peer)
-                    else:
-                        print(f"Received empty piece data for piece {random_piece}")
-                        self.pieces_requested[random_piece] = False  # Reset request flag
-                except socket.timeout:
-                    print(f"Timeout while receiving piece {random_piece} from peer {peer.ID}")
-                    self.pieces_requested[random_piece] = False  # Reset request flag
-                except Exception as e:
-                    print(f"Error receiving piece data: {e}")
-                    self.pieces_requested[random_piece] = False  # Reset request flag
+                self.send_message(peer, request_message)
+                print(f"Sent request for piece {piece_index} block {begin}+{length} to peer {peer.ID}")
             except Exception as e:
                 print(f"Failed to send request message to peer {peer.ID}: {e}")
-                self.pieces_requested[random_piece] = False  # Reset request flag
-        elif peer.interested:
+                self.release_requests(peer.requests.clear())
+                return
+
+        if still_wanted or peer.requests.pending():
+            return
+
+        if peer.am_interested:
             # No more pieces needed from this peer, send not interested
             print(f"No more pieces needed from peer {peer.ID}, sending not interested")
-            not_interested_message = self.make_not_interested_message()
-            try:
-                peer.socket.sendall(not_interested_message.get_message().encode('utf-8'))
-                # peer.interested = False
-                print(f"Sent not interested message to peer {peer.ID}")
-            except Exception as e:
-                print(f"Failed to send not interested message to peer {peer.ID}: {e}")
+            self.send_not_interested(peer)
 
+    def check_end_game(self):
+        """Enter end-game mode once the missing pieces drop to EndGameThreshold; caller holds bitfield_lock"""
+        if not self.end_game:
+            remaining = self.num_pieces - self.bitfield.count()
+            if 0 < remaining <= self.config.end_game_threshold:
+                self.end_game = True
+                print(f"Entering end game with {remaining} pieces left")
+        return self.end_game
+
+    def start_piece(self, piece_index):
+        """Begin fetching a piece; caller holds bitfield_lock"""
+        partial = PartialPiece(piece_index, self.piece_length(piece_index), self.block_size)
+        self.partial_pieces[piece_index] = partial
+        self.pieces_requested[piece_index] = True
+        return partial
+
+    def claim_blocks(self, peer, chosen, partial, blocks, count):
+        """Mark blocks of a partial piece as requested from peer and add them to chosen, up to count in all"""
+        for block in blocks[:count - len(chosen)]:
+            partial.on_request(block, peer)
+            chosen.append((partial.piece_index, partial.begin(block), partial.block_length(block)))
+
+    def pick_blocks(self, peer, count):
+        """Free blocks of pieces already started first, so they finish sooner, then blocks of newly picked pieces"""
+        chosen = []
+        for partial in self.partial_pieces.values():
+            if len(chosen) == count:
+                return chosen
+            if peer.bitfield.has(partial.piece_index) and partial.available_to(peer):
+                self.claim_blocks(peer, chosen, partial, partial.free_blocks(), count)
+
+        while len(chosen) < count:
+            blocks_per_piece = ceil(self.config.piece_size / self.block_size)
+            new_pieces = self.piece_picker.pick(peer.bitfield, ceil((count - len(chosen)) / blocks_per_piece),
+                                                self.pieces_requested)
+            if not new_pieces:
+                break
+            for piece_index in new_pieces:
+                partial = self.start_piece(piece_index)
+                self.claim_blocks(peer, chosen, partial, partial.free_blocks(), count)
+        return chosen
+
+    def pick_end_game_blocks(self, peer, count):
+        """Missing blocks this peer has and we have not asked it for, even if another peer is fetching them"""
+        candidates = []
+        for piece_index in self.bitfield.wanted_from(peer.bitfield).pieces():
+            partial = self.partial_pieces.get(piece_index) or self.start_piece(piece_index)
+            if not partial.available_to(peer):
+                continue
+            for block in partial.missing_blocks():
+                if not peer.requests.is_outstanding((piece_index, partial.begin(block))):
+                    candidates.append((partial, block))
+        random.shuffle(candidates)
+        # Blocks nobody is fetching yet come first
+        candidates.sort(key=lambda c: c[0].requested[c[1]])
+        chosen = []
+        for partial, block in candidates[:count]:
+            self.claim_blocks(peer, chosen, partial, [block], count)
+        return chosen
+
+    def cancel_duplicate_requests(self, piece_index, begin, length):
+        """Cancel requests for a block that has just arrived, left over from end game"""
+        with self.peers_lock:
+            peers = list(self.peers)
+        for other_peer in peers:
+            if other_peer.requests.cancel((piece_index, begin)):
+                try:
+                    self.send_message(other_peer, self.make_cancel_message(piece_index, begin, length))
+                    print(f"Sent cancel for piece {piece_index} block {begin}+{length} to peer {other_peer.ID}")
+                except Exception as e:
+                    print(f"Error sending cancel message to peer {other_peer.ID}: {e}")
+
+    def send_not_interested(self, peer):
+        """Tell a peer we no longer want anything from it"""
+        not_interested_message = self.make_not_interested_message()
+        try:
+            self.send_message(peer, not_interested_message)
+            peer.am_interested = False
+            print(f"Sent not interested message to peer {peer.ID}")
+        except Exception as e:
+            print(f"Failed to send not interested message to peer {peer.ID}: {e}")
+
+    def get_piece_store(self):
+        """Open the download target the first time a piece needs it"""
+        with self.piece_store_lock:
+            if self.piece_store is None:
+                # A seeder only reads, so its file is mapped read-only instead of opened for writing
+                self.piece_store = PieceStore(self.data_files(), self.config.piece_size,
+                                              writable=not self.bitfield.is_complete(),
+                                              track_dirty=self.flush_policy != FLUSH_NONE)
+            return self.piece_store
+
+    def close_piece_store(self):
+        """Flush and unmap the download target"""
+        with self.piece_store_lock:
+            if self.piece_store is not None:
+                self.piece_store.close(flush=self.flush_policy != FLUSH_NONE)
+                self.piece_store = None
+
+    def flush_store(self, sync=False):
+        """Flush what was written to the piece store (and fsync it, with sync), timing it for the metrics"""
+        store = self.get_piece_store()
+        start = time.perf_counter()
+        flushed, runs = store.sync() if sync else store.flush()
+        elapsed = time.perf_counter() - start
+        self.flush_latency_metric.labels().observe(elapsed)
+        self.flushed_bytes_metric.inc(flushed)
+        print(f"Flushed {flushed} bytes in {runs} runs in {elapsed * 1000:.1f} ms")
+
+    def handle_block(self, peer, piece_index, begin, block_content):
+        """Write a received block in place, hand the piece off once all its blocks are in, and keep the pipeline going"""
+        if piece_index >= self.num_pieces:
+            print(f"Invalid piece ID received: {piece_index}")
+            return
+
+        length = len(block_content)
+        latency = peer.requests.on_block((piece_index, begin), length)
+        peer.download_counter.inc(length)
+        peer.download_meter.add(length)
+        if latency is not None:
+            peer.latency_histogram.observe(latency)
+            download_rate = length / latency if latency > 0 else 0
+            print(f"Received piece {piece_index} block {begin}+{length} at {download_rate:.2f} B/s")
+
+        # Only the first copy of a block we are still missing is written; late answers to expired
+        # or end-game requests, and blocks we never asked for, are dropped
+        with self.bitfield_lock:
+            partial = self.partial_pieces.get(piece_index)
+            block = partial.block_at(begin, length) if partial is not None else None
+            claimed = block is not None and partial.claim(block, peer)
+
+        if not claimed:
+            print(f"Dropping piece {piece_index} block {begin}+{length} from peer {peer.ID}, not needed")
+        else:
+            if self.end_game:
+                self.cancel_duplicate_requests(piece_index, begin, length)
+            # Blocks only go to ranges whose piece bit is unset, so uploads never see a partial piece
+            self.get_piece_store().write_block(piece_index, begin, block_content)
+            with self.bitfield_lock:
+                piece_done = partial.block_written()
+            if piece_done and self.verify_pool:
+                # Hash off the network thread; the piece stays in partial_pieces meanwhile
+                self.verify_pool.submit(self.verify_piece, peer, partial)
+            elif piece_done:
+                self.store_piece(peer, piece_index)
+
+        # Request more blocks if not choked
+        if not peer.choking_us and not self.bitfield.is_complete():
+            self.request_pieces(peer)
+
+    def verify_piece(self, peer, partial):
+        """Runs in the verify pool: keep the assembled piece if it matches the manifest, otherwise fetch it again"""
+        piece_index = partial.piece_index
+        try:
+            if self.manifest.verify(piece_index, self.get_piece_store().read_piece(piece_index)):
+                self.store_piece(peer, piece_index)
+                return
+
+            with self.bitfield_lock:
+                senders = list(partial.senders)
+                partial.reset()
+            self.trace_event(event_trace.HASH_FAILURE, peer, piece_index, partial.piece_length)
+            self.hash_failures_metric.inc()
+            if len(senders) > 1:
+                # Any of them may have sent the bad block; the retry comes from one peer, so a repeat can be pinned down
+                print(f"Piece {piece_index} with blocks from peers {[p.ID for p in senders]} failed verification, "
+                      f"fetching it again from a single peer")
+            else:
+                peer.hash_failures += 1
+                print(f"Piece {piece_index} from peer {peer.ID} failed verification "
+                      f"({peer.hash_failures}/{MAX_HASH_FAILURES})")
+                if peer.hash_failures >= MAX_HASH_FAILURES:
+                    print(f"Disconnecting peer {peer.ID} after {peer.hash_failures} corrupt pieces")
+                    self.banned_peers.add(peer.ID)
+                    self.remove_peer(peer)
+                    return
+            # Ask again right away instead of waiting for the next block
+            for sender in senders:
+                if not sender.choking_us:
+                    self.request_pieces(sender)
+        except Exception as e:
+            print(f"Error verifying piece {piece_index} from peer {peer.ID}: {e}")
+
+    def store_piece(self, peer, piece_index):
+        """Mark a piece whose blocks are all written as ours, announce it and finish the download if it was the last one"""
+        with self.bitfield_lock:
+            is_new = self.bitfield.set(piece_index)
+            self.partial_pieces.pop(piece_index, None)
+            self.pieces_requested[piece_index] = False
+            self.piece_picker.piece_completed(piece_index)
+            cur_num_pieces = self.bitfield.count()
+            self.resume_dirty = self.resume_dirty or is_new
+
+        if not is_new:
+            return
+
+        # Log download and update statistics
+        self.pieces_stored_metric.inc()
+        self.trace_event(event_trace.PIECE_STORED, peer, piece_index, self.piece_length(piece_index))
+        self.logger.log_downloading_piece(peer.ID, str(piece_index), cur_num_pieces)
+        
+        # Announce the piece to the other peers, batched with others stored shortly after it
+        self.queue_have(piece_index)
+        
+        # Check if download is complete
+        if cur_num_pieces == self.num_pieces:
+            self.announce_complete()
+            self.logger.log_download_completion()
+            self.trace_event(event_trace.COMPLETE)
+            print(f"Download complete! All {self.num_pieces} pieces received.")
+            self.disk_pool.submit(self.finalize_download)
+            self.disk_pool.submit(self.checkpoint_resume_state)
+            
+            # Nothing more to ask anyone for
+            with self.peers_lock:
+                interesting_peers = [p for p in self.peers if p.am_interested]
+            for other_peer in interesting_peers:
+                self.send_not_interested(other_peer)
+
+    def queue_have(self, piece_index):
+        """Announce a stored piece after HaveBatchDelay, in one frame with any others stored meanwhile"""
+        with self.have_lock:
+            self.pending_haves.append(piece_index)
+            if len(self.pending_haves) > 1:
+                return  # The first piece of the batch already scheduled the flush
+        if self.config.have_batch_delay > 0:
+            self.call_later(self.config.have_batch_delay, self.flush_haves)
+        else:
+            self.flush_haves()
+
+    def flush_haves(self):
+        """Send the pieces stored since the last flush to every peer that does not have them yet"""
+        with self.have_lock:
+            batch = self.pending_haves
+            self.pending_haves = []
+        if not batch:
+            return
+        with self.peers_lock:
+            peers = list(self.peers)
+        for other_peer in peers:
+            # A peer that already has a piece gets nothing from hearing that we have it too
+            missing = [i for i in batch if not other_peer.bitfield.has(i)]
+            if len(missing) < len(batch):
+                self.haves_suppressed_metric.inc(len(batch) - len(missing))
+            if not missing:
+                continue
+            if len(missing) == 1:
+                message = self.make_have_message(missing[0])
+            else:
+                message = self.make_multi_have_message(missing)
+            self.send_message(other_peer, message)
+            self.have_frames_metric.inc()
+            print(f"Sent have for pieces {missing} to peer {other_peer.ID}")
+
+    def announce_complete(self):
+        """Send our full bitfield to every peer, so peers whose haves were suppressed still see us complete"""
+        with self.have_lock:
+            self.pending_haves = []  # The bitfield covers them
+        bitfield_message = self.make_bitfield_message(self.bitfield)
+        with self.peers_lock:
+            peers = list(self.peers)
+        for other_peer in peers:
+            self.send_message(other_peer, bitfield_message)
+            self.have_frames_metric.inc()
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds, on the scheduler thread"""
+        if self.scheduler is not None:
+            self.scheduler.call_later(delay, callback)
+        else:
+            callback()
 
     def remove_peer(self, peer):
         """Remove peer from all collections and close socket"""
         try:
             print(f"Removing peer {peer.ID} from connections")
             
-            # Close socket
+            # Stop the writer, then close socket
+            peer.outbound.close()
             if peer.socket:
                 peer.socket.close()
                 
             # Remove from collections
             with self.peers_lock:
-                if peer in self.peers:
+                was_connected = peer in self.peers
+                if was_connected:
                     self.peers.remove(peer)
+                    self.trace_event(event_trace.DISCONNECT, peer)
                     print(f"Removed peer {peer.ID} from peers list")
                     
                 if peer in self.unchoked_peers:
@@ -850,72 +1406,61 @@ class Client:
                 if peer == self.optimistically_unchoked_peer:
                     self.optimistically_unchoked_peer = None
                     print(f"Removed peer {peer.ID} as optimistically unchoked peer")
+
+            # Its pieces no longer count towards availability, and its requests go back to the pool
+            with self.bitfield_lock:
+                if was_connected:
+                    self.piece_picker.remove_peer_bitfield(peer.bitfield)
+                self.release_blocks(peer.requests.clear())
+
+            if was_connected:
+                self.peer_history[peer.ID] = (peer.download_meter, peer.hash_failures)
+                if peer.dial_address is not None and self.running:
+                    if peer.ID in self.banned_peers:
+                        self.stop_dialing(peer.dial_address)
+                    else:
+                        self.redial(peer.dial_address)
                     
         except Exception as e:
             print(f"Error removing peer {peer.ID}: {e}")
 
-    def reconstruct_file(self):
-        """Reconstruct the complete file from pieces with validation"""
+    def finalize_download(self):
+        """Make the completed download durable and give it its final name; pieces were already written in place"""
         try:
-            output_file = os.path.join(self.peer_directory, self.config.file_name)
-            print(f"Reconstructing file to: {output_file}")
-            
-            # Create a backup of any existing file
-            if os.path.exists(output_file):
-                backup_file = output_file + ".bak"
-                try:
-                    import shutil
-                    shutil.copy2(output_file, backup_file)
-                    print(f"Created backup of existing file: {backup_file}")
-                except Exception as e:
-                    print(f"Failed to create backup: {e}")
-            
-            # Open file for writing
-            with open(output_file, 'wb') as f:
-                pieces_written = 0
-                bytes_written = 0
-                
-                for i in range(self.num_pieces):
-                    print(f"PIECE {i}: {self.file_pieces[i][:20]}")
-                    if self.file_pieces[i]:
-                        f.write(self.file_pieces[i])
-                        pieces_written += 1
-                        bytes_written += len(self.file_pieces[i])
-                        
-                        # Progress indicator for large files
-                        if self.num_pieces > 50 and i % (self.num_pieces // 10) == 0:
-                            progress = 100 * i / self.num_pieces
-                            print(f"File reconstruction progress: {progress:.1f}%")
-                    else:
-                        print(f"Warning: Missing piece {i} during file reconstruction")
-                        # Write empty bytes for missing pieces
-                        if i < self.num_pieces - 1:  # Not the last piece
-                            f.write(b'\0' * self.config.piece_size)
-                        else:  # Last piece might be smaller
-                            last_piece_size = self.config.file_size % self.config.piece_size
-                            if last_piece_size == 0:
-                                last_piece_size = self.config.piece_size
-                            f.write(b'\0' * last_piece_size)
-                
-                # Set file size to match original
-                if bytes_written != self.config.file_size:
-                    print(f"Warning: Bytes written ({bytes_written}) doesn't match expected file size ({self.config.file_size})")
-                    print("Truncating file to expected size")
-                    f.truncate(self.config.file_size)
-            
-            print(f"File reconstruction complete: {self.config.file_name}")
-            print(f"Wrote {pieces_written} of {self.num_pieces} pieces")
-            
-            # Verify file size
-            actual_size = os.path.getsize(output_file)
-            if actual_size == self.config.file_size:
-                print(f"File size verification successful: {actual_size} bytes")
-            else:
-                print(f"File size verification failed: Expected {self.config.file_size} bytes, got {actual_size} bytes")
-            
-            return True
+            with self.checkpoint_lock:
+                if self.flush_policy != FLUSH_NONE:
+                    self.flush_store(sync=True)
+
+                file_path = self.download_path()
+                output_file = os.path.join(self.data_root, self.config.file_name)
+                if file_path != output_file:
+                    # One rename, so the final name only ever holds a complete file
+                    os.replace(file_path, output_file)
+                    sync_directory(self.data_root)
+                    self.data_suffix = ""
+                    # The rename keeps the file's mtime, so its resume state stays current
+                    if os.path.exists(resume_path(file_path)):
+                        os.replace(resume_path(file_path), resume_path(output_file))
+                    print(f"Finalized {file_path} as {output_file}")
+                with self.bitfield_lock:
+                    self.resume_dirty = True
+
+            missing = [i for i in range(self.num_pieces) if not self.bitfield.has(i)]
+            for i in missing:
+                print(f"Warning: Missing piece {i} in downloaded file")
+            print(f"Have {self.num_pieces - len(missing)} of {self.num_pieces} pieces")
+
+            # Verify file sizes
+            for path, expected_size in self.data_files():
+                actual_size = os.path.getsize(path)
+                if actual_size == expected_size:
+                    print(f"File size verification successful: {path} {actual_size} bytes")
+                else:
+                    print(f"File size verification failed: {path} expected {expected_size} bytes, got {actual_size} bytes")
+
+            return not missing
         except Exception as e:
-            print(f"Error reconstructing file: {e}")
+            print(f"Error finalizing file: {e}")
             import traceback
             traceback.print_exc()
-            return False
\ No newline at end of file
+            return False
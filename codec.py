@@ -0,0 +1,151 @@
+"""
+Binary wire codec for peer messages.
+
+Every frame is a 4-byte big-endian length (type byte + payload), a 1-byte
+message type and the payload. Frames are built and parsed directly on
+bytes/bytearray/memoryview objects, so nothing is decoded to str on the way.
+"""
+
+import struct
+
+# Message type values (see the protocol table in README.md)
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+MULTI_HAVE = 9
+
+MESSAGE_TYPE_ENCODE = {
+    "choke": CHOKE,
+    "unchoke": UNCHOKE,
+    "interested": INTERESTED,
+    "not interested": NOT_INTERESTED,
+    "have": HAVE,
+    "bitfield": BITFIELD,
+    "request": REQUEST,
+    "piece": PIECE,
+    "cancel": CANCEL,
+    "multi have": MULTI_HAVE,
+}
+
+HEADER = struct.Struct(">IB")  # length, type
+HEADER_SIZE = HEADER.size
+PIECE_INDEX = struct.Struct(">I")
+PIECE_INDEX_SIZE = PIECE_INDEX.size
+BLOCK_REQUEST = struct.Struct(">III")  # piece index, offset in the piece, length: request and cancel payloads
+BLOCK_REQUEST_SIZE = BLOCK_REQUEST.size
+BLOCK_HEADER = struct.Struct(">II")  # piece index, offset in the piece: the start of a piece payload
+BLOCK_HEADER_SIZE = BLOCK_HEADER.size
+
+# Refuse to allocate buffers for absurd lengths coming off the wire
+MAX_FRAME_LENGTH = 1 << 28
+
+
+def encode_frame(message_type, payload=b""):
+    """Build a complete frame (header + payload) as bytes"""
+    return HEADER.pack(len(payload) + 1, message_type) + payload
+
+
+def encode_header(message_type, payload_length):
+    """Build only the frame header, for payloads that are sent separately"""
+    return HEADER.pack(payload_length + 1, message_type)
+
+
+def encode_index(piece_index):
+    """Encode a piece index as a 4-byte big-endian payload"""
+    return PIECE_INDEX.pack(piece_index)
+
+
+def decode_index(payload, offset=0):
+    """Decode a 4-byte big-endian piece index from a payload"""
+    return PIECE_INDEX.unpack_from(payload, offset)[0]
+
+
+def encode_indices(piece_indices):
+    """Encode several piece indices back to back, for a multi have payload"""
+    return struct.pack(f">{len(piece_indices)}I", *piece_indices)
+
+
+def decode_indices(payload):
+    """Decode every whole 4-byte piece index in a payload"""
+    count = len(payload) // PIECE_INDEX_SIZE
+    return struct.unpack_from(f">{count}I", payload)
+
+
+def encode_block_request(piece_index, begin, length):
+    """Encode the block a request or cancel is about"""
+    return BLOCK_REQUEST.pack(piece_index, begin, length)
+
+
+def decode_block_request(payload):
+    """Decode (piece index, begin, length) from a request or cancel payload"""
+    return BLOCK_REQUEST.unpack_from(payload)
+
+
+def encode_block_header(piece_index, begin):
+    """Encode the index and offset that come before the data in a piece payload"""
+    return BLOCK_HEADER.pack(piece_index, begin)
+
+
+def decode_block_header(payload):
+    """Decode (piece index, begin) from the start of a piece payload"""
+    return BLOCK_HEADER.unpack_from(payload)
+
+
+def decode_header(buffer, offset=0):
+    """Return (payload_length, message_type) for the header at offset"""
+    length, message_type = HEADER.unpack_from(buffer, offset)
+    if length < 1 or length > MAX_FRAME_LENGTH:
+        raise ValueError(f"Invalid frame length: {length}")
+    return length - 1, message_type
+
+
+def decode_frame(buffer, offset=0):
+    """Decode one frame from an in-memory buffer.
+
+    Returns (message_type, payload, next_offset) where payload is a memoryview
+    into buffer, or None if the buffer does not yet hold a complete frame.
+    """
+    if len(buffer) - offset < HEADER_SIZE:
+        return None
+    payload_length, message_type = decode_header(buffer, offset)
+    start = offset + HEADER_SIZE
+    end = start + payload_length
+    if len(buffer) < end:
+        return None
+    return message_type, memoryview(buffer)[start:end], end
+
+
+def recv_exact(sock, length):
+    """Receive exactly length bytes into a bytearray, or None if the peer closed"""
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        chunk_size = sock.recv_into(view[received:], length - received)
+        if chunk_size == 0:
+            return None
+        received += chunk_size
+    return buffer
+
+
+def read_frame(sock):
+    """Read one frame from a socket.
+
+    Returns (message_type, payload) or None if the connection was closed.
+    """
+    header = recv_exact(sock, HEADER_SIZE)
+    if header is None:
+        return None
+    payload_length, message_type = decode_header(header)
+    if payload_length == 0:
+        return message_type, b""
+    payload = recv_exact(sock, payload_length)
+    if payload is None:
+        return None
+    return message_type, payload
@@ -7,6 +7,24 @@ class Config:
         self.file_name = None
         self.file_size = None
         self.piece_size = None
+        self.block_size = 16384  # Optional, bytes per block request (0 requests whole pieces)
+        self.max_outstanding_requests = 16  # Optional, upper bound on pipelined block requests per peer
+        self.piece_selection = "rarest-first"  # Optional, "rarest-first" or "random"
+        self.end_game_threshold = 8  # Optional, pieces left when end-game mode starts (0 disables it)
+        self.manifest_file = None  # Optional, piece hash manifest made by manifest.py
+        self.share_file = None  # Optional, share manifest made by share.py for a multi-file share
+        self.share = None  # The loaded Share when share_file is set
+        self.resume_interval = 30  # Optional, seconds between resume state checkpoints
+        self.log_flush_interval = 1.0  # Optional, seconds between log file flushes
+        self.log_flush_bytes = 65536  # Optional, buffered log bytes that force an early flush
+        self.log_queue_size = 10000  # Optional, log events waiting for the writer thread
+        self.log_overflow = "block"  # Optional, "block" or "drop" when the log queue is full
+        self.rate_half_life = 10.0  # Optional, seconds for a download rate sample to lose half its weight
+        self.choke_hysteresis = 0.2  # Optional, how much faster a peer must be to displace a preferred neighbor
+        self.have_batch_delay = 0.05  # Optional, seconds stored pieces wait to be announced together (0 sends at once)
+        self.max_concurrent_dials = 8  # Optional, outgoing connection attempts in progress at once
+        self.dial_backoff_max = 60.0  # Optional, longest wait in seconds between attempts to reach a peer
+        self.flush_policy = "periodic"  # Optional, "periodic", "on-complete" or "none": when stored pieces are synced to disk
         self.peers_file = "project_config_file_small/project_config_file_small/PeerInfo.cfg"  # Default value
         
         with open(filepath, "r") as file:
@@ -30,12 +48,56 @@ class Config:
                         self.file_size = int(param_value)
                     elif param_name == "PieceSize":
                         self.piece_size = int(param_value)
+                    elif param_name == "BlockSize":
+                        self.block_size = int(param_value)
+                    elif param_name == "MaxOutstandingRequests":
+                        self.max_outstanding_requests = int(param_value)
+                    elif param_name == "PieceSelection":
+                        self.piece_selection = param_value.lower()
+                    elif param_name == "EndGameThreshold":
+                        self.end_game_threshold = int(param_value)
+                    elif param_name == "ManifestFile":
+                        self.manifest_file = param_value
+                    elif param_name == "ShareFile":
+                        self.share_file = param_value
+                    elif param_name == "ResumeInterval":
+                        self.resume_interval = int(param_value)
+                    elif param_name == "LogFlushInterval":
+                        self.log_flush_interval = float(param_value)
+                    elif param_name == "LogFlushBytes":
+                        self.log_flush_bytes = int(param_value)
+                    elif param_name == "LogQueueSize":
+                        self.log_queue_size = int(param_value)
+                    elif param_name == "LogOverflow":
+                        self.log_overflow = param_value.lower()
+                    elif param_name == "RateHalfLife":
+                        self.rate_half_life = float(param_value)
+                    elif param_name == "ChokeHysteresis":
+                        self.choke_hysteresis = float(param_value)
+                    elif param_name == "HaveBatchDelay":
+                        self.have_batch_delay = float(param_value)
+                    elif param_name == "MaxConcurrentDials":
+                        self.max_concurrent_dials = int(param_value)
+                    elif param_name == "DialBackoffMax":
+                        self.dial_backoff_max = float(param_value)
+                    elif param_name == "FlushPolicy":
+                        self.flush_policy = param_value.lower()
                     else:
                         print(f"Unknown parameter: {param_name} with value: {param_value}")
         
         # If custom filename was provided, log it
         if custom_filename:
             print(f"Using custom file: {custom_filename} instead of {param_value}")
+
+        # A share describes its own files, so it decides the name, size and piece size
+        if self.share_file:
+            from share import Share
+            self.share = Share.load(self.share_file)
+            if self.piece_size is not None and self.piece_size != self.share.piece_size:
+                print(f"Warning: PieceSize {self.piece_size} ignored, the share uses {self.share.piece_size}")
+            self.file_name = self.share.name
+            self.file_size = self.share.total_size
+            self.piece_size = self.share.piece_size
                         
     def print_config(self):
         """Print all configuration parameters for debugging"""
@@ -46,4 +108,21 @@ class Config:
         print("FileName:", self.file_name)
         print("FileSize:", self.file_size)
         print("PieceSize:", self.piece_size)
+        print("BlockSize:", self.block_size)
+        print("MaxOutstandingRequests:", self.max_outstanding_requests)
+        print("PieceSelection:", self.piece_selection)
+        print("EndGameThreshold:", self.end_game_threshold)
+        print("ManifestFile:", self.manifest_file)
+        print("ShareFile:", self.share_file)
+        print("ResumeInterval:", self.resume_interval)
+        print("LogFlushInterval:", self.log_flush_interval)
+        print("LogFlushBytes:", self.log_flush_bytes)
+        print("LogQueueSize:", self.log_queue_size)
+        print("LogOverflow:", self.log_overflow)
+        print("RateHalfLife:", self.rate_half_life)
+        print("ChokeHysteresis:", self.choke_hysteresis)
+        print("HaveBatchDelay:", self.have_batch_delay)
+        print("MaxConcurrentDials:", self.max_concurrent_dials)
+        print("DialBackoffMax:", self.dial_backoff_max)
+        print("FlushPolicy:", self.flush_policy)
         print("PeersFile:", self.peers_file)
\ No newline at end of file
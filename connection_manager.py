@@ -0,0 +1,168 @@
+"""
+Outgoing connection manager for the threaded engine.
+
+Every peer we are responsible for dialing is a target here. A fixed pool of
+dialer threads takes targets off a heap of due times, so at most
+MaxConcurrentDials connection attempts run at once and the thread count does
+not grow with the number of unreachable peers. A failed attempt puts the
+target back on the heap after an exponential backoff with jitter, capped at
+DialBackoffMax seconds, so a peer that is down is not hammered and a swarm of
+restarting peers does not retry in lockstep.
+
+At startup every earlier peer is added at once and dialed in parallel. A peer
+that is not listening yet is probed again after PROBE_DELAY, doubling from
+there, so peers launched together find each other within a few round trips
+instead of one fixed delay per peer. Once a peer has been reached, later
+retries use the slower BASE_DELAY backoff.
+
+Once a dial succeeds the target belongs to the connection. When the client
+loses the connection (or the handshake fails) it calls lost(), and the target
+is dialed again with the same backoff, so dropped peers are reconnected.
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+BASE_DELAY = 1.0  # Seconds before the first retry; doubled after every failure
+PROBE_DELAY = 0.05  # Same, for a peer we have never reached (it may still be starting up)
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_MAX_DIALS = 8
+
+# Target states
+WAITING = "waiting"  # On the heap until its next attempt
+DIALING = "dialing"  # A dialer thread is connecting to it
+CONNECTED = "connected"  # Owned by a live connection (or its handshake)
+
+
+def backoff_delay(attempts, max_delay=DEFAULT_MAX_DELAY, base=BASE_DELAY):
+    """Delay before the next attempt after attempts failures: half the capped exponential, plus up to half again at random"""
+    delay = min(max_delay, base * 2 ** min(attempts, 32))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class DialTarget:
+    def __init__(self, address):
+        self.address = address  # (host, port)
+        self.attempts = 0  # Failures since the last successful handshake
+        self.reached = False  # Set by the first successful handshake; until then failures are startup probes
+        self.state = WAITING
+        self.due = 0.0
+
+
+class ConnectionManager:
+    def __init__(self, connect, on_connect, max_dials=DEFAULT_MAX_DIALS, max_delay=DEFAULT_MAX_DELAY):
+        """connect(address) returns a connected socket or raises OSError; on_connect(address, sock) takes it over"""
+        self.connect = connect
+        self.on_connect = on_connect
+        self.max_dials = max(1, max_dials)
+        self.max_delay = max_delay
+        self.targets = {}  # address -> DialTarget
+        self.heap = []  # (due, seq, address) of waiting targets
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        for i in range(self.max_dials):
+            thread = threading.Thread(target=self.run, name=f"dialer-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def _schedule(self, target, delay):
+        """Put a target on the heap; caller holds the condition"""
+        target.state = WAITING
+        target.due = time.monotonic() + delay
+        heapq.heappush(self.heap, (target.due, next(self.seq), target.address))
+        self.condition.notify()
+
+    def _retry(self, target):
+        """Schedule the next attempt after a backoff; caller holds the condition. Returns the delay"""
+        delay = backoff_delay(target.attempts, self.max_delay, BASE_DELAY if target.reached else PROBE_DELAY)
+        target.attempts += 1
+        self._schedule(target, delay)
+        return delay
+
+    def add(self, address, delay=0.0):
+        """Start dialing a peer after delay seconds, unless it is already a target"""
+        address = tuple(address)
+        with self.condition:
+            if address in self.targets:
+                return
+            target = DialTarget(address)
+            self.targets[address] = target
+            self._schedule(target, delay)
+
+    def connected(self, address):
+        """The handshake with a dialed peer succeeded; the next loss starts the backoff from the beginning"""
+        with self.condition:
+            target = self.targets.get(tuple(address))
+            if target is not None:
+                target.attempts = 0
+                target.reached = True
+
+    def lost(self, address):
+        """A connection we dialed ended (or never completed its handshake); dial it again after a backoff"""
+        with self.condition:
+            target = self.targets.get(tuple(address))
+            if target is None or target.state != CONNECTED or not self.running:
+                return
+            delay = self._retry(target)
+            print(f"Connection to {target.address} lost, redialing in {delay:.1f}s")
+
+    def forget(self, address):
+        """Never dial this peer again (e.g. it was banned for sending corrupt pieces)"""
+        with self.condition:
+            self.targets.pop(tuple(address), None)
+
+    def counts(self):
+        """Number of targets in each state"""
+        with self.condition:
+            counts = {WAITING: 0, DIALING: 0, CONNECTED: 0}
+            for target in self.targets.values():
+                counts[target.state] += 1
+            return counts
+
+    def next_target(self):
+        """Block until a target is due and mark it as being dialed; None once stopped"""
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+                if self.heap and self.heap[0][0] <= now:
+                    due, _, address = heapq.heappop(self.heap)
+                    target = self.targets.get(address)
+                    # Skip entries for forgotten targets and stale entries left by a reschedule
+                    if target is None or target.state != WAITING or target.due != due:
+                        continue
+                    target.state = DIALING
+                    return target
+                self.condition.wait(self.heap[0][0] - now if self.heap else None)
+            return None
+
+    def run(self):
+        """Body of a dialer thread"""
+        while True:
+            target = self.next_target()
+            if target is None:
+                return
+            try:
+                sock = self.connect(target.address)
+            except Exception as e:
+                with self.condition:
+                    if self.targets.get(target.address) is target and self.running:
+                        delay = self._retry(target)
+                        print(f"Dial to {target.address} failed ({e}), retrying in {delay:.1f}s")
+                continue
+            # Mark it first, so a handshake that fails straight away finds it ready for lost()
+            with self.condition:
+                target.state = CONNECTED
+            self.on_connect(target.address, sock)
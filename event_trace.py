@@ -0,0 +1,120 @@
+"""
+Binary event trace.
+
+An opt-in record of what a peer did, for analysis after the run (see
+trace_analyzer.py). Every event is one fixed-size little-endian record:
+
+    timestamp_ns  u64  wall clock, time.time_ns()
+    peer_id       u32  the other peer (0 when there is none)
+    piece_index   u32  NO_PIECE when the event is not about a piece
+    num_bytes     u32  payload bytes moved, 0 otherwise
+    event_type    u8   one of the constants below
+    (3 pad bytes)
+
+Records are packed into a preallocated buffer and the buffer is written to
+the file in one call whenever it fills up, and on close. The file starts with
+a small header: magic, format version, record size and the tracing peer's ID.
+"""
+
+import struct
+import threading
+import time
+
+MAGIC = b"P2PTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sHHI")  # magic, version, record size, own peer ID
+RECORD = struct.Struct("<QIIIB3x")
+NO_PIECE = 0xFFFFFFFF
+DEFAULT_BUFFER_RECORDS = 4096
+
+# Event types
+CONNECT = 1
+DISCONNECT = 2
+CHOKE_SENT = 3
+UNCHOKE_SENT = 4
+CHOKED_BY = 5
+UNCHOKED_BY = 6
+REQUEST_SENT = 7
+PIECE_RECEIVED = 8
+PIECE_STORED = 9
+HASH_FAILURE = 10
+REQUEST_TIMEOUT = 11
+CANCEL_SENT = 12
+PIECE_SENT = 13
+HAVE_RECEIVED = 14
+COMPLETE = 15
+
+EVENT_NAMES = {
+    CONNECT: "connect",
+    DISCONNECT: "disconnect",
+    CHOKE_SENT: "choke_sent",
+    UNCHOKE_SENT: "unchoke_sent",
+    CHOKED_BY: "choked_by",
+    UNCHOKED_BY: "unchoked_by",
+    REQUEST_SENT: "request_sent",
+    PIECE_RECEIVED: "piece_received",
+    PIECE_STORED: "piece_stored",
+    HASH_FAILURE: "hash_failure",
+    REQUEST_TIMEOUT: "request_timeout",
+    CANCEL_SENT: "cancel_sent",
+    PIECE_SENT: "piece_sent",
+    HAVE_RECEIVED: "have_received",
+    COMPLETE: "complete",
+}
+
+
+def peer_number(peer_id):
+    """Numeric form of a peer ID for the peer_id field"""
+    return int(peer_id) if str(peer_id).isdigit() else 0
+
+
+class EventTrace:
+    def __init__(self, path, own_peer_id, buffer_records=DEFAULT_BUFFER_RECORDS):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, peer_number(own_peer_id)))
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def record(self, event_type, peer_id=0, piece_index=NO_PIECE, num_bytes=0):
+        with self.lock:
+            if self.file is None:
+                return
+            RECORD.pack_into(self.buffer, self.offset, time.time_ns(), peer_id, piece_index, num_bytes, event_type)
+            self.offset += RECORD.size
+            if self.offset == len(self.buffer):
+                self._write_buffer()
+
+    def _write_buffer(self):
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self._write_buffer()
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self._write_buffer()
+            self.file.close()
+            self.file = None
+
+
+def read_trace(path):
+    """Return (own peer ID, list of (timestamp_ns, peer_id, piece_index, num_bytes, event_type))"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a trace")
+    magic, version, record_size, own_peer_id = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a version {VERSION} trace")
+    # A trace cut short by a crash may end in a partial record; ignore it
+    usable = (len(data) - HEADER.size) // RECORD.size * RECORD.size
+    records = list(RECORD.iter_unpack(memoryview(data)[HEADER.size:HEADER.size + usable]))
+    return own_peer_id, records
@@ -1,22 +1,124 @@
+"""
+Per-peer event log.
+
+log_message only formats the line and puts it on a queue; a background writer
+thread owns the one long-lived file handle, writes queued lines in batches and
+flushes them every flush_interval seconds or once flush_bytes are buffered,
+whichever comes first. The queue is bounded: with the "block" overflow policy
+a full queue makes the caller wait for the writer, with "drop" the event is
+discarded and counted. Line formats are unchanged.
+"""
+
+import atexit
+import queue
+import threading
+import time
 from datetime import datetime
-import os
+
+OVERFLOW_POLICIES = ("block", "drop")
+_CLOSE = None  # Queue sentinel telling the writer thread to finish
+
 
 class Logger:
-    def __init__(self, peer_id):
+    def __init__(self, peer_id, flush_interval=1.0, flush_bytes=65536, queue_size=10000, overflow="block"):
         self.peer_id = peer_id
         self.log_filepath = f"log_peer_{peer_id}.log"
-        
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.overflow = overflow if overflow in OVERFLOW_POLICIES else "block"
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.closed = False
+        self.close_lock = threading.Lock()
+
+        # Timestamps only change once a second, so the formatted one is reused until then
+        self.stamp_second = None
+        self.stamp = None
+
         # Create log file if it doesn't exist and clear it if it does
-        with open(self.log_filepath, "w") as file:
-            file.write(f"Log file for Peer {peer_id}\n")
-            file.write(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            file.write("-" * 80 + "\n")
-    
+        self.file = open(self.log_filepath, "w")
+        self.file.write(f"Log file for Peer {peer_id}\n")
+        self.file.write(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        self.file.write("-" * 80 + "\n")
+        self.file.flush()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def timestamp(self):
+        now = int(time.time())
+        if now != self.stamp_second:
+            self.stamp = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+            self.stamp_second = now
+        return self.stamp
+
     def log_message(self, message):
         """Log a message with timestamp"""
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(self.log_filepath, "a") as file:
-            file.write(f"{current_time}: {message}\n")
+        line = f"{self.timestamp()}: {message}\n"
+        if self.closed:
+            return
+        if self.overflow == "block":
+            self.queue.put(line)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        """Body of the writer thread: batch queued lines into the file and flush on time or size"""
+        pending_bytes = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                line = ""
+
+            # Take everything else that is already queued in the same batch
+            batch = []
+            finished = line is _CLOSE
+            if line:
+                batch.append(line)
+            while not finished:
+                try:
+                    line = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is _CLOSE:
+                    finished = True
+                else:
+                    batch.append(line)
+
+            if batch:
+                data = "".join(batch)
+                self.file.write(data)
+                pending_bytes += len(data)
+
+            if finished:
+                self.file.flush()
+                return
+            if pending_bytes and (pending_bytes >= self.flush_bytes
+                                  or time.monotonic() - last_flush >= self.flush_interval):
+                self.file.flush()
+                pending_bytes = 0
+                last_flush = time.monotonic()
+            elif not pending_bytes:
+                last_flush = time.monotonic()
+
+    def close(self):
+        """Write out everything still queued and close the file"""
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(_CLOSE)
+        self.writer.join()
+        self.file.close()
+        if self.dropped:
+            print(f"Logger for peer {self.peer_id} dropped {self.dropped} events because its queue was full")
             
     def log_tcp_connection(self, other_peer_id="1002", self_initiated=False):
         """Log TCP connection establishment"""
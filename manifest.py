@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Per-piece hash manifest for the shared file.
+
+The manifest lists one digest (SHA-1 or SHA-256) per piece. It is generated
+once for the seeder's copy of the file, hashing piece ranges in a process pool
+so every core is used, and cached next to the file as <file>.manifest. The
+cached copy is reused as long as the file size, modification time, piece size
+and algorithm still match. Leechers point ManifestFile in Common.cfg at it and
+check each received piece against it before writing it.
+
+Hashing reads from a "source": either a file path, or a list of (path, size)
+pairs laid end to end (a multi-file share, see share.py), in which case a
+piece can span the end of one file and the start of the next.
+
+Usage: python manifest.py FILE (--piece-size PIECE_SIZE | --config Common.cfg)
+                          [--algorithm {sha1,sha256}] [--workers N] [--output PATH]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+
+from resume import save_json
+
+ALGORITHMS = ("sha1", "sha256")
+DEFAULT_ALGORITHM = "sha1"
+MANIFEST_SUFFIX = ".manifest"
+BATCHES_PER_WORKER = 4  # Smaller batches keep every worker busy until the end
+
+
+def manifest_path(file_path):
+    """Where the cached manifest of a file lives"""
+    return file_path + MANIFEST_SUFFIX
+
+
+class ConcatenatedReader:
+    """Read-only file object over several files laid end to end"""
+    def __init__(self, files):
+        self.files = files  # [(path, size), ...]
+        self.starts = []
+        total = 0
+        for _, size in files:
+            self.starts.append(total)
+            total += size
+        self.size = total
+        self.position = 0
+        self.handles = {}
+
+    def seek(self, offset):
+        self.position = offset
+
+    def read(self, length):
+        chunks = []
+        length = min(length, self.size - self.position)
+        while length > 0:
+            index = bisect_right(self.starts, self.position) - 1
+            path, size = self.files[index]
+            file_offset = self.position - self.starts[index]
+            count = min(length, size - file_offset)
+            if count > 0:
+                handle = self.handles.get(index)
+                if handle is None:
+                    handle = self.handles[index] = open(path, 'rb')
+                handle.seek(file_offset)
+                chunk = handle.read(count)
+                if not chunk:
+                    break  # File shorter than listed
+                chunks.append(chunk)
+                count = len(chunk)
+            self.position += count
+            length -= count
+        return b"".join(chunks)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_source(source):
+    """Open a file path, or a list of (path, size) pairs, for reading"""
+    if isinstance(source, str):
+        return open(source, 'rb')
+    return ConcatenatedReader(source)
+
+
+def hash_piece_range(source, piece_size, algorithm, first_piece, last_piece):
+    """Hash pieces first_piece..last_piece-1 of a source; runs in a worker process"""
+    digests = []
+    with open_source(source) as f:
+        f.seek(first_piece * piece_size)
+        for _ in range(first_piece, last_piece):
+            digests.append(hashlib.new(algorithm, f.read(piece_size)).digest())
+    return digests
+
+
+def hash_file(source, piece_size, algorithm, num_pieces, workers=None):
+    """Digest of each of the first num_pieces pieces, hashed across a process pool"""
+    workers = workers or os.cpu_count() or 1
+    batch = max(1, ceil(num_pieces / (workers * BATCHES_PER_WORKER)))
+    ranges = [(start, min(start + batch, num_pieces)) for start in range(0, num_pieces, batch)]
+
+    digests = []
+    if workers == 1 or len(ranges) <= 1:
+        for first, last in ranges:
+            digests.extend(hash_piece_range(source, piece_size, algorithm, first, last))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(hash_piece_range, source, piece_size, algorithm, first, last)
+                       for first, last in ranges]
+            for future in futures:
+                digests.extend(future.result())
+    return digests
+
+
+class Manifest:
+    def __init__(self, file_size, piece_size, algorithm, digests, file_mtime=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.algorithm = algorithm
+        self.digests = digests
+        self.file_mtime = file_mtime
+        self.num_pieces = ceil(file_size / piece_size)
+        if len(digests) != self.num_pieces:
+            raise ValueError(f"Manifest has {len(digests)} digests for {self.num_pieces} pieces")
+
+    def verify(self, piece_index, data):
+        """True if data hashes to the digest recorded for the piece"""
+        return hashlib.new(self.algorithm, data).digest() == self.digests[piece_index]
+
+    def matches(self, file_size, piece_size):
+        return self.file_size == file_size and self.piece_size == piece_size
+
+    @classmethod
+    def generate(cls, file_path, piece_size, algorithm=DEFAULT_ALGORITHM, workers=None):
+        """Hash every piece of a file across a process pool"""
+        stat = os.stat(file_path)
+        num_pieces = ceil(stat.st_size / piece_size)
+        digests = hash_file(file_path, piece_size, algorithm, num_pieces, workers)
+        return cls(stat.st_size, piece_size, algorithm, digests, stat.st_mtime)
+
+    def verified_pieces(self, source, workers=None):
+        """Indices of the pieces of a (possibly partial) file or share whose contents match the manifest"""
+        digests = hash_file(source, self.piece_size, self.algorithm, self.num_pieces, workers)
+        return [i for i, digest in enumerate(digests) if digest == self.digests[i]]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(data["file_size"], data["piece_size"], data["algorithm"],
+                   [bytes.fromhex(d) for d in data["pieces"]], data.get("file_mtime"))
+
+    def save(self, path):
+        data = {
+            "file_size": self.file_size,
+            "piece_size": self.piece_size,
+            "algorithm": self.algorithm,
+            "file_mtime": self.file_mtime,
+            "pieces": [d.hex() for d in self.digests],
+        }
+        # A reader never sees a half-written manifest, even after a crash
+        save_json(path, data)
+
+
+def load_or_generate(file_path, piece_size, algorithm=DEFAULT_ALGORITHM, workers=None, output=None):
+    """Return the cached manifest of a file if it is still valid, otherwise hash the file and cache it"""
+    path = output or manifest_path(file_path)
+    stat = os.stat(file_path)
+    if os.path.exists(path):
+        try:
+            cached = Manifest.load(path)
+            if (cached.matches(stat.st_size, piece_size) and cached.algorithm == algorithm
+                    and cached.file_mtime == stat.st_mtime):
+                print(f"Using cached manifest {path}")
+                return cached
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable manifest {path}: {e}")
+
+    manifest = Manifest.generate(file_path, piece_size, algorithm, workers)
+    manifest.save(path)
+    print(f"Wrote manifest {path} ({manifest.num_pieces} pieces, {algorithm})")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the per-piece hash manifest of a file")
+    parser.add_argument("file", help="File to hash (the seeder's copy)")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--piece-size", type=int, help="Piece size in bytes")
+    group.add_argument("--config", help="Read PieceSize from this Common.cfg")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default=DEFAULT_ALGORITHM)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument("--output", default=None, help=f"Manifest path (default: FILE{MANIFEST_SUFFIX})")
+    args = parser.parse_args()
+
+    piece_size = args.piece_size
+    if args.config:
+        from config import Config
+        piece_size = Config(args.config).piece_size
+
+    load_or_generate(args.file, piece_size, args.algorithm, args.workers, args.output)
+
+
+if __name__ == "__main__":
+    main()
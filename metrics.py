@@ -0,0 +1,279 @@
+"""
+In-process metrics registry with a local HTTP endpoint.
+
+Counters and histograms are updated on the hot path: callers keep a reference
+to a (labelled) child and call inc()/observe(). Each child keeps one cell per
+updating thread, and only that thread ever writes its cell, so an update is a
+dict lookup and an add with no lock; readers sum the cells. Values that
+already live elsewhere in the client (queue depths, choke state, peer counts)
+are not copied into the registry at all; they are registered as callbacks and
+read only when someone scrapes.
+
+MetricsServer serves the registry on 127.0.0.1:
+    /metrics       Prometheus text exposition format
+    /metrics.json  JSON snapshot
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from threading import get_ident
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Request-to-piece latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATE_MIN_INTERVAL = 1.0  # Seconds a rate is averaged over at least
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterChild:
+    __slots__ = ("cells",)
+
+    def __init__(self):
+        self.cells = {}  # thread ident -> [value]
+
+    def inc(self, amount=1):
+        try:
+            self.cells[get_ident()][0] += amount
+        except KeyError:
+            self.cells[get_ident()] = [amount]
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self.cells.values()))
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "cells")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.cells = {}  # thread ident -> bucket counts (last one +Inf), then the sum
+
+    def observe(self, value):
+        try:
+            cell = self.cells[get_ident()]
+        except KeyError:
+            cell = self.cells[get_ident()] = [0] * (len(self.bounds) + 1) + [0.0]
+        cell[bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def read(self):
+        """(bucket counts, sum) over all threads"""
+        totals = [0] * (len(self.bounds) + 1) + [0.0]
+        for cell in list(self.cells.values()):
+            for i, count in enumerate(cell):
+                totals[i] += count
+        return totals[:-1], totals[-1]
+
+
+class Metric:
+    """A named metric with one child per combination of label values"""
+    def __init__(self, name, help_text, label_names, make_child):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.make_child = make_child
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """Child for these label values; look it up once and keep it, the lookup is not hot-path cheap"""
+        values = tuple(str(v) for v in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.make_child()
+            return child
+
+    def items(self):
+        with self.lock:
+            return list(self.children.items())
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names, CounterChild)
+        # Make the unlabelled child right away so an unlabelled counter always shows up
+        if not self.label_names:
+            self.labels()
+
+    def inc(self, amount=1):
+        """Increment the unlabelled counter"""
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self.items():
+            yield self.name, _format_labels(self.label_names, values), child.value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help_text, label_names, lambda: HistogramChild(self.bounds))
+        if not self.label_names:
+            self.labels()
+
+    def samples(self):
+        for values, child in self.items():
+            counts, total = child.read()
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield self.name + "_bucket", _format_labels(self.label_names, values, le), cumulative
+            yield self.name + "_sum", _format_labels(self.label_names, values), total
+            yield self.name + "_count", _format_labels(self.label_names, values), cumulative
+
+    def snapshot_child(self, child):
+        counts, total = child.read()
+        return {"buckets": {_format_value(b): c for b, c in zip(self.bounds + (float("inf"),), counts)},
+                "sum": total, "count": sum(counts)}
+
+
+class CallbackGauge:
+    """Gauge whose values are produced by a function at scrape time"""
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, label_names, callback):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.callback = callback  # Returns [(label values tuple, value), ...]
+
+    def items(self):
+        return [(tuple(str(v) for v in values), value) for values, value in self.callback()]
+
+    def samples(self):
+        for values, value in self.items():
+            yield self.name, _format_labels(self.label_names, values), value
+
+
+class RateGauge(CallbackGauge):
+    """Per-second rate of a counter child, averaged since the previous read at least RATE_MIN_INTERVAL ago"""
+    def __init__(self, name, help_text, counter_child):
+        super().__init__(name, help_text, (), self.read_rate)
+        self.counter_child = counter_child
+        self.last_time = time.monotonic()
+        self.last_value = 0
+        self.rate = 0.0
+        self.lock = threading.Lock()
+
+    def read_rate(self):
+        with self.lock:
+            now = time.monotonic()
+            value = self.counter_child.value
+            if now - self.last_time >= RATE_MIN_INTERVAL:
+                self.rate = (value - self.last_value) / (now - self.last_time)
+                self.last_time = now
+                self.last_value = value
+            return [((), self.rate)]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge_callback(self, name, help_text, callback, label_names=()):
+        return self.register(CallbackGauge(name, help_text, label_names, callback))
+
+    def rate(self, name, help_text, counter_child):
+        return self.register(RateGauge(name, help_text, counter_child))
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """All metrics as a JSON-friendly dict: name -> value, or label value -> value for labelled ones"""
+        with self.lock:
+            metrics = list(self.metrics)
+        result = {}
+        for metric in metrics:
+            entries = {}
+            for values, child in metric.items():
+                if isinstance(metric, Histogram):
+                    value = metric.snapshot_child(child)
+                elif isinstance(metric, Counter):
+                    value = child.value
+                else:
+                    value = child
+                entries[",".join(values)] = value
+            result[metric.name] = entries[""] if not metric.label_names and "" in entries else entries
+        return result
+
+
+class MetricsServer:
+    """Serves a registry over HTTP on a background thread"""
+    def __init__(self, registry, port, host="127.0.0.1"):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry_ref.render_prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(registry_ref.snapshot(), indent=2).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would flood stdout
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"Serving metrics on http://127.0.0.1:{self.port}/metrics and /metrics.json")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
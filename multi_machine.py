@@ -32,7 +32,17 @@ def create_common_config(file_path, file_name=None, file_size=20971520, piece_si
         "OptimisticUnchokingInterval": 15,
         "FileName": file_name if file_name else "TheFile.dat",
         "FileSize": file_size,
-        "PieceSize": piece_size
+        "PieceSize": piece_size,
+        "BlockSize": 16384,
+        "MaxOutstandingRequests": 16,
+        "PieceSelection": "rarest-first",
+        "EndGameThreshold": 8,
+        "RateHalfLife": 10,
+        "ChokeHysteresis": 0.2,
+        "HaveBatchDelay": 0.05,
+        "MaxConcurrentDials": 8,
+        "DialBackoffMax": 60,
+        "FlushPolicy": "periodic"
     }
     
     with open(file_path, 'w') as f:
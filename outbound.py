@@ -0,0 +1,102 @@
+"""
+Per-peer outbound queue.
+
+Everything sent to a peer after the handshake goes through its queue, and a
+single writer owns the sending side of the socket: a thread per peer in the
+threaded engine, a task on the event loop in the asyncio engine. Producers
+(receive threads, the choking rounds, have broadcasts from other peers'
+threads) only append to the queue, so they never wait on another peer's
+socket.
+
+Control messages go ahead of queued blocks, and all the control frames waiting
+when the writer comes back for more are sent in one call. Blocks are queued as
+(piece index, begin, length) and read from disk only when their turn comes, so
+a queued block that is cancelled, or dropped because the peer was choked,
+costs nothing.
+"""
+
+import threading
+from collections import deque
+
+
+class OutboundQueue:
+    def __init__(self):
+        self.control = deque()  # Encoded control frames
+        self.blocks = deque()  # (piece index, begin, length) of blocks to upload
+        self.ready = threading.Condition()
+        self.closed = False
+        self.on_ready = None  # Called after every put, for writers that cannot wait on the condition
+
+    def put_control(self, frame):
+        with self.ready:
+            if self.closed:
+                return False
+            self.control.append(frame)
+            self.ready.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def put_block(self, block):
+        """Queue a block for upload; a block that is already queued is not queued twice"""
+        with self.ready:
+            if self.closed or block in self.blocks:
+                return False
+            self.blocks.append(block)
+            self.ready.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def cancel_block(self, block):
+        """Drop a queued block; returns False if it is not queued (already sent, or never requested)"""
+        with self.ready:
+            try:
+                self.blocks.remove(block)
+                return True
+            except ValueError:
+                return False
+
+    def clear_blocks(self):
+        """Drop every queued block and return them"""
+        with self.ready:
+            dropped = list(self.blocks)
+            self.blocks.clear()
+            return dropped
+
+    def _take(self):
+        if self.control:
+            frames = b"".join(self.control)
+            self.control.clear()
+            return frames, None
+        if self.blocks:
+            return None, self.blocks.popleft()
+        return None
+
+    def take(self):
+        """Next thing to send, as (control frames, None) or (None, block); None if nothing is waiting"""
+        with self.ready:
+            return None if self.closed else self._take()
+
+    def wait(self):
+        """Like take, but blocks until something is waiting; returns None once the queue is closed"""
+        with self.ready:
+            while not self.closed:
+                item = self._take()
+                if item is not None:
+                    return item
+                self.ready.wait()
+            return None
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.control.clear()
+            self.blocks.clear()
+            self.ready.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+    def pending(self):
+        with self.ready:
+            return len(self.control), len(self.blocks)
@@ -0,0 +1,97 @@
+"""
+Block bookkeeping for pieces being downloaded.
+
+Pieces are fetched in blocks of BlockSize bytes, each requested on its own, so
+the blocks of one piece can come from several peers at once. A PartialPiece
+exists from the moment the first of its blocks is requested until the whole
+piece is stored. It tracks, per block, how many requests for it are in flight
+and whether it has arrived; blocks are written straight into the piece store
+as they arrive, and the piece is verified and announced only once every block
+has been written.
+
+A piece that fails verification can only be blamed on its sender if one peer
+sent every block. When blocks came from several peers, the piece is fetched
+again from a single peer (single_source), so that a repeat failure points at
+the culprit instead of at everyone who took part.
+
+Like the piece picker, partial pieces are not locked on their own; the client
+uses them under its bitfield_lock.
+"""
+
+from math import ceil
+
+
+class PartialPiece:
+    def __init__(self, piece_index, piece_length, block_size):
+        self.piece_index = piece_index
+        self.piece_length = piece_length
+        self.block_size = block_size
+        self.num_blocks = ceil(piece_length / block_size)
+        self.requested = [0] * self.num_blocks  # Requests in flight per block (more than one in end game)
+        self.received = [False] * self.num_blocks  # Set by the arrival that writes the block
+        self.num_written = 0
+        self.senders = set()  # Peers that sent blocks; a lone sender is blamed if the piece fails verification
+        self.single_source = False  # Set once a piece with blocks from several peers failed verification
+        self.owner = None  # While single_source, the peer all blocks are requested from
+
+    def begin(self, block):
+        return block * self.block_size
+
+    def block_length(self, block):
+        """Length of a block; only the last one can be shorter than BlockSize"""
+        return min(self.block_size, self.piece_length - block * self.block_size)
+
+    def block_at(self, begin, length):
+        """The block starting at begin, or None if begin and length do not describe one of ours"""
+        if begin % self.block_size or not 0 <= begin < self.piece_length:
+            return None
+        block = begin // self.block_size
+        return block if length == self.block_length(block) else None
+
+    def free_blocks(self):
+        """Blocks nobody is fetching and that have not arrived"""
+        return [b for b in range(self.num_blocks) if not self.received[b] and not self.requested[b]]
+
+    def missing_blocks(self):
+        """Blocks that have not arrived, whether or not they are being fetched"""
+        return [b for b in range(self.num_blocks) if not self.received[b]]
+
+    def available_to(self, peer):
+        """Whether blocks of this piece may be requested from peer"""
+        return not self.single_source or self.owner is None or self.owner is peer
+
+    def on_request(self, block, peer):
+        self.requested[block] += 1
+        if self.single_source:
+            self.owner = peer
+
+    def release(self, block):
+        """A request for the block was dropped (choke, timeout, cancel or disconnect)"""
+        if self.requested[block] > 0:
+            self.requested[block] -= 1
+        if self.owner is not None and not any(self.requested):
+            # The owner stopped fetching the piece; let another peer take it over
+            self.owner = None
+
+    def claim(self, block, peer):
+        """Take an arrived block for writing; False if another copy already got there first"""
+        if self.received[block]:
+            return False
+        self.received[block] = True
+        self.requested[block] = 0  # Any other requests for it are cancelled
+        self.senders.add(peer)
+        return True
+
+    def block_written(self):
+        """Count a claimed block as written; returns True once the whole piece is on disk"""
+        self.num_written += 1
+        return self.num_written == self.num_blocks
+
+    def reset(self):
+        """Start over after the assembled piece failed verification"""
+        self.single_source = len(self.senders) > 1
+        self.owner = None
+        self.requested = [0] * self.num_blocks
+        self.received = [False] * self.num_blocks
+        self.num_written = 0
+        self.senders = set()
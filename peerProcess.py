@@ -300,12 +300,13 @@
 
 from config import Config
 from client import Client
+from async_client import AsyncClient
 import sys
 import socket
 import time
 import os
-import shutil
 import argparse
+import signal
 
 CONFIG_FILEPATH = "project_config_file_small/project_config_file_small/Common.cfg"
 PEER_PROCESS_FILEPATH = "project_config_file_small/project_config_file_small/PeerInfo.cfg"
@@ -327,6 +328,11 @@ def read_peer_info(filepath):
                 peers.append(PeerProcess(params[0], params[1], params[2], params[3]))
     return peers
 
+def exit_on_sigterm(signum, frame):
+    """Raise SystemExit once; later SIGTERMs are ignored while shutting down"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="P2P File Sharing Peer Process")
@@ -334,6 +340,12 @@ def main():
     parser.add_argument("--file", help="Custom file to share instead of the default specified in Common.cfg")
     parser.add_argument("--config", help="Path to Common.cfg (default: project_config_file_small/project_config_file_small/Common.cfg)")
     parser.add_argument("--peer-info", help="Path to PeerInfo.cfg (default: project_config_file_small/project_config_file_small/PeerInfo.cfg)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="Networking engine: a thread per connection, or one asyncio event loop for all connections (default: threads)")
+    parser.add_argument("--trace", nargs="?", const="", default=None, metavar="PATH",
+                        help="Record a binary event trace for trace_analyzer.py (default path: trace_peer_<peer_id>.bin)")
+    parser.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                        help="Serve live metrics on http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json")
     
     args = parser.parse_args()
     peer_id = args.peer_id
@@ -386,13 +398,7 @@ def main():
                 print(f"Found source file at: {path}")
                 break
                 
-        if file_found:
-            # Ensure file is in peer directory
-            dest_file = os.path.join(peer_dir, config.file_name)
-            if source_path != dest_file:
-                shutil.copy2(source_path, dest_file)
-                print(f"Copied {source_path} to {dest_file}")
-        else:
+        if not file_found:
             print(f"WARNING: Peer {peer_id} is supposed to have file {config.file_name}, but it doesn't exist in any expected location")
             print(f"Looked in: {file_paths}")
             current_peer.has_file = False
@@ -419,14 +425,23 @@ def main():
         ip = "127.0.0.1"  # Fallback to localhost
     
     # Create a client instance
-    client = Client(config_filepath, ip, port, peer_id)
+    client_class = AsyncClient if args.engine == "asyncio" else Client
+    client = client_class(config_filepath, ip, port, peer_id)
+    if args.trace is not None:
+        client.start_trace(args.trace or f"trace_peer_{peer_id}.bin")
+    if args.metrics_port is not None:
+        client.start_metrics_server(args.metrics_port)
     
     # Set file status and update with custom filename if provided
     if current_peer.has_file:
         if custom_file:
             # If using a custom file, make sure the client knows about it
             client.config.file_name = custom_file
-        client.has_file()
+        # Links the file (or share directory) into the peer directory, or serves it from where it was found
+        client.has_file(source_path)
+    else:
+        # Carry on from whatever an earlier run of this peer already downloaded
+        client.resume_download()
     
     # Find peers that started before this one to connect to
     other_peers = []
@@ -449,6 +464,9 @@ def main():
             other_ip = "localhost"
         other_peers.append([other_ip, peer.port])
     
+    # Treat kill like Ctrl-C, so buffered log lines and resume state are written before exiting
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
     # Start the client
     try:
         print(f"Starting peer {peer_id} on {ip}:{port} with file {config.file_name}")
@@ -462,12 +480,12 @@ def main():
             # Check if all peers have the complete file
             all_complete = True
             for peer in client.peers:
-                if '0' in peer.bitfield:
+                if not peer.bitfield.is_complete():
                     all_complete = False
                     break
             
             # Also check if we have the complete file
-            if '0' in client.bitfield:
+            if not client.bitfield.is_complete():
                 all_complete = False
             
             if all_complete and len(client.peers) == len(peers) - 1:
@@ -477,6 +495,8 @@ def main():
     except KeyboardInterrupt:
         print("Peer process interrupted by user")
     finally:
+        # A second SIGTERM (e.g. from a timeout wrapper) must not interrupt shutdown or the log flush
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         # Shutdown client gracefully
         client.shutdown()
         print(f"Peer {peer_id} shutdown complete")
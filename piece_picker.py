@@ -0,0 +1,130 @@
+"""
+Piece selection policies.
+
+RarestFirstPicker keeps, for every piece we still need, how many connected
+peers have it, with the pieces grouped into one bucket per availability
+count. Bitfield, have and peer removal events move a piece between buckets in
+O(1), and picking walks the buckets from the rarest up, so it only looks at
+as many pieces as it takes to fill the request window instead of scanning the
+whole bitfield.
+
+RandomPicker is the original behaviour: a uniform random choice among the
+pieces the peer has and we still need.
+
+Pickers are not locked on their own; the client calls them under its
+bitfield_lock, the same lock that guards its bitfield and pieces_requested.
+"""
+
+import random
+
+RAREST_FIRST = "rarest-first"
+RANDOM = "random"
+PIECE_SELECTION_MODES = (RAREST_FIRST, RANDOM)
+
+
+class PiecePicker:
+    """Interface shared by the piece selection policies"""
+    def __init__(self, local_bitfield):
+        self.local_bitfield = local_bitfield
+
+    def add_peer_bitfield(self, bitfield):
+        """A peer announced its bitfield"""
+
+    def remove_peer_bitfield(self, bitfield):
+        """A peer with this bitfield disconnected"""
+
+    def add_have(self, piece_index):
+        """A peer announced a piece it did not have before"""
+
+    def piece_completed(self, piece_index):
+        """We now have this piece and never need to pick it again"""
+
+    def pick(self, peer_bitfield, count, pieces_requested):
+        """Choose up to count pieces that the peer has, we need and nobody is fetching"""
+        raise NotImplementedError
+
+
+class RandomPicker(PiecePicker):
+    def pick(self, peer_bitfield, count, pieces_requested):
+        wanted = self.local_bitfield.wanted_from(peer_bitfield)
+        desired_pieces = [i for i in wanted.pieces() if not pieces_requested[i]]
+        return random.sample(desired_pieces, min(count, len(desired_pieces)))
+
+
+class RarestFirstPicker(PiecePicker):
+    def __init__(self, local_bitfield):
+        super().__init__(local_bitfield)
+        num_pieces = len(local_bitfield)
+        self.availability = [0] * num_pieces
+        # buckets[k] holds the pieces we need that exactly k peers have; position[i] is i's slot in its bucket
+        self.buckets = [[]]
+        self.position = [-1] * num_pieces
+        for piece_index in range(num_pieces):
+            if not local_bitfield.has(piece_index):
+                self._insert(piece_index)
+
+    def _insert(self, piece_index):
+        level = self.availability[piece_index]
+        while len(self.buckets) <= level:
+            self.buckets.append([])
+        bucket = self.buckets[level]
+        self.position[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def _remove(self, piece_index):
+        # Swap the last piece of the bucket into the freed slot
+        bucket = self.buckets[self.availability[piece_index]]
+        slot = self.position[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[slot] = last
+            self.position[last] = slot
+        self.position[piece_index] = -1
+
+    def _adjust(self, piece_index, delta):
+        tracked = self.position[piece_index] >= 0
+        if tracked:
+            self._remove(piece_index)
+        self.availability[piece_index] = max(0, self.availability[piece_index] + delta)
+        if tracked:
+            self._insert(piece_index)
+
+    def add_peer_bitfield(self, bitfield):
+        for piece_index in bitfield.pieces():
+            self._adjust(piece_index, 1)
+
+    def remove_peer_bitfield(self, bitfield):
+        for piece_index in bitfield.pieces():
+            self._adjust(piece_index, -1)
+
+    def add_have(self, piece_index):
+        self._adjust(piece_index, 1)
+
+    def piece_completed(self, piece_index):
+        if self.position[piece_index] >= 0:
+            self._remove(piece_index)
+
+    def pick(self, peer_bitfield, count, pieces_requested):
+        """Rarest pieces first; each bucket is scanned from a random slot to break ties"""
+        chosen = []
+        for bucket in self.buckets[1:]:
+            size = len(bucket)
+            if size == 0:
+                continue
+            start = random.randrange(size)
+            for offset in range(size):
+                piece_index = bucket[(start + offset) % size]
+                if not pieces_requested[piece_index] and peer_bitfield.has(piece_index):
+                    chosen.append(piece_index)
+                    if len(chosen) == count:
+                        return chosen
+        return chosen
+
+
+def make_piece_picker(mode, local_bitfield):
+    """Build the picker named by the PieceSelection config key"""
+    if mode == RANDOM:
+        return RandomPicker(local_bitfield)
+    if mode != RAREST_FIRST:
+        print(f"Unknown PieceSelection {mode}, using {RAREST_FIRST}")
+    return RarestFirstPicker(local_bitfield)
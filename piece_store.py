@@ -0,0 +1,284 @@
+"""
+On-disk piece storage for the downloaded file.
+
+The file is created at its final size once (fallocate where the OS supports
+it, a sparse file otherwise) and memory-mapped, so each received block is
+copied straight into place without reopening or seeking the file, and
+nothing but the page cache holds piece data. A piece is assembled in place
+from its blocks, whichever peers they came from.
+
+A store can also span several files laid end to end (a multi-file share, see
+share.py). Pieces are numbered across the whole span, so a piece may cover the
+end of one file and the start of the next; reads, writes and uploads split it
+at the file boundaries.
+
+Written ranges are remembered until the next flush, which coalesces them
+(adjacent blocks and pieces become one range) and msyncs only those ranges,
+so flushing costs in proportion to what changed rather than to the file
+size. When flushes happen is up to the client's FlushPolicy.
+
+A seeder's store is opened read-only: nothing is created, resized or
+preallocated, the file is only stat'ed and mapped, so opening it takes the
+same time for any file size and pages are read in only as blocks are served.
+This also keeps a seeder from ever writing through a hardlink to the
+original file (see file_link.py).
+
+Uploads go the other way with os.sendfile: the kernel copies the block range
+from the file to the socket without it passing through Python. Where
+sendfile is missing or the socket is not a real one, the block is read into
+a buffer and sent with sendall instead.
+"""
+
+import errno
+import mmap
+import os
+import socket
+import threading
+from bisect import bisect_right
+from math import ceil
+
+HAS_SENDFILE = hasattr(os, "sendfile")
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+# FlushPolicy values: sync written pieces at every resume checkpoint, only once the download is complete, or never
+FLUSH_PERIODIC = "periodic"
+FLUSH_ON_COMPLETE = "on-complete"
+FLUSH_NONE = "none"
+FLUSH_POLICIES = (FLUSH_PERIODIC, FLUSH_ON_COMPLETE, FLUSH_NONE)
+
+DIRTY_RANGE_LIMIT = 1024  # Written ranges a file remembers before they are merged, keeping the list bounded
+
+# sendfile errors meaning "not supported for this file or socket" rather than a broken connection
+SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, getattr(errno, "ENOTSUP", errno.EINVAL),
+                        getattr(errno, "EOPNOTSUPP", errno.EINVAL)}
+
+
+def merge_ranges(ranges, granularity=1):
+    """Sort (start, end) ranges and merge overlapping or adjacent ones, starts rounded down to granularity"""
+    merged = []
+    for start, end in sorted(ranges):
+        start -= start % granularity
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class StoredFile:
+    """One preallocated, memory-mapped file of a store"""
+    def __init__(self, path, size, writable=True, track_dirty=True):
+        self.path = path
+        self.size = size
+        self.writable = writable
+        self.track_dirty = writable and track_dirty  # Off when nothing will ever flush the ranges
+        self.dirty = []  # (start, end) ranges written since the last flush
+        self.dirty_lock = threading.Lock()
+        self.file = None  # File object over fd, made for asyncio's loop.sendfile on first use
+        if writable:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            self.preallocate()
+            self.map = mmap.mmap(self.fd, size) if size > 0 else None
+        else:
+            self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            actual_size = os.fstat(self.fd).st_size
+            if actual_size != size:
+                os.close(self.fd)
+                raise ValueError(f"{path} has {actual_size} bytes, expected {size}")
+            self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ) if size > 0 else None
+
+    def preallocate(self):
+        """Give the file its final size, reserving the blocks up front if possible"""
+        current_size = os.fstat(self.fd).st_size
+        if current_size == self.size:
+            return
+        if current_size < self.size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+                return
+            except OSError as e:
+                # e.g. filesystems without fallocate support; a sparse file works too
+                print(f"fallocate failed for {self.path}, using a sparse file: {e}")
+        os.ftruncate(self.fd, self.size)
+
+    def mark_dirty(self, offset, count):
+        """Remember a written range; the list stays at most DIRTY_RANGE_LIMIT long however many blocks arrive"""
+        if not self.track_dirty:
+            return
+        end = offset + count
+        with self.dirty_lock:
+            if self.dirty:
+                last_start, last_end = self.dirty[-1]
+                if offset <= last_end and end >= last_start:
+                    # Blocks usually arrive in order within a piece; extend the range instead of adding one
+                    self.dirty[-1] = (min(offset, last_start), max(end, last_end))
+                    return
+            self.dirty.append((offset, end))
+            if len(self.dirty) > DIRTY_RANGE_LIMIT:
+                merged = merge_ranges(self.dirty)
+                if len(merged) > DIRTY_RANGE_LIMIT // 2:
+                    # Too scattered to list; one covering range flushes them all (msync skips clean pages)
+                    merged = [[merged[0][0], merged[-1][1]]]
+                self.dirty = [tuple(r) for r in merged]
+
+    def flush(self):
+        """msync the ranges written since the last flush, merged into runs; returns (bytes, runs) flushed"""
+        with self.dirty_lock:
+            ranges, self.dirty = self.dirty, []
+        if self.map is None or not self.writable or not ranges:
+            return 0, 0
+        # msync needs an aligned start
+        runs = merge_ranges(ranges, mmap.ALLOCATIONGRANULARITY)
+        for start, end in runs:
+            self.map.flush(start, end - start)
+        return sum(end - start for start, end in runs), len(runs)
+
+    def sync(self):
+        """Flush, then wait until the data is on stable storage"""
+        flushed = self.flush()
+        if self.writable:
+            os.fsync(self.fd)
+        return flushed
+
+    def file_object(self):
+        """A binary file object sharing fd (sendfile takes explicit offsets, so the shared position does not matter)"""
+        if self.file is None:
+            self.file = open(self.fd, "rb", buffering=0, closefd=False)
+        return self.file
+
+    def close(self, flush=True):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.map is not None:
+            if flush:
+                self.flush()
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PieceStore:
+    def __init__(self, files, piece_size, use_sendfile=HAS_SENDFILE, writable=True, track_dirty=True):
+        """files is a list of (path, size) pairs; a single-file download is a list of one"""
+        self.files = []
+        try:
+            for path, size in files:
+                self.files.append(StoredFile(path, size, writable, track_dirty))
+        except (OSError, ValueError):
+            self.close()
+            raise
+        self.starts = []  # Offset of each file in the piece space
+        total = 0
+        for stored in self.files:
+            self.starts.append(total)
+            total += stored.size
+        self.file_size = total
+        self.piece_size = piece_size
+        self.num_pieces = ceil(total / piece_size)
+        self.use_sendfile = use_sendfile and HAS_SENDFILE
+
+    def piece_offset(self, piece_index):
+        return piece_index * self.piece_size
+
+    def piece_length(self, piece_index):
+        """Length of a piece; only the last one can be shorter than PieceSize"""
+        return min(self.piece_size, self.file_size - piece_index * self.piece_size)
+
+    def spans(self, offset, length):
+        """(file, offset in file, length) for each file a byte range of the piece space falls in"""
+        index = bisect_right(self.starts, offset) - 1
+        while length > 0:
+            stored = self.files[index]
+            file_offset = offset - self.starts[index]
+            count = min(length, stored.size - file_offset)
+            if count > 0:
+                yield stored, file_offset, count
+                offset += count
+                length -= count
+            index += 1
+
+    def check_block(self, piece_index, begin, length):
+        """Raise ValueError unless the block lies inside the piece"""
+        piece_length = self.piece_length(piece_index)
+        if begin < 0 or length < 0 or begin + length > piece_length:
+            raise ValueError(f"Block at {begin} with {length} bytes is outside piece {piece_index} "
+                             f"({piece_length} bytes)")
+
+    def write_block(self, piece_index, begin, data):
+        """Copy a block of a piece into its place in the file(s)"""
+        self.check_block(piece_index, begin, len(data))
+        position = 0
+        for stored, file_offset, count in self.spans(self.piece_offset(piece_index) + begin, len(data)):
+            stored.map[file_offset:file_offset + count] = data[position:position + count]
+            stored.mark_dirty(file_offset, count)
+            position += count
+
+    def write_piece(self, piece_index, data):
+        """Copy a whole piece into its place in the file(s)"""
+        length = self.piece_length(piece_index)
+        if len(data) != length:
+            raise ValueError(f"Piece {piece_index} has {len(data)} bytes, expected {length}")
+        self.write_block(piece_index, 0, data)
+
+    def read_block(self, piece_index, begin, length):
+        """Return a copy of a block's bytes"""
+        self.check_block(piece_index, begin, length)
+        chunks = [stored.map[file_offset:file_offset + count]
+                  for stored, file_offset, count in self.spans(self.piece_offset(piece_index) + begin, length)]
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def read_piece(self, piece_index):
+        """Return a copy of a piece's bytes"""
+        return self.read_block(piece_index, 0, self.piece_length(piece_index))
+
+    def send_piece(self, sock, piece_index, header=b""):
+        """Send header followed by a whole piece"""
+        self.send_block(sock, piece_index, 0, self.piece_length(piece_index), header)
+
+    def send_block(self, sock, piece_index, begin, length, header=b""):
+        """Send header followed by a block's bytes, straight from the file(s) when sendfile is usable"""
+        if not (self.use_sendfile and isinstance(sock, socket.socket)):
+            sock.sendall(header + self.read_block(piece_index, begin, length))
+            return
+
+        self.check_block(piece_index, begin, length)
+        # MSG_MORE lets the kernel put the header in the same segment as the start of the block
+        sock.sendall(header, MSG_MORE)
+        for stored, offset, remaining in self.spans(self.piece_offset(piece_index) + begin, length):
+            while remaining > 0 and self.use_sendfile:
+                try:
+                    sent = os.sendfile(sock.fileno(), stored.fd, offset, remaining)
+                except OSError as e:
+                    if e.errno not in SENDFILE_UNSUPPORTED:
+                        raise
+                    print(f"sendfile not supported for {stored.path}, using buffered uploads: {e}")
+                    self.use_sendfile = False
+                    break
+                if sent == 0:
+                    raise ConnectionError(f"Connection closed while sending piece {piece_index}")
+                offset += sent
+                remaining -= sent
+
+            if remaining > 0:
+                sock.sendall(os.pread(stored.fd, remaining, offset))
+
+    def flush(self):
+        """Write the blocks written since the last flush back to the file(s); returns (bytes, runs) flushed"""
+        totals = [stored.flush() for stored in self.files]
+        return sum(n for n, _ in totals), sum(runs for _, runs in totals)
+
+    def sync(self):
+        """Flush and fsync the file(s); returns (bytes, runs) flushed"""
+        totals = [stored.sync() for stored in self.files]
+        return sum(n for n, _ in totals), sum(runs for _, runs in totals)
+
+    def close(self, flush=True):
+        """Unmap and close the file(s), flushing what was written unless flush is False"""
+        for stored in self.files:
+            stored.close(flush)
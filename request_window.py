@@ -0,0 +1,103 @@
+"""
+Per-peer window of outstanding block requests.
+
+Requests are for blocks, keyed by (piece index, offset in the piece). The
+window is sized from the bandwidth-delay product of the link: the delivery
+rate of recent blocks times the smallest request-to-block latency seen
+lately, divided by the block size. One extra request is kept in flight so the
+window can grow when the link has spare capacity, and the size is capped by
+MaxOutstandingRequests from Common.cfg.
+"""
+
+import threading
+import time
+from math import ceil
+
+RATE_SMOOTHING = 0.25  # EWMA weight of a new delivery rate sample
+MIN_RTT_WINDOW = 10.0  # Seconds before the minimum latency sample is refreshed
+
+
+class RequestWindow:
+    def __init__(self, max_outstanding, block_size):
+        self.max_outstanding = max(1, max_outstanding)
+        self.block_size = block_size
+        self.outstanding = {}  # (piece index, begin) -> monotonic time the request was sent
+        self.throughput = 0.0  # Smoothed delivery rate in bytes/s
+        self.min_rtt = None  # Smallest request-to-piece latency in the current window
+        self.min_rtt_stamp = 0.0
+        self.last_arrival = None
+        self.lock = threading.Lock()
+
+    def size(self):
+        """Number of requests that should be in flight right now"""
+        if not self.throughput or self.min_rtt is None:
+            return 1
+        bdp_blocks = ceil(self.throughput * self.min_rtt / self.block_size)
+        return max(1, min(self.max_outstanding, bdp_blocks + 1))
+
+    def free_slots(self):
+        with self.lock:
+            return max(0, self.size() - len(self.outstanding))
+
+    def pending(self):
+        with self.lock:
+            return len(self.outstanding)
+
+    def is_outstanding(self, block):
+        with self.lock:
+            return block in self.outstanding
+
+    def on_request(self, block):
+        with self.lock:
+            self.outstanding[block] = time.monotonic()
+
+    def on_block(self, block, num_bytes):
+        """Record an arrived block; returns its latency, or None if it was not outstanding"""
+        now = time.monotonic()
+        with self.lock:
+            sent_at = self.outstanding.pop(block, None)
+            if sent_at is None:
+                return None
+            latency = now - sent_at
+
+            # Delivery rate: if the pipe was already busy when this request went out,
+            # the block took only the time since the previous arrival
+            if self.last_arrival is not None and self.last_arrival > sent_at:
+                interval = now - self.last_arrival
+            else:
+                interval = latency
+            self.last_arrival = now
+            if interval > 0:
+                sample = num_bytes / interval
+                if self.throughput:
+                    self.throughput += RATE_SMOOTHING * (sample - self.throughput)
+                else:
+                    self.throughput = sample
+
+            # Windowed minimum, so queueing inside our own pipeline doesn't inflate the RTT
+            if self.min_rtt is None or latency <= self.min_rtt or now - self.min_rtt_stamp > MIN_RTT_WINDOW:
+                self.min_rtt = latency
+                self.min_rtt_stamp = now
+            return latency
+
+    def cancel(self, block):
+        """Forget a request whose block arrived from another peer; returns whether it was outstanding"""
+        with self.lock:
+            return self.outstanding.pop(block, None) is not None
+
+    def expire(self, timeout):
+        """Drop requests older than timeout seconds and return their blocks"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [block for block, sent_at in self.outstanding.items() if now - sent_at > timeout]
+            for block in expired:
+                del self.outstanding[block]
+            return expired
+
+    def clear(self):
+        """Drop all outstanding requests (e.g. when choked) and return their blocks"""
+        with self.lock:
+            dropped = list(self.outstanding)
+            self.outstanding.clear()
+            self.last_arrival = None
+            return dropped
@@ -0,0 +1,147 @@
+"""
+Resume state for partial downloads.
+
+While downloading, the client periodically records which pieces are safely on
+disk in a small state file next to the download (<file>.resume): the packed
+bitfield plus the size and modification time the file had at that moment. The
+pieces are flushed before the state is written, so every piece it lists is
+really in the file.
+
+On restart, a state file whose size and mtime still match the file is trusted
+as is. Otherwise the file changed after the last checkpoint (a crash mid-
+download, or someone edited it) and, when a manifest is available, every piece
+is checked against it in a parallel scan instead.
+
+For a multi-file share the state lives next to the share directory, and the
+size and mtime are the total size and the newest mtime of its files.
+
+A download is written to <file>.part (or the share directory <name>.part)
+until its last piece is stored; the client then fsyncs it and renames it to
+its final name, so anything found under the final name is complete.
+"""
+
+import json
+import os
+
+from bitfield import Bitfield
+
+RESUME_SUFFIX = ".resume"
+PART_SUFFIX = ".part"
+
+
+def resume_path(file_path):
+    """Where the resume state of a download lives"""
+    return file_path + RESUME_SUFFIX
+
+
+def part_path(file_path):
+    """Where a download is written until it is complete"""
+    return file_path + PART_SUFFIX
+
+
+def sync_directory(directory):
+    """fsync a directory, so a rename in it survives a crash; a no-op where directories cannot be opened"""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def save_json(path, data):
+    """Write data as JSON to path atomically: a temp file is fsynced, renamed over path and the rename synced"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_directory(os.path.dirname(path))
+
+
+def source_stat(source):
+    """(size, mtime_ns) of a file path, or total size and newest mtime of a list of (path, size) pairs"""
+    if isinstance(source, str):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime_ns
+    stats = [os.stat(path) for path, _ in source]
+    return sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0)
+
+
+class ResumeState:
+    def __init__(self, file_size, piece_size, file_mtime_ns, bitfield):
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.file_mtime_ns = file_mtime_ns
+        self.bitfield = bitfield
+
+    def is_current(self, source, file_size, piece_size):
+        """True if the file (or share) has not changed since this state was written"""
+        try:
+            size, mtime_ns = source_stat(source)
+        except OSError:
+            return False
+        return (self.file_size == file_size and self.piece_size == piece_size
+                and size == file_size and mtime_ns == self.file_mtime_ns)
+
+    @classmethod
+    def capture(cls, source, file_size, piece_size, bitfield):
+        """State for a bitfield whose pieces have already been flushed to source"""
+        return cls(file_size, piece_size, source_stat(source)[1], bitfield)
+
+    @classmethod
+    def load(cls, path, num_pieces):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        bitfield = Bitfield.from_bytes(num_pieces, bytes.fromhex(data["bitfield"]))
+        return cls(data["file_size"], data["piece_size"], data["file_mtime_ns"], bitfield)
+
+    def save(self, path):
+        data = {
+            "file_size": self.file_size,
+            "piece_size": self.piece_size,
+            "file_mtime_ns": self.file_mtime_ns,
+            "bitfield": self.bitfield.to_bytes().hex(),
+        }
+        # A crash never leaves a half-written state file
+        save_json(path, data)
+
+
+def recover_bitfield(file_path, file_size, piece_size, num_pieces, manifest=None, source=None):
+    """Work out which pieces of a partial download are usable; returns (bitfield, how it was found)"""
+    # Pieces are read from source, when it is not file_path itself (a share's list of files)
+    source = file_path if source is None else source
+    state = None
+    try:
+        state = ResumeState.load(resume_path(file_path), num_pieces)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable resume state for {file_path}: {e}")
+
+    if state is not None and state.is_current(source, file_size, piece_size):
+        return state.bitfield, "resume state"
+
+    try:
+        size = source_stat(source)[0]
+    except OSError:
+        size = None
+    if size != file_size:
+        return Bitfield(num_pieces), "nothing (file size does not match)"
+
+    if manifest is not None:
+        bitfield = Bitfield(num_pieces)
+        for piece_index in manifest.verified_pieces(source):
+            bitfield.set(piece_index)
+        return bitfield, "verification scan"
+
+    if state is not None and state.file_size == file_size and state.piece_size == piece_size:
+        # No way to check the data; the pieces listed were on disk when the state was written
+        return state.bitfield, "stale resume state (unverified, no manifest)"
+
+    return Bitfield(num_pieces), "nothing (no resume state or manifest)"
@@ -0,0 +1,97 @@
+"""
+Timer scheduler for the threaded engine.
+
+One thread keeps a heap of due times and runs each task when it comes due, one
+task at a time. Periodic tasks are rescheduled on a fixed cadence from the
+monotonic clock; if a task overruns, the ticks it missed are skipped rather
+than run back to back. Tasks are expected to be short: anything that can block
+for long (disk flushes, socket sends to slow peers) belongs outside them.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class ScheduledTask:
+    __slots__ = ("when", "seq", "callback", "interval", "cancelled")
+
+    def __init__(self, when, seq, callback, interval):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.interval = interval  # None for a one-off task
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, name="scheduler"):
+        self.heap = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def call_at(self, when, callback, interval=None):
+        """Run callback at monotonic time when, then every interval seconds if one is given"""
+        task = ScheduledTask(when, next(self.seq), callback, interval)
+        with self.condition:
+            heapq.heappush(self.heap, task)
+            # Wake the thread in case this task is due before the one it is waiting for
+            self.condition.notify()
+        return task
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def call_every(self, interval, callback, first_delay=None):
+        """Run callback every interval seconds, the first time after first_delay (default: interval)"""
+        delay = interval if first_delay is None else first_delay
+        return self.call_at(time.monotonic() + delay, callback, interval)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def next_task(self):
+        """Block until a task is due and return it, or None once stopped"""
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+                if self.heap and self.heap[0].when <= now:
+                    task = heapq.heappop(self.heap)
+                    if task.cancelled:
+                        continue
+                    if task.interval is not None:
+                        task.when += task.interval
+                        if task.when <= now:
+                            task.when = now + task.interval
+                        heapq.heappush(self.heap, task)
+                    return task
+                self.condition.wait(self.heap[0].when - now if self.heap else None)
+            return None
+
+    def run(self):
+        """Body of the scheduler thread"""
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            try:
+                task.callback()
+            except Exception as e:
+                print(f"Scheduled task {getattr(task.callback, '__name__', task.callback)} failed: {e}")
@@ -21,7 +21,17 @@ DEFAULT_CONFIG = {
     "OptimisticUnchokingInterval": 15,
     "FileName": "TheFile.dat",
     "FileSize": 10485760,  # 10MB
-    "PieceSize": 32768     # 32KB
+    "PieceSize": 32768,    # 32KB
+    "BlockSize": 16384,
+    "MaxOutstandingRequests": 16,
+    "PieceSelection": "rarest-first",
+    "EndGameThreshold": 8,
+    "RateHalfLife": 10,
+    "ChokeHysteresis": 0.2,
+    "HaveBatchDelay": 0.05,
+    "MaxConcurrentDials": 8,
+    "DialBackoffMax": 60,
+    "FlushPolicy": "periodic"
 }
 
 # Default peer information
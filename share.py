@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Multi-file shares.
+
+A share distributes a whole directory over one swarm. Its files, in the order
+the share manifest lists them, are laid end to end and cut into PieceSize
+pieces, so there is a single piece space (and a single bitfield) for the
+whole directory, and a piece may span the end of one file and the start of
+the next.
+
+The share manifest (<directory>.share, JSON) records the directory name, the
+piece size, every file's relative path and size, and by default one digest
+per piece over the concatenated files, so downloads are verified the same way
+a ManifestFile verifies a single file. Point ShareFile in Common.cfg at it;
+FileName, FileSize and PieceSize then come from the share. Every peer keeps
+the files under peer_<id>/<directory name>/.
+
+Usage: python share.py DIRECTORY --piece-size PIECE_SIZE [--algorithm {sha1,sha256}]
+                       [--no-hashes] [--workers N] [--output PATH]
+"""
+
+import argparse
+import json
+import os
+import posixpath
+from math import ceil
+
+from manifest import ALGORITHMS, DEFAULT_ALGORITHM, Manifest, hash_file
+from resume import save_json
+
+SHARE_SUFFIX = ".share"
+
+
+def share_path(directory):
+    """Where the share manifest of a directory is written by default"""
+    return os.path.normpath(directory) + SHARE_SUFFIX
+
+
+def check_relative_path(path):
+    """Refuse paths that would put a file outside the share directory"""
+    parts = path.split("/")
+    if not path or posixpath.isabs(path) or "\\" in path or any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Invalid path in share: {path!r}")
+    return path
+
+
+class Share:
+    def __init__(self, name, piece_size, files, algorithm=None, digests=None):
+        self.name = check_relative_path(name)
+        self.piece_size = piece_size
+        self.files = [(check_relative_path(path), size) for path, size in files]  # [(relative path, size), ...]
+        self.total_size = sum(size for _, size in self.files)
+        self.num_pieces = ceil(self.total_size / piece_size)
+        self.algorithm = algorithm
+        self.digests = digests
+        if not self.files or self.total_size == 0:
+            raise ValueError(f"Share {name} has no data")
+        if digests is not None and len(digests) != self.num_pieces:
+            raise ValueError(f"Share has {len(digests)} digests for {self.num_pieces} pieces")
+
+    def file_paths(self, root, name=None):
+        """(path, size) of every file, with the share directory under root (named name, if given)"""
+        return [(os.path.join(root, name or self.name, *path.split("/")), size) for path, size in self.files]
+
+    def manifest(self):
+        """The share's piece digests as a Manifest, or None if it has none"""
+        if self.digests is None:
+            return None
+        return Manifest(self.total_size, self.piece_size, self.algorithm, self.digests)
+
+    @classmethod
+    def from_directory(cls, directory, piece_size, algorithm=DEFAULT_ALGORITHM, hashes=True, workers=None):
+        """Describe every file under directory, in sorted path order, hashing the pieces unless hashes is False"""
+        directory = os.path.normpath(directory)
+        files = []
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            for name in sorted(names):
+                full_path = os.path.join(root, name)
+                relative = os.path.relpath(full_path, directory).replace(os.sep, "/")
+                files.append((relative, os.path.getsize(full_path)))
+        share = cls(os.path.basename(directory), piece_size, files)
+        if hashes:
+            share.algorithm = algorithm
+            share.digests = hash_file(share.file_paths(os.path.dirname(directory)), piece_size, algorithm,
+                                      share.num_pieces, workers)
+        return share
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        digests = [bytes.fromhex(d) for d in data["pieces"]] if data.get("pieces") is not None else None
+        return cls(data["name"], data["piece_size"], [(entry["path"], entry["size"]) for entry in data["files"]],
+                   data.get("algorithm"), digests)
+
+    def save(self, path):
+        data = {
+            "name": self.name,
+            "piece_size": self.piece_size,
+            "total_size": self.total_size,
+            "files": [{"path": path, "size": size} for path, size in self.files],
+            "algorithm": self.algorithm,
+            "pieces": [d.hex() for d in self.digests] if self.digests is not None else None,
+        }
+        # A reader never sees a half-written share manifest, even after a crash
+        save_json(path, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the share manifest of a directory")
+    parser.add_argument("directory", help="Directory to share (the seeder's copy)")
+    parser.add_argument("--piece-size", type=int, required=True, help="Piece size in bytes")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default=DEFAULT_ALGORITHM)
+    parser.add_argument("--no-hashes", action="store_true", help="Leave out the piece digests")
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes (default: one per core)")
+    parser.add_argument("--output", default=None, help=f"Share manifest path (default: DIRECTORY{SHARE_SUFFIX})")
+    args = parser.parse_args()
+
+    share = Share.from_directory(args.directory, args.piece_size, args.algorithm, not args.no_hashes, args.workers)
+    output = args.output or share_path(args.directory)
+    share.save(output)
+    print(f"Wrote {output}: {len(share.files)} files, {share.total_size} bytes, {share.num_pieces} pieces"
+          + (f" ({share.algorithm})" if share.digests is not None else ""))
+    print(f"Set 'ShareFile {output}' in Common.cfg and put the directory at peer_<id>/{share.name} on the seeder")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Loopback swarm benchmark.
+
+Starts N peerProcess.py processes on 127.0.0.1 in a fresh directory, peer 1001
+seeding a file generated from a fixed seed, and runs until every other peer
+has the whole file. Each peer records an event trace, so the timings come from
+the peers themselves rather than from polling:
+
+  - time to first piece and completion time per leecher, from launch
+  - swarm completion time and aggregate download throughput
+  - CPU time and peak RSS of every peer process (from wait4)
+
+Results are printed and optionally written as JSON. Given a baseline (an
+earlier --output file), the medians over all runs are compared against it and
+the exit status is 1 if anything got worse by more than --tolerance.
+
+Usage: python swarm_benchmark.py [--peers N] [--file-size BYTES] [--piece-size PIECE_SIZE]
+                                 [--preferred-neighbors K] [--engine {threads,asyncio}] [--runs RUNS]
+                                 [--set KEY=VALUE ...] [--keep] [--output FILE] [--baseline FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import event_trace
+from event_trace import read_trace
+
+PEER_PROCESS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "peerProcess.py")
+FIRST_PEER_ID = 1001
+FILE_NAME = "bench.dat"
+POLL_INTERVAL = 0.1
+STOP_TIMEOUT = 10.0  # Seconds a peer gets to shut down after SIGTERM before it is killed
+
+# Summary metrics compared against a baseline, and whether lower values are better
+COMPARED_METRICS = {
+    "swarm_complete_s": True,
+    "mean_first_piece_s": True,
+    "mean_complete_s": True,
+    "throughput_mib_s": False,
+    "total_cpu_s": True,
+    "max_peak_rss_kb": True,
+}
+
+
+def make_file(path, size, seed):
+    """Write size pseudo-random bytes that depend only on seed"""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 1 << 20)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+
+def free_port_range(count, start):
+    """First port >= start such that count consecutive ports are free on 127.0.0.1"""
+    port = start
+    while port + count < 65536:
+        for offset in range(count):
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.bind(("127.0.0.1", port + offset))
+                except OSError:
+                    break
+        else:
+            return port
+        port += offset + 1
+    raise RuntimeError(f"No {count} consecutive free ports above {start}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(PEER_PROCESS), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_configs(work_dir, args, base_port):
+    with open(os.path.join(work_dir, "Common.cfg"), "w") as f:
+        f.write(f"NumberOfPreferredNeighbors {args.preferred_neighbors}\n")
+        f.write(f"UnchokingInterval {args.unchoking_interval}\n")
+        f.write(f"OptimisticUnchokingInterval {args.optimistic_interval}\n")
+        f.write(f"FileName {FILE_NAME}\n")
+        f.write(f"FileSize {args.file_size}\n")
+        f.write(f"PieceSize {args.piece_size}\n")
+        for key, value in args.set:
+            f.write(f"{key} {value}\n")
+    with open(os.path.join(work_dir, "PeerInfo.cfg"), "w") as f:
+        for i in range(args.peers):
+            f.write(f"{FIRST_PEER_ID + i} localhost {base_port + i} {1 if i == 0 else 0}\n")
+
+
+def completed_peers(work_dir, peer_ids):
+    """Peers whose log already records the completed download"""
+    done = set()
+    for peer_id in peer_ids:
+        try:
+            with open(os.path.join(work_dir, f"log_peer_{peer_id}.log")) as f:
+                if "has downloaded the complete file" in f.read():
+                    done.add(peer_id)
+        except OSError:
+            pass
+    return done
+
+
+def reap(pid, deadline):
+    """wait4 a child until deadline; returns its rusage, or None if it is still running"""
+    while True:
+        reaped, _, usage = os.wait4(pid, os.WNOHANG)
+        if reaped:
+            return usage
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(POLL_INTERVAL)
+
+
+def peer_timings(trace_path, start_ns):
+    """(first piece, completion) in seconds after launch, from a peer's trace"""
+    first_piece = complete = None
+    try:
+        _, records = read_trace(trace_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {trace_path}: {e}")
+        return None, None
+    for timestamp_ns, _, _, _, event_type in records:
+        if event_type == event_trace.PIECE_STORED and first_piece is None:
+            first_piece = (timestamp_ns - start_ns) / 1e9
+        elif event_type == event_trace.COMPLETE:
+            complete = (timestamp_ns - start_ns) / 1e9
+    return first_piece, complete
+
+
+def run_swarm(args, run_number):
+    """Run one swarm to completion (or timeout) in a fresh directory, removed afterwards unless --keep"""
+    work_dir = tempfile.mkdtemp(prefix="swarm_benchmark_")
+    try:
+        return measure_swarm(args, run_number, work_dir)
+    finally:
+        if args.keep:
+            print(f"Kept run {run_number} in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure_swarm(args, run_number, work_dir):
+    """Run one swarm in work_dir and return its measurements"""
+    base_port = free_port_range(args.peers, args.port)
+    write_configs(work_dir, args, base_port)
+    os.makedirs(os.path.join(work_dir, f"peer_{FIRST_PEER_ID}"))
+    make_file(os.path.join(work_dir, f"peer_{FIRST_PEER_ID}", FILE_NAME), args.file_size, args.seed)
+
+    peer_ids = [str(FIRST_PEER_ID + i) for i in range(args.peers)]
+    leechers = peer_ids[1:]
+    processes = {}
+    start_ns = time.time_ns()
+    started = time.monotonic()
+    for peer_id in peer_ids:
+        command = [sys.executable, PEER_PROCESS, peer_id, "--config", "Common.cfg", "--peer-info", "PeerInfo.cfg",
+                   "--engine", args.engine, "--trace", f"trace_peer_{peer_id}.bin"]
+        with open(os.path.join(work_dir, f"out_{peer_id}.txt"), "w") as out:
+            processes[peer_id] = subprocess.Popen(command, cwd=work_dir, stdout=out, stderr=subprocess.STDOUT)
+        if args.stagger:
+            time.sleep(args.stagger)
+
+    # The log writer flushes at least once a second, so this only decides when to stop;
+    # the timings themselves come from the traces
+    done = set()
+    while len(done) < len(leechers) and time.monotonic() - started < args.timeout:
+        time.sleep(POLL_INTERVAL)
+        done = completed_peers(work_dir, leechers)
+    timed_out = len(done) < len(leechers)
+
+    # Reap with wait4 rather than Popen.poll/wait, which would throw the rusage away
+    usages = {peer_id: reap(process.pid, 0) for peer_id, process in processes.items()}
+    for peer_id, process in processes.items():
+        if usages[peer_id] is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for peer_id, process in processes.items():
+        usage = usages[peer_id] or reap(process.pid, deadline)
+        if usage is None:
+            print(f"Peer {peer_id} did not stop, killing it")
+            process.kill()
+            usage = reap(process.pid, time.monotonic() + STOP_TIMEOUT)
+        usages[peer_id] = usage
+
+    peers = {}
+    for peer_id in peer_ids:
+        first_piece, complete = peer_timings(os.path.join(work_dir, f"trace_peer_{peer_id}.bin"), start_ns)
+        usage = usages[peer_id]
+        peers[peer_id] = {
+            "seeder": peer_id == peer_ids[0],
+            "first_piece_s": first_piece,
+            "complete_s": complete,
+            "cpu_s": round(usage.ru_utime + usage.ru_stime, 3) if usage else None,
+            "peak_rss_kb": usage.ru_maxrss if usage else None,
+        }
+
+    first_pieces = [peers[p]["first_piece_s"] for p in leechers if peers[p]["first_piece_s"] is not None]
+    completions = [peers[p]["complete_s"] for p in leechers if peers[p]["complete_s"] is not None]
+    all_complete = len(completions) == len(leechers)
+    swarm_complete = max(completions) if all_complete and completions else None
+    result = {
+        "run": run_number,
+        "work_dir": work_dir if args.keep else None,
+        "timed_out": timed_out,
+        "completed_peers": len(completions),
+        "swarm_complete_s": swarm_complete,
+        "mean_first_piece_s": statistics.mean(first_pieces) if first_pieces else None,
+        "mean_complete_s": statistics.mean(completions) if all_complete and completions else None,
+        "throughput_mib_s": (args.file_size * len(leechers) / swarm_complete / (1 << 20)) if swarm_complete else None,
+        "total_cpu_s": round(sum(p["cpu_s"] or 0 for p in peers.values()), 3),
+        "max_peak_rss_kb": max((p["peak_rss_kb"] or 0 for p in peers.values()), default=0),
+        "peers": peers,
+    }
+    print(f"Run {run_number}: {len(completions)}/{len(leechers)} leechers complete, "
+          f"swarm {format_value(swarm_complete)}s, first piece {format_value(result['mean_first_piece_s'])}s avg, "
+          f"{format_value(result['throughput_mib_s'])} MiB/s, CPU {result['total_cpu_s']}s, "
+          f"peak RSS {result['max_peak_rss_kb']} KB")
+    return result
+
+
+def summarize(runs):
+    """Median of each compared metric over the runs where it was measured"""
+    summary = {}
+    for metric in COMPARED_METRICS:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        median = statistics.median(values) if values else None
+        summary[metric] = int(median) if values and all(isinstance(v, int) for v in values) else median
+    summary["complete_runs"] = sum(1 for run in runs if run["swarm_complete_s"] is not None)
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """Print current vs baseline medians; returns the metrics that regressed beyond tolerance"""
+    regressions = []
+    print(f"{'metric':<20} {'baseline':>12} {'current':>12} {'change':>9}")
+    for metric, lower_is_better in COMPARED_METRICS.items():
+        old = baseline.get(metric)
+        new = summary.get(metric)
+        if old is None or new is None or old == 0:
+            print(f"{metric:<20} {format_value(old):>12} {format_value(new):>12} {'-':>9}")
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        better = change < -tolerance if lower_is_better else change > tolerance
+        verdict = "REGRESSION" if worse else ("improved" if better else "")
+        print(f"{metric:<20} {format_value(old):>12} {format_value(new):>12} {change:>+8.1%} {verdict}")
+        if worse:
+            regressions.append(metric)
+    return regressions
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def parse_setting(text):
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a swarm of peers on loopback")
+    parser.add_argument("--peers", type=int, default=5, help="Number of peers, including the seeder")
+    parser.add_argument("--file-size", type=int, default=10 * 1024 * 1024)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--preferred-neighbors", type=int, default=2)
+    parser.add_argument("--unchoking-interval", type=int, default=1)
+    parser.add_argument("--optimistic-interval", type=int, default=2)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--set", type=parse_setting, action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra Common.cfg setting, e.g. --set PieceSelection=random")
+    parser.add_argument("--runs", type=int, default=3, help="Swarms to run; results are medians over the runs")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the shared file's contents")
+    parser.add_argument("--stagger", type=float, default=0.0,
+                        help="Seconds between peer launches (later peers retry their dials anyway)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds before a run is given up")
+    parser.add_argument("--port", type=int, default=7100, help="Lowest port to give the peers")
+    parser.add_argument("--keep", action="store_true", help="Keep each run's directory (configs, logs, traces, files)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against results from an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative change that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    if args.peers < 2:
+        parser.error("--peers must be at least 2")
+
+    runs = [run_swarm(args, i + 1) for i in range(args.runs)]
+    summary = summarize(runs)
+    results = {
+        "config": {
+            "peers": args.peers,
+            "file_size": args.file_size,
+            "piece_size": args.piece_size,
+            "preferred_neighbors": args.preferred_neighbors,
+            "unchoking_interval": args.unchoking_interval,
+            "optimistic_interval": args.optimistic_interval,
+            "engine": args.engine,
+            "settings": dict(args.set),
+            "seed": args.seed,
+            "stagger": args.stagger,
+        },
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "summary": summary,
+        "runs": runs,
+    }
+
+    print()
+    print(f"Median over {len(runs)} runs ({summary['complete_runs']} complete):")
+    for metric in COMPARED_METRICS:
+        print(f"  {metric:<20} {format_value(summary[metric])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: the baseline was run with a different configuration")
+        print()
+        print(f"Compared with {args.baseline} (commit {baseline.get('environment', {}).get('commit')}):")
+        regressions = compare(summary, baseline.get("summary", {}), args.tolerance)
+        if regressions:
+            print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            status = 1
+    if summary["complete_runs"] < len(runs):
+        status = 1
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
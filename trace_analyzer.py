@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Analyzer for binary event traces written with peerProcess.py --trace.
+
+For each trace it reports:
+  - per-peer download and upload throughput over time, in fixed intervals
+  - request-to-block latency percentiles, overall and per peer
+  - the choke/unchoke timeline in both directions, with a flap count per peer
+
+Usage: python trace_analyzer.py TRACE [TRACE ...] [--interval SECONDS] [--json] [--dump]
+"""
+
+import argparse
+import json
+from collections import defaultdict, deque
+from math import ceil
+
+import event_trace
+from event_trace import EVENT_NAMES, NO_PIECE, read_trace
+
+CHOKE_EVENTS = (event_trace.CHOKE_SENT, event_trace.UNCHOKE_SENT, event_trace.CHOKED_BY, event_trace.UNCHOKED_BY)
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    summary = {"count": len(values)}
+    for pct in PERCENTILES:
+        summary[f"p{pct}_ms"] = percentile(values, pct)
+    summary["max_ms"] = values[-1] if values else None
+    return summary
+
+
+def analyze(records, interval):
+    """Turn the records of one trace into throughput, latency and choke reports"""
+    if not records:
+        return {"duration_s": 0, "events": {}, "throughput": {}, "latency": {}, "chokes": [], "flaps": {}}
+    start_ns = records[0][0]
+    end_ns = records[-1][0]
+    num_buckets = int((end_ns - start_ns) / 1e9 // interval) + 1
+
+    events = defaultdict(int)
+    download = defaultdict(lambda: [0] * num_buckets)
+    upload = defaultdict(lambda: [0] * num_buckets)
+    sent_at = defaultdict(deque)  # (peer, piece) -> send times of its outstanding block requests, oldest first
+    latencies = defaultdict(list)
+    chokes = []
+    flaps = defaultdict(int)
+
+    for timestamp_ns, peer_id, piece_index, num_bytes, event_type in records:
+        events[EVENT_NAMES.get(event_type, str(event_type))] += 1
+        offset = (timestamp_ns - start_ns) / 1e9
+        bucket = int(offset // interval)
+
+        # Traces name the piece but not the block; a peer answers the blocks of a piece in the order asked
+        if event_type == event_trace.REQUEST_SENT:
+            sent_at[(peer_id, piece_index)].append(timestamp_ns)
+        elif event_type == event_trace.PIECE_RECEIVED:
+            download[peer_id][bucket] += num_bytes
+            requested = sent_at.get((peer_id, piece_index))
+            if requested:
+                latencies[peer_id].append((timestamp_ns - requested.popleft()) / 1e6)
+        elif event_type in (event_trace.REQUEST_TIMEOUT, event_trace.CANCEL_SENT):
+            requested = sent_at.get((peer_id, piece_index))
+            if requested:
+                requested.popleft()
+        elif event_type == event_trace.PIECE_SENT:
+            upload[peer_id][bucket] += num_bytes
+        elif event_type in CHOKE_EVENTS:
+            chokes.append((round(offset, 3), peer_id, EVENT_NAMES[event_type]))
+            flaps[peer_id] += 1
+
+    def rates(series):
+        return {str(peer): [round(b / interval / 1024, 1) for b in buckets] for peer, buckets in sorted(series.items())}
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "duration_s": round((end_ns - start_ns) / 1e9, 3),
+        "events": dict(sorted(events.items())),
+        "throughput": {"interval_s": interval, "download_kib_s": rates(download), "upload_kib_s": rates(upload)},
+        "latency": {
+            "all": latency_summary(all_latencies),
+            "per_peer": {str(peer): latency_summary(values) for peer, values in sorted(latencies.items())},
+        },
+        "chokes": chokes,
+        "flaps": {str(peer): count for peer, count in sorted(flaps.items())},
+    }
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_rates(title, rates, interval):
+    if not rates:
+        print(f"{title}: none")
+        return
+    peers = list(rates)
+    print(f"{title} (KiB/s per {interval:g}s interval):")
+    print(f"{'time s':>8} " + " ".join(f"{peer:>9}" for peer in peers))
+    for bucket in range(len(rates[peers[0]])):
+        print(f"{bucket * interval:>8.1f} " + " ".join(f"{rates[peer][bucket]:>9.1f}" for peer in peers))
+
+
+def print_report(path, own_peer_id, report):
+    print(f"=== {path} (peer {own_peer_id}), {report['duration_s']}s ===")
+    print("Events: " + ", ".join(f"{name} {count}" for name, count in report["events"].items()))
+    print()
+    throughput = report["throughput"]
+    if throughput:
+        print_rates("Download", throughput["download_kib_s"], throughput["interval_s"])
+        print()
+        print_rates("Upload", throughput["upload_kib_s"], throughput["interval_s"])
+        print()
+
+    print("Request-to-block latency (ms):")
+    print(f"{'peer':>8} {'count':>7} " + " ".join(f"{'p' + str(p):>8}" for p in PERCENTILES) + f" {'max':>8}")
+    latency = report["latency"]
+    rows = list(latency.get("per_peer", {}).items()) + ([("all", latency["all"])] if latency else [])
+    for peer, summary in rows:
+        print(f"{peer:>8} {summary['count']:>7} "
+              + " ".join(f"{format_ms(summary[f'p{p}_ms']):>8}" for p in PERCENTILES)
+              + f" {format_ms(summary['max_ms']):>8}")
+    print()
+
+    print("Choke/unchoke timeline:")
+    for offset, peer, name in report["chokes"]:
+        print(f"  +{offset:>9.3f}s  peer {peer}  {name}")
+    if report["flaps"]:
+        print("Choke state changes per peer: " + ", ".join(f"{peer} {count}" for peer, count in report["flaps"].items()))
+    print()
+
+
+def dump(records):
+    start_ns = records[0][0] if records else 0
+    for timestamp_ns, peer_id, piece_index, num_bytes, event_type in records:
+        piece = "-" if piece_index == NO_PIECE else piece_index
+        print(f"+{(timestamp_ns - start_ns) / 1e9:>10.6f}s {EVENT_NAMES.get(event_type, event_type):<16} "
+              f"peer {peer_id} piece {piece} bytes {num_bytes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize binary event traces")
+    parser.add_argument("traces", nargs="+", help="Trace files written with peerProcess.py --trace")
+    parser.add_argument("--interval", type=float, default=1.0, help="Throughput interval in seconds")
+    parser.add_argument("--json", action="store_true", help="Print the reports as JSON")
+    parser.add_argument("--dump", action="store_true", help="Print every record instead of a report")
+    args = parser.parse_args()
+
+    reports = {}
+    for path in args.traces:
+        own_peer_id, records = read_trace(path)
+        if args.dump:
+            dump(records)
+            continue
+        report = analyze(records, args.interval)
+        report["peer_id"] = own_peer_id
+        if args.json:
+            reports[path] = report
+        else:
+            print_report(path, own_peer_id, report)
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()